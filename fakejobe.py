@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+
+'''A stand-in for a Jobe server, for testing the load-testing tools.
+
+    Speaks just enough of the Jobe REST API (GET languages, POST runs) for
+    loadtestjobe.py and friends, but doesn't actually run anything. Each run
+    occupies one of a fixed number of worker slots for a time drawn from a
+    configurable per-language service-time distribution, mimicking a Jobe
+    server with that many jobe users. Overload is modelled the way a real
+    deployment behaves:
+
+      * A run that can't get a worker slot within MAX_WAIT_SECS gets an
+        HTTP 200 response with outcome 21 (RESULT_SERVER_OVERLOAD), as Jobe
+        itself does.
+      * If more than MAX_QUEUE runs are already waiting, the request is
+        rejected immediately with HTTP 503, as a fronting proxy would.
+
+    Service-time distributions are given as language=distribution, where
+    distribution is one of const:T, exp:MEAN, uniform:LOW,HIGH or
+    lognormal:MEDIAN,SIGMA (all times in seconds). For example
+
+        python3 fakejobe.py --port 4000 --workers 8 --service c=lognormal:0.6,0.3
+
+    Python 3 standard library only.
+'''
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+PORT = 4000
+NUM_WORKERS = 8         # Concurrent runs, like the number of jobe users
+MAX_WAIT_SECS = 10      # Time a run waits for a worker before outcome 21
+MAX_QUEUE = 500         # Waiting runs beyond this many get HTTP 503
+
+RESULT_SUCCESS = 15
+RESULT_SERVER_OVERLOAD = 21
+
+DEFAULT_SERVICE_TIMES = {
+    'python3': 'lognormal:0.15,0.4',
+    'c': 'lognormal:0.5,0.3',
+    'cpp': 'lognormal:0.8,0.3',
+    'java': 'lognormal:1.2,0.3',
+    'octave': 'lognormal:0.8,0.3',
+    'nodejs': 'lognormal:0.2,0.4',
+    'php': 'lognormal:0.15,0.4',
+    'pascal': 'lognormal:0.4,0.3'
+}
+
+
+def make_sampler(spec):
+    '''Return a function of no arguments that returns random service times
+       according to the given distribution spec (see module docstring)
+    '''
+    kind, _, args = spec.partition(':')
+    params = [float(arg) for arg in args.split(',')]
+    if kind == 'const':
+        return lambda: params[0]
+    elif kind == 'exp':
+        return lambda: random.expovariate(1.0 / params[0])
+    elif kind == 'uniform':
+        return lambda: random.uniform(params[0], params[1])
+    elif kind == 'lognormal':
+        mu = math.log(params[0])
+        return lambda: random.lognormvariate(mu, params[1])
+    else:
+        raise ValueError("Unknown service time distribution '{}'".format(spec))
+
+
+class FakeJobe:
+    '''The state of the fake server: its worker slots and service-time samplers'''
+    def __init__(self, service_times, num_workers=NUM_WORKERS, max_wait=MAX_WAIT_SECS, max_queue=MAX_QUEUE):
+        self.samplers = {language: make_sampler(spec) for (language, spec) in service_times.items()}
+        self.workers = asyncio.Semaphore(num_workers)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.counts = {}  # Map from response type to count, for the final report
+
+    def count(self, what):
+        self.counts[what] = self.counts.get(what, 0) + 1
+
+    async def run(self, run_spec):
+        '''Return the pair (http status, response object) for the given run_spec'''
+        language = run_spec.get('language_id', '')
+        if language not in self.samplers:
+            self.count('400')
+            return 400, 'Language {} not known'.format(language)
+        if self.waiting >= self.max_queue:
+            self.count('503')
+            return 503, 'Service unavailable'
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.workers.acquire(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self.count('overload')
+            return 200, self.result(RESULT_SERVER_OVERLOAD)
+        finally:
+            self.waiting -= 1
+        try:
+            await asyncio.sleep(self.samplers[language]())
+        finally:
+            self.workers.release()
+        self.count('ok')
+        return 200, self.result(RESULT_SUCCESS)
+
+    @staticmethod
+    def result(outcome):
+        return {'run_id': None, 'outcome': outcome, 'cmpinfo': '', 'stdout': '', 'stderr': ''}
+
+    async def handle(self, method, path, body):
+        '''Return the pair (http status, response object) for a request'''
+        if method == 'GET' and path.endswith('/languages'):
+            return 200, [[language, 'fake'] for language in sorted(self.samplers)]
+        elif method == 'POST' and path.endswith('/runs'):
+            try:
+                run_spec = json.loads(body.decode('utf-8'))['run_spec']
+            except (ValueError, KeyError, TypeError):
+                self.count('400')
+                return 400, 'Bad run_spec'
+            return await self.run(run_spec)
+        else:
+            return 404, 'Not found'
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+
+
+async def serve_connection(jobe, reader, writer):
+    '''Handle HTTP/1.1 requests on one (keep-alive) connection'''
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await jobe.handle(method, path, body)
+            payload = json.dumps(response).encode('utf-8')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                status, REASONS.get(status, ''), len(payload)).encode('latin-1') + payload)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(jobe, port):
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(jobe, reader, writer), '0.0.0.0', port, backlog=4096)
+    print('Fake Jobe listening on port {}'.format(port))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A fake Jobe server for testing load testers')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='Number of concurrent runs')
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT_SECS,
+                        help='Seconds a run waits for a worker before getting outcome 21')
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE,
+                        help='Number of waiting runs beyond which requests get HTTP 503')
+    parser.add_argument('--service', action='append', default=[], metavar='LANGUAGE=DIST',
+                        help='Service time distribution for a language, e.g. c=lognormal:0.6,0.3')
+    args = parser.parse_args()
+
+    service_times = dict(DEFAULT_SERVICE_TIMES)
+    for setting in args.service:
+        language, _, spec = setting.partition('=')
+        make_sampler(spec)  # Check it parses
+        service_times[language] = spec
+
+    async def run():
+        jobe = FakeJobe(service_times, args.workers, args.max_wait, args.max_queue)
+        try:
+            await serve(jobe, args.port)
+        finally:
+            print('Responses:', jobe.counts)
+
+    start = time.time()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print('Fake Jobe stopped after {:.0f} secs'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,608 @@
+#! /usr/bin/env python3
+
+'''Asyncio engine for the CodeRunner load tester.
+
+    Runs the same login -> course -> quiz -> submit loop as
+    loop_doing_questions() in loadtesting3.py, but with each virtual student
+    as a coroutine rather than a process running a mechanize browser. All
+    students share a single pooled aiohttp connector (each has its own
+    cookie jar, so its own Moodle session), which lets one client process
+    drive several thousand concurrent students.
+
+    Server, course, language, questions, answers and password are all taken
+    from loadtesting3.py; the constants below control only the engine itself.
+    Select this engine by setting ENGINE = 'asyncio' in loadtesting3.py.
+
+    Requires aiohttp (pip3 install aiohttp). With thousands of students
+    you will probably also need to raise the open file limit (ulimit -n).
+'''
+
+import asyncio
+import html
+import random
+import re
+import time
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlencode
+
+import aiohttp
+
+import loadtesting3 as lt
+from loadtesthistogram import LatencyRecorder, WINDOW_SECS
+from loadtestresults import error_excerpt
+from loadtesttrace import tracer_for
+from loadtestworkload import arrival_times
+
+MAX_CONNECTIONS = 1000       # Size of the connection pool shared by all students
+LOGIN_RAMP_SECS = 60         # Student logins are spread uniformly over this time
+REQUEST_TIMEOUT_SECS = 120   # Total time allowed for any one HTTP request
+LATE_SEND_SECS = 0.1         # Open-loop sends more than this far behind schedule are reported
+KEEPALIVE_SECS = 60          # Idle pooled connections are kept open this long
+FAST_PATH = False            # Skip navigation after each student's first visit to a quiz (see QuizShortcut)
+
+INPUT_TAG = re.compile(r'<input\b[^>]*>', re.IGNORECASE)
+ATTRIBUTE = re.compile(r'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+
+
+class LinkNotFoundError(Exception):
+    '''Raised when following a link that isn't on the current page'''
+
+
+class Form:
+    '''A minimal HTML form: its action url, method and a list of controls,
+       each a [name, type, value] triple in document order. Unchecked
+       checkboxes and radio buttons are not recorded.
+    '''
+    def __init__(self, action, method):
+        self.action = action
+        self.method = method.upper()
+        self.controls = []
+
+    def names(self, type):
+        '''Return the names of all controls of the given type'''
+        return [name for (name, control_type, value) in self.controls if control_type == type]
+
+    def set(self, name, value):
+        '''Set the value of the named control(s)'''
+        for control in self.controls:
+            if control[0] == name:
+                control[2] = value
+
+    def data(self, submit_name=None):
+        '''Return the list of (name, value) pairs a browser would send
+           when the named submit button (default: the first) is clicked
+        '''
+        pairs = []
+        clicked = False
+        for name, control_type, value in self.controls:
+            if control_type != 'submit':
+                pairs.append((name, value))
+            elif not clicked and (submit_name is None or name == submit_name):
+                pairs.append((name, value))
+                clicked = True
+        return pairs
+
+
+class PageParser(HTMLParser):
+    '''Extracts the links (as (text, url) pairs) and forms from an HTML page'''
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.links = []
+        self.forms = []
+        self._in_form = False
+        self._link = None       # [href, text fragments] while inside an <a>
+        self._textarea = None   # [control, text fragments] while inside a <textarea>
+        self._select = None     # The control while inside a <select>
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {key: value if value is not None else '' for (key, value) in attrs}
+        if tag == 'a' and attrs.get('href'):
+            self._link = [attrs['href'], []]
+        elif tag == 'form':
+            action = urljoin(self.base_url, attrs.get('action') or self.base_url)
+            self.forms.append(Form(action, attrs.get('method') or 'GET'))
+            self._in_form = True
+        elif not self._in_form or not attrs.get('name'):
+            pass
+        elif tag in ('input', 'button'):
+            control_type = attrs.get('type', 'submit' if tag == 'button' else 'text').lower()
+            if control_type in ('checkbox', 'radio') and 'checked' not in attrs:
+                return
+            if control_type in ('reset', 'file', 'image', 'button'):
+                return
+            self.forms[-1].controls.append([attrs['name'], control_type, attrs.get('value', '')])
+        elif tag == 'textarea':
+            control = [attrs['name'], 'textarea', '']
+            self.forms[-1].controls.append(control)
+            self._textarea = [control, []]
+        elif tag == 'select':
+            self._select = [attrs['name'], 'select', None]
+            self.forms[-1].controls.append(self._select)
+        if tag == 'option' and self._select is not None:
+            if self._select[2] is None or 'selected' in attrs:
+                self._select[2] = attrs.get('value', '')
+
+    def handle_data(self, data):
+        if self._link is not None:
+            self._link[1].append(data)
+        if self._textarea is not None:
+            self._textarea[1].append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._link is not None:
+            href, text = self._link
+            self.links.append((''.join(text).strip(), urljoin(self.base_url, href)))
+            self._link = None
+        elif tag == 'textarea' and self._textarea is not None:
+            control, text = self._textarea
+            control[2] = ''.join(text)
+            self._textarea = None
+        elif tag == 'select' and self._select is not None:
+            if self._select[2] is None:
+                self._select[2] = ''
+            self._select = None
+        elif tag == 'form':
+            self._in_form = False
+
+    def find_link(self, text_regex):
+        '''Return the url of the first link whose text matches text_regex'''
+        for text, url in self.links:
+            if re.search(text_regex, text):
+                return url
+        raise LinkNotFoundError(text_regex)
+
+
+class QuizShortcut:
+    '''What a student needs to go straight from any page to the Check button
+       of a quiz they have visited before: the start (or continue) attempt
+       form from the quiz view page, and the attempt form itself with the
+       names of its answer field and Check button. Moodle takes a student
+       with an attempt in progress straight back to it, so the field names
+       stay the same; only hidden values such as the sequence check change,
+       and those are refreshed by a quick scan of the page's input tags
+       rather than a full parse.
+    '''
+    def __init__(self, start_form, attempt_form, answer_name):
+        self.start_form = start_form
+        self.attempt_form = attempt_form
+        self.answer_name = answer_name
+        self.hidden = set(attempt_form.names('hidden'))
+
+    def refresh(self, page_html):
+        '''Update the attempt form's hidden values from a freshly fetched
+           attempt page. Return False if the page lacks any of the expected
+           fields (e.g. because it's a new attempt), in which case the
+           shortcut is no longer usable.
+        '''
+        values = {}
+        for tag in INPUT_TAG.finditer(page_html):
+            attrs = {name: ''.join(value) for (name, *value) in ATTRIBUTE.findall(tag.group(0))}
+            if attrs.get('name') in self.hidden:
+                values[attrs['name']] = html.unescape(attrs.get('value', ''))
+        if set(values) != self.hidden:
+            return False
+        for name, value in values.items():
+            self.attempt_form.set(name, value)
+        return True
+
+
+class VirtualStudent:
+    '''A browser-like HTTP client for one student, holding that student's
+       Moodle session cookie and the most recently loaded page. If tracing
+       is on (loadtesting3.TRACE_FILE), each request is traced as a span of
+       the student's current phase and question.
+    '''
+    def __init__(self, student_num, connector):
+        self.student_num = student_num
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            connector_owner=False,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECS))
+        self.html = ''
+        self.page = None
+        self.shortcuts = {}  # Map from (language, question) to QuizShortcut, if using the fast path
+        self.tracer = tracer_for(lt.TRACE_FILE)
+        self.phase = 'login'
+        self.question = None
+
+    async def open(self, url, data=None, parse=True):
+        '''GET the given url, or POST the given data to it if not None.
+           Parse the response, unless parse is False, and return its text.
+        '''
+        method = 'GET' if data is None else 'POST'
+        start = time.time()
+        try:
+            async with self.session.request(method, url, data=data) as response:
+                self.html = await response.text(errors='replace')
+                self.page = PageParser(str(response.url)) if parse else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if self.tracer:
+                self.tracer.span(self.phase, self.student_num, self.question, start, time.time() - start,
+                                 getattr(e, 'status', None), error=repr(e))
+            raise
+        if self.tracer:
+            self.tracer.span(self.phase, self.student_num, self.question, start, time.time() - start,
+                             response.status, len(self.html))
+        if parse:
+            self.page.feed(self.html)
+            self.page.close()
+        return self.html
+
+    async def follow_link(self, text_regex):
+        '''Open the first link on the current page with text matching text_regex'''
+        return await self.open(self.page.find_link(text_regex))
+
+    async def submit(self, form, submit_name=None, parse=True):
+        '''Submit the given form by clicking the named submit button'''
+        data = form.data(submit_name)
+        if form.method == 'POST':
+            return await self.open(form.action, data, parse)
+        else:
+            separator = '&' if '?' in form.action else '?'
+            return await self.open(form.action + separator + urlencode(data), parse=parse)
+
+    async def close(self):
+        await self.session.close()
+
+
+async def login(student):
+    '''Log the given student in to Moodle'''
+    student.phase = 'login'
+    await student.open(lt.SERVER)
+    log_form = student.page.forms[0]
+    log_form.set('username', 'student' + str(student.student_num))
+    log_form.set('password', lt.PASSWORD)
+    await student.submit(log_form)
+
+
+def find_button(form, button):
+    '''Return the name of the form's Check button (if button is 'submit') or
+       Precheck button (if button is 'precheck'), falling back to the Check
+       button if the question has no Precheck. As with mechanize, only
+       submit buttons whose name ends in '-submit' are Check buttons (the Ace
+       editor's maximise buttons are submit buttons too).
+    '''
+    for suffix in [button, 'submit']:
+        buttons = [name for name in form.names('submit') if name.endswith('-' + suffix)]
+        if buttons:
+            return buttons[0]
+    raise IndexError('No Check button on the attempt page')
+
+
+async def prepare_question(student, question, answer=None, button='submit', language=None):
+    '''Navigate to the given question's quiz in the given language (default
+       lt.LANGUAGE), start an attempt and enter the answer (default: a
+       randomised one from quiz_answers). Return the pair (form, name of its
+       Check or Precheck button, as selected by button), ready for
+       submit_check. With FAST_PATH set, a student who has been to the quiz
+       before goes straight to the attempt using a QuizShortcut.
+    '''
+    student_num = student.student_num
+    student.question = question
+    language = language or lt.LANGUAGE
+    if answer is None:
+        answer = lt.randomise(lt.quiz_answers[language][question], language)
+    shortcut = student.shortcuts.get((language, question))
+    if shortcut is not None:
+        lt.debug(student_num, 'Taking shortcut to question {}'.format(question))
+        student.phase = 'start attempt'
+        page_html = await student.submit(shortcut.start_form, parse=False)
+        if shortcut.refresh(page_html):
+            shortcut.attempt_form.set(shortcut.answer_name, answer)
+            return shortcut.attempt_form, find_button(shortcut.attempt_form, button)
+        del student.shortcuts[(language, question)]
+
+    student.phase = 'navigate'
+    if student.page is None:  # Last page wasn't parsed, so start from the site home page
+        await student.open(urljoin(lt.SERVER, '..'))
+    for link in ['Home', 'Site home']:
+        try:
+            await student.follow_link(link)
+        except LinkNotFoundError:
+            pass
+    lt.debug(student_num, 'Following link to ' + lt.COURSE)
+    await student.follow_link(lt.COURSE)
+    question_name = language + '_LoadTesting' + str(question + 1)
+    lt.debug(student_num, 'Following link to {}'.format(question_name))
+    await student.follow_link(question_name)
+    lt.debug(student_num, "Follow link to 'Attempt quiz now' (or 'Re-attempt quiz')")
+    start_form = student.page.forms[0]
+    student.phase = 'start attempt'
+    await student.submit(start_form)
+
+    main_form = student.page.forms[0]
+    textareas = main_form.names('textarea')
+    answer_areas = [name for name in textareas if name.endswith('_answer')] or textareas
+    lt.debug(student_num, 'Entering code into textarea')
+    main_form.set(answer_areas[0], answer)
+    if FAST_PATH:
+        student.shortcuts[(language, question)] = QuizShortcut(start_form, main_form, answer_areas[0])
+    return main_form, find_button(main_form, button)
+
+
+async def submit_check(student, form, submit_name, start=None, kind='correct'):
+    '''Click the Check button of a form set up by prepare_question. Return
+       the pair (time from start until the response arrived, error). If
+       start is not given, it is the time at which the request is sent.
+       If kind is 'failing' (see loadtesting3.choose_answer), the answer is
+       expected to be graded as wrong, so that isn't an error.
+    '''
+    student_num = student.student_num
+    lt.debug(student_num, 'submit code')
+    if start is None:
+        start = time.time()
+    student.phase = 'precheck' if submit_name.endswith('-precheck') else 'check'
+    data = await student.submit(form, submit_name, parse=not FAST_PATH)
+    dt = time.time() - start
+    if 'coderunner-test-results' in data:
+        if 'coderunner-test-results good' in data:
+            lt.debug(student_num, 'Success! Test results returned in %.3f secs' % dt)
+            err = ''
+        elif kind == 'failing':
+            lt.debug(student_num, 'Failed as expected. Test results returned in %.3f secs' % dt)
+            err = ''
+        else:
+            lt.debug(student_num, '***Failed***! Test results returned in %.3f secs' % dt)
+            err = 'Wrong answer'
+    else:
+        err = '****Serious error****'
+    return dt, err
+
+
+async def attempt_question(student, question):
+    '''Navigate to the given question's quiz, start an attempt, enter the answer
+       and click Check. Return the pair (time to get Check response, error).
+    '''
+    form, submit_name = await prepare_question(student, question)
+    return await submit_check(student, form, submit_name)
+
+
+async def loop_doing_questions(student, sim_gap, time_end, result_q):
+    '''As for loadtesting3.loop_doing_questions, except that the student is a
+       VirtualStudent, the loop ends at the absolute time time_end and
+       result_q is an asyncio.Queue. A request that fails outright is
+       recorded as an error for that question and the loop continues.
+    '''
+    lamb = 1.e10 if sim_gap == 0 else 1.0 / sim_gap
+    while time.time() < time_end:
+        for question in range(lt.FIRST_QUESTION, lt.LAST_QUESTION + 1):
+            start = time.time()
+            language = lt.choose_language()
+            answer, cache, kind = lt.choose_answer(question, language)
+            details = {'cache': cache, 'language': language, 'kind': kind}
+            try:
+                form, submit_name = await prepare_question(student, question, answer, language=language)
+                details['nav_secs'] = time.time() - start
+                dt, err = await submit_check(student, form, submit_name, kind=kind)
+                details['check_secs'] = dt
+                if err == '****Serious error****':
+                    details['excerpt'] = error_excerpt(student.html)
+            except (aiohttp.ClientError, asyncio.TimeoutError, LinkNotFoundError, IndexError) as e:
+                dt = time.time() - start
+                err = 'Request failed: {!r}'.format(e)
+
+            result_q.put_nowait((student.student_num, question, dt, err, details))
+
+            if sim_gap != 0:
+                sleep_time = random.expovariate(lamb)
+                max_sleep = time_end - time.time()
+                await asyncio.sleep(max(0, min(max_sleep, sleep_time)))
+
+
+async def quiz_runner(student_num, sim_gap, login_delay, time_end, connector, result_q):
+    '''For the given student number, wait login_delay seconds, log in and
+       cycle through the quiz questions until time_end. Results are written
+       to result_q as for loadtesting3.quiz_runner.
+    '''
+    await asyncio.sleep(login_delay)
+    student = VirtualStudent(student_num, connector)
+    try:
+        print('Student{} logging in ...'.format(student_num))
+        await login(student)
+        print("Student{} logged in.".format(student_num))
+        await loop_doing_questions(student, sim_gap, time_end, result_q)
+    except (aiohttp.ClientError, asyncio.TimeoutError, IndexError, ValueError) as e:
+        message = "OOPS - student{} run broke: {!r}".format(student_num, e)
+        print(message)
+        result_q.put_nowait((student_num, -1, 0, message, {}))
+    finally:
+        await student.close()
+
+
+def make_connector():
+    '''Return the keep-alive connection pool to be shared by all students'''
+    return aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_SECS, ssl=False)
+
+
+async def collect_results(all_done, result_q, recorder, run=None):
+    '''Read and display result tuples from result_q until the all_done
+       future has completed and the queue is empty, recording them in the
+       given LatencyRecorder, which is returned, and in the results store
+       Run run, if given.
+    '''
+    while not (all_done.done() and result_q.empty()):
+        try:
+            (student, question, delta_t, error, details) = await asyncio.wait_for(result_q.get(), timeout=1)
+        except asyncio.TimeoutError:
+            continue
+        print('Student{}, Q{}: dt = {:.2f} {}'.format(student, question, delta_t, 'FAIL' if error else 'OK'))
+        language = details.get('language', lt.LANGUAGE)
+        if error:
+            recorder.record_error(error, question, language, cache=details.get('cache'))
+        else:
+            recorder.record(delta_t, question, language, cache=details.get('cache'))
+        if run is not None:
+            run.record(student, question, language, delta_t, error, details)
+    await all_done
+    print(recorder.num_errors(), ' errors')
+    return recorder
+
+
+async def run_students(num_students, avg_gap, sim_length, run, monitor):
+    '''Coroutine that does the work of simulate_async'''
+    lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+    result_q = asyncio.Queue()
+    connector = make_connector()
+    ramp = min(LOGIN_RAMP_SECS, sim_length)
+    time_end = time.time() + sim_length
+    recorder = LatencyRecorder()
+
+    runners = []
+    for i, student in enumerate(range(lt.START_STUDENT, lt.START_STUDENT + num_students)):
+        login_delay = ramp * i / num_students
+        runners.append(asyncio.ensure_future(quiz_runner(
+            student, avg_gap, login_delay, time_end, connector, result_q)))
+    print('STARTED {} STUDENTS'.format(num_students))
+    await collect_results(asyncio.gather(*runners), result_q, recorder, run)
+
+    await connector.close()
+    if lag_watcher:
+        lag_watcher.cancel()
+    return recorder
+
+
+def simulate_async(num_students, avg_gap, sim_length, run=None, monitor=None):
+    '''Equivalent of loadtesting3.simulate, running all students in this
+       process as coroutines. Returns a LatencyRecorder of the results, which
+       are also recorded in the results store Run run, if given. If a
+       ClientMonitor is given, it also measures the event loop's lag.
+    '''
+    return asyncio.run(run_students(num_students, avg_gap, sim_length, run, monitor))
+
+
+# ===== Open-loop (fixed arrival rate) mode =====
+#
+# In the closed-loop mode above, each student waits for a response before
+# pausing and submitting again, so when the server slows down the offered
+# load drops with it and the worst latencies are never measured (so-called
+# "coordinated omission"). In open-loop mode a scheduler generates Check
+# submissions as a Poisson process at a fixed target rate. Each student
+# prepares its next question (navigation, attempt start, answer entry) and
+# then joins a queue of ready students; at each scheduled send time the
+# next ready student clicks Check. Latency is measured from the scheduled
+# send time, so if no student is ready, or the client falls behind, the
+# delay is charged to the response time rather than silently dropped.
+
+async def open_loop_student(student_num, login_delay, time_end, connector, ready_q, result_q):
+    '''Log the given student in, then repeatedly prepare the next question,
+       wait to be given a scheduled send time via ready_q and submit it.
+    '''
+    await asyncio.sleep(login_delay)
+    student = VirtualStudent(student_num, connector)
+    loop = asyncio.get_running_loop()
+    try:
+        print('Student{} logging in ...'.format(student_num))
+        await login(student)
+        print("Student{} logged in.".format(student_num))
+        question = lt.FIRST_QUESTION
+        while time.time() < time_end:
+            nav_start = time.time()
+            language = lt.choose_language()
+            answer, cache, kind = lt.choose_answer(question, language)
+            try:
+                form, submit_name = await prepare_question(student, question, answer, language=language)
+                details = {'nav_secs': time.time() - nav_start, 'cache': cache, 'language': language, 'kind': kind}
+            except (aiohttp.ClientError, asyncio.TimeoutError, LinkNotFoundError, IndexError) as e:
+                result_q.put_nowait((student_num, question, 0, 'Navigation failed: {!r}'.format(e),
+                                     {'language': language}))
+                await asyncio.sleep(1)  # Don't hammer a server that's failing
+                continue
+            send_time = loop.create_future()
+            await ready_q.put(send_time)
+            scheduled = await send_time
+            if scheduled is None:  # Run over
+                break
+            try:
+                dt, err = await submit_check(student, form, submit_name, start=scheduled, kind=kind)
+                details['check_secs'] = dt
+                if err == '****Serious error****':
+                    details['excerpt'] = error_excerpt(student.html)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                dt = time.time() - scheduled
+                err = 'Request failed: {!r}'.format(e)
+            result_q.put_nowait((student_num, question, dt, err, details))
+            question = question + 1 if question < lt.LAST_QUESTION else lt.FIRST_QUESTION
+    except (aiohttp.ClientError, asyncio.TimeoutError, IndexError, ValueError) as e:
+        message = "OOPS - student{} run broke: {!r}".format(student_num, e)
+        print(message)
+        result_q.put_nowait((student_num, -1, 0, message, {}))
+    finally:
+        await student.close()
+
+
+async def schedule_arrivals(rate_per_sec, time_start, time_end, ready_q, lags):
+    '''Release ready students from ready_q at the times of a Poisson process
+       of the given rate (see arrival_times), from time_start until time_end,
+       by setting each one's send-time future to its scheduled time. The
+       dispatch lag (actual time minus scheduled time) of each send is
+       appended to lags.
+    '''
+    for scheduled in arrival_times(rate_per_sec, time_start, time_end):
+        await asyncio.sleep(max(0, scheduled - time.time()))
+        try:  # May wait for a ready student, but the wait is charged to latency
+            send_time = await asyncio.wait_for(ready_q.get(), timeout=max(0, time_end - time.time()))
+        except asyncio.TimeoutError:
+            break
+        send_time.set_result(scheduled)
+        lags.append(time.time() - scheduled)
+
+
+async def run_open_loop(num_students, rate_per_min, sim_length, window_secs, run, monitor):
+    '''Coroutine that does the work of simulate_open_loop'''
+    lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+    result_q = asyncio.Queue()
+    ready_q = asyncio.Queue()
+    connector = make_connector()
+    ramp = min(LOGIN_RAMP_SECS, sim_length)
+    time_start = time.time() + ramp  # Arrivals start once all students are logged in
+    time_end = time.time() + sim_length
+    recorder = LatencyRecorder(window_secs, start_time=time_start)
+    lags = []
+
+    runners = []
+    for i, student in enumerate(range(lt.START_STUDENT, lt.START_STUDENT + num_students)):
+        login_delay = ramp * i / num_students
+        runners.append(asyncio.ensure_future(open_loop_student(
+            student, login_delay, time_end, connector, ready_q, result_q)))
+    print('STARTED {} STUDENTS'.format(num_students))
+    all_done = asyncio.gather(*runners)
+    collector = asyncio.ensure_future(collect_results(all_done, result_q, recorder, run))
+
+    if callable(rate_per_min):
+        rate_per_sec = lambda elapsed: rate_per_min(elapsed) / 60.0
+    else:
+        rate_per_sec = rate_per_min / 60.0
+    await schedule_arrivals(rate_per_sec, time_start, time_end, ready_q, lags)
+    while not all_done.done():  # Release students still waiting to send
+        try:
+            send_time = await asyncio.wait_for(ready_q.get(), timeout=1)
+            send_time.set_result(None)
+        except asyncio.TimeoutError:
+            pass
+    await collector
+
+    await connector.close()
+    if lag_watcher:
+        lag_watcher.cancel()
+    late = [lag for lag in lags if lag > LATE_SEND_SECS]
+    print('{} of {} submissions sent more than {:.2f} secs late (max lag {:.2f} secs)'.format(
+        len(late), len(lags), LATE_SEND_SECS, max(lags, default=0)))
+    return recorder
+
+
+def simulate_open_loop(num_students, rate_per_min, sim_length, window_secs=WINDOW_SECS, run=None, monitor=None):
+    '''Submit answers at a target Poisson rate of rate_per_min Check
+       submissions per minute for sim_length seconds, using a pool of
+       num_students logged-in students. rate_per_min may also be a function
+       giving the rate at a given number of seconds after arrivals start
+       (which is once all students have logged in). Returns a
+       LatencyRecorder as for simulate_async, with windows of window_secs
+       starting when arrivals start, but with each time measured from the
+       scheduled send time. If the submission rate is more than the pool of
+       students can sustain, latencies grow, as they should. Each result is
+       also recorded in the results store Run run, if given, and the event
+       loop's lag is measured by the ClientMonitor monitor, if given.
+    '''
+    return asyncio.run(run_open_loop(num_students, rate_per_min, sim_length, window_secs, run, monitor))
@@ -0,0 +1,294 @@
+#! /usr/bin/env python3
+
+'''Offline capacity planning for a Jobe pool.
+
+    A discrete-event simulation of the Jobe pool during an exam, to predict
+    how many Jobe workers (concurrent runs, i.e. jobe users summed over all
+    Jobe servers) the exam needs, without a load test at full scale.
+
+    The pool is modelled as a single first-come first-served queue with the
+    given number of workers. Each submission's service time is drawn from
+    the measured times of its language, taken from one or more runs in a
+    results store (see loadtestresults.py): the Check times of a loadtesting3
+    run, or the run times of a loadtestjobe.py run. Use lightly loaded runs,
+    so that the measurements are service times rather than queueing delays.
+    The language of each submission is drawn from the mix given, or by
+    default the mix of the measured runs.
+
+    Submissions arrive as a Poisson process whose rate follows a curve,
+    either
+      * a load profile (JSON, as for loadtestprofiles.py), giving the total
+        rate directly, or
+      * one or more past quiz-attempt downloads (read with quizsubmissions),
+        giving each minute's Precheck and Check submissions per student,
+        which is scaled to the projected cohort size.
+
+    A submission that can't get a worker within MAX_WAIT_SECS (Jobe's
+    jobe_wait_timeout), or that arrives when QUEUE_LIMIT submissions are
+    already waiting (e.g. the web server's worker limit), is rejected: an
+    overload (503 or outcome 21) error. For each number of workers the
+    simulation is repeated with different random seeds, and it reports the
+    mean queue depth (time-averaged) and peak queue depth, the p95 latency
+    (waiting plus service time), the fraction of submissions rejected, the
+    probability that any are rejected during the exam and the workers'
+    utilisation. A minute-by-minute timeline can be given for one size.
+
+        python3 loadtestcapacity.py --runs 3 --downloads exam2024.csv --cohort 800 --workers 8 16 24 32
+        python3 loadtestcapacity.py --runs 3 4 --profile spike.json --mix PYTHON3=60,C=25,JAVA=10,MATLAB=5
+
+    It runs entirely offline, needing only the results store and the
+    downloads or profile.
+'''
+
+import argparse
+import collections
+import heapq
+import math
+import random
+
+from loadtestresults import connect, group_latencies, run_ids_clause, RESULTS_DB
+from loadtestworkload import arrival_times, parse_mix
+
+WORKERS = [4, 8, 16, 32]
+MAX_WAIT_SECS = 10.0     # Jobe's jobe_wait_timeout: a run waiting longer than this is rejected
+QUEUE_LIMIT = None       # Submissions waiting beyond which new ones are rejected at once (None: no limit)
+REPLICATIONS = 10
+BIN_SECS = 60            # Width of the time bins of the arrival curve and timeline
+MAX_SAMPLES = 10000      # Measured service times kept per language
+SERVICE_COLUMN = 'COALESCE(check_secs, latency)'  # The Check time if recorded, else the whole latency
+ACTIONS = ('precheck', 'submit')  # Steps of a download that are submissions
+
+SimResult = collections.namedtuple('SimResult', [
+    'arrivals', 'rejected', 'latencies', 'mean_depth', 'peak_depth', 'busy_secs', 'duration', 'timeline'])
+
+
+def fit_service_times(connection, run_ids, max_samples=MAX_SAMPLES):
+    '''Return the pair (map from language to list of service times, map
+       from language to number of successful submissions) from the given runs
+    '''
+    samples = {language: values for (language, values) in group_latencies(
+        connection, run_ids, 'language', max_samples, SERVICE_COLUMN) if values}
+    counts = dict(connection.execute(
+        "SELECT language, COUNT(*) FROM requests WHERE {} AND status = 'ok' GROUP BY language".format(
+            run_ids_clause(run_ids)), run_ids).fetchall())
+    return samples, {language: counts.get(language, 0) for language in samples}
+
+
+class ArrivalCurve:
+    '''The total submission rate (per second) as a function of time'''
+    def __init__(self, rate_at, duration, description):
+        self.rate_at = rate_at
+        self.duration = duration
+        self.description = description
+
+    @classmethod
+    def from_profile(cls, filename):
+        from loadtestprofiles import LoadProfile
+        profile = LoadProfile.load(filename)
+        return cls(profile.rate_at, profile.duration, 'load profile {}'.format(filename))
+
+    @classmethod
+    def from_downloads(cls, filenames, cohort=None, bin_secs=BIN_SECS):
+        '''The submission rate of the given downloads (aligned to start
+           together), per BIN_SECS bin, scaled from their number of students
+           to cohort (if given)
+        '''
+        from quizsubmissions import read_quiz_attempts
+        counts = collections.Counter()
+        students = 0
+        for filename in filenames:
+            times = []
+            emails = set()
+            for quiz_attempt in read_quiz_attempts(filename):
+                emails.add(quiz_attempt.email)
+                for question_attempt in quiz_attempt.submissions.values():
+                    times.extend(step.time for step in question_attempt.steps if step.action in ACTIONS)
+            if times:
+                first = min(times)
+                counts.update((time - first) // bin_secs for time in times)
+            students += len(emails)
+        if not counts:
+            raise ValueError('No submissions in the downloads')
+        scale = cohort / students if cohort else 1.0
+        rates = [scale * counts.get(i, 0) / bin_secs for i in range(max(counts) + 1)]
+        description = '{} submissions by {} students in {}, scaled to {} students'.format(
+            sum(counts.values()), students, ', '.join(filenames), cohort or students)
+        return cls(lambda elapsed: rates[int(elapsed // bin_secs)] if 0 <= elapsed < len(rates) * bin_secs else 0,
+                   len(rates) * bin_secs, description)
+
+    def arrival_times(self, rng):
+        '''Generate the times of a Poisson process with this rate, following
+           each change of rate exactly (see loadtestworkload.arrival_times),
+           so a burst after quiet bins gets all its arrivals
+
+        >>> curve = ArrivalCurve(lambda elapsed: 0.01 if elapsed < 60 else 5.0, 120, 'quiet then burst')
+        >>> counts = [len(list(curve.arrival_times(random.Random(seed)))) for seed in range(200)]
+        >>> 290 < sum(counts) / len(counts) < 311  # 0.6 + 300 expected
+        True
+        '''
+        return arrival_times(self.rate_at, 0.0, self.duration, rng)
+
+
+def simulate(curve, workers, service_times, mix, rng, max_wait=MAX_WAIT_SECS, queue_limit=QUEUE_LIMIT,
+             bin_secs=BIN_SECS):
+    '''Simulate one exam with the given number of workers. Returns a
+       SimResult, whose timeline is a list, per bin, of (arrivals, rejected,
+       time-averaged queue depth, list of latencies).
+    '''
+    languages = sorted(mix)
+    weights = [mix[language] for language in languages]
+    free_at = [0.0] * workers   # Heap of the times at which each worker is next free
+    waiting = []                # Heap of the times at which queued submissions stop waiting
+    latencies = []
+    arrivals = rejected = peak_depth = 0
+    busy_secs = 0.0
+    num_bins = int(math.ceil(curve.duration / bin_secs)) + 1
+    timeline = [[0, 0, 0.0, []] for _ in range(num_bins)]
+    last_time = 0.0
+
+    def add_waiting(start, end):
+        '''Add a submission's waiting interval to the timeline's queue depths'''
+        while start < end:
+            index = int(start // bin_secs)
+            bin_end = (index + 1) * bin_secs
+            if index < num_bins:
+                timeline[index][2] += (min(end, bin_end) - start) / bin_secs
+            start = bin_end
+
+    for arrival in curve.arrival_times(rng):
+        arrivals += 1
+        last_time = arrival
+        bin_stats = timeline[int(arrival // bin_secs)]
+        bin_stats[0] += 1
+        while waiting and waiting[0] <= arrival:
+            heapq.heappop(waiting)
+        if queue_limit is not None and len(waiting) >= queue_limit:
+            rejected += 1
+            bin_stats[1] += 1
+            continue
+        start = max(arrival, free_at[0])
+        if start - arrival > max_wait:  # Gives up without taking a worker
+            rejected += 1
+            bin_stats[1] += 1
+            add_waiting(arrival, arrival + max_wait)
+            heapq.heappush(waiting, arrival + max_wait)
+        else:
+            service = rng.choice(service_times[rng.choices(languages, weights)[0]])
+            heapq.heapreplace(free_at, start + service)
+            busy_secs += max(0.0, min(start + service, curve.duration) - start)  # Within the simulation
+            latencies.append(start + service - arrival)
+            bin_stats[3].append(start + service - arrival)
+            if start > arrival:
+                add_waiting(arrival, start)
+                heapq.heappush(waiting, start)
+        peak_depth = max(peak_depth, len(waiting))
+    duration = max(curve.duration, last_time)
+    mean_depth = sum(stats[2] for stats in timeline) * bin_secs / duration if duration else 0
+    return SimResult(arrivals, rejected, latencies, mean_depth, peak_depth, busy_secs, duration, timeline)
+
+
+def percentile(sorted_values, percent):
+    '''Return the given percentile of a sorted list (nearest rank), or None if empty'''
+    if not sorted_values:
+        return None
+    return sorted_values[max(1, int(math.ceil(percent / 100.0 * len(sorted_values)))) - 1]
+
+
+def format_secs(secs):
+    return '{:.2f}'.format(secs) if secs is not None else '-'
+
+
+def print_predictions(curve, worker_counts, service_times, mix, replications=REPLICATIONS,
+                      max_wait=MAX_WAIT_SECS, queue_limit=QUEUE_LIMIT, seed=1):
+    '''Simulate each number of workers replications times and print a table
+       of the predictions. Returns a map from number of workers to the list
+       of SimResults.
+    '''
+    print('{:>8} {:>10} {:>10} {:>10} {:>9} {:>9} {:>10} {:>6}'.format(
+        'workers', 'mean queue', 'peak queue', 'p95 secs', 'p99 secs', 'rejected', 'P(any 503)', 'util'))
+    results = {}
+    for workers in worker_counts:
+        rng = random.Random(seed)
+        runs = [simulate(curve, workers, service_times, mix, rng, max_wait, queue_limit)
+                for _ in range(replications)]
+        results[workers] = runs
+        latencies = sorted(latency for run in runs for latency in run.latencies)
+        arrivals = sum(run.arrivals for run in runs)
+        rejected = sum(run.rejected for run in runs)
+        print('{:>8} {:>10.1f} {:>10.1f} {:>10} {:>9} {:>8.2f}% {:>9.0f}% {:>5.0f}%'.format(
+            workers, sum(run.mean_depth for run in runs) / replications,
+            sum(run.peak_depth for run in runs) / replications,
+            format_secs(percentile(latencies, 95)), format_secs(percentile(latencies, 99)),
+            100.0 * rejected / arrivals if arrivals else 0,
+            100.0 * sum(1 for run in runs if run.rejected) / replications,
+            100.0 * sum(run.busy_secs for run in runs) / sum(workers * run.duration for run in runs)))
+    print()
+    return results
+
+
+def print_timeline(curve, workers, runs, bin_secs=BIN_SECS):
+    '''Print a bin-by-bin timeline of the given runs, averaged over them'''
+    print('Timeline with {} workers (mean of {} runs)'.format(workers, len(runs)))
+    print('{:>8} {:>10} {:>10} {:>10} {:>9}'.format('start', 'offered/s', 'queue', 'p95 secs', 'rejected'))
+    for index in range(len(runs[0].timeline)):
+        arrivals = sum(run.timeline[index][0] for run in runs)
+        if arrivals == 0 and index * bin_secs >= curve.duration:
+            continue
+        latencies = sorted(latency for run in runs for latency in run.timeline[index][3])
+        print('{:>7}s {:>10.2f} {:>10.1f} {:>10} {:>8.1f}%'.format(
+            index * bin_secs, arrivals / len(runs) / bin_secs,
+            sum(run.timeline[index][2] for run in runs) / len(runs),
+            format_secs(percentile(latencies, 95)),
+            100.0 * sum(run.timeline[index][1] for run in runs) / arrivals if arrivals else 0))
+    print()
+
+
+def print_service_times(service_times, mix):
+    print('{:>10} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('language', 'mix %', 'samples', 'mean', 'p50', 'p95'))
+    total_weight = sum(mix.values())
+    for language in sorted(mix):
+        values = sorted(service_times[language])
+        print('{:>10} {:>8.1f} {:>8} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+            language, 100.0 * mix[language] / total_weight, len(values), sum(values) / len(values),
+            percentile(values, 50), percentile(values, 95)))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict Jobe pool queueing for an exam by simulation')
+    parser.add_argument('--db', default=RESULTS_DB, help='Results store holding the measured runs')
+    parser.add_argument('--runs', type=int, nargs='+', required=True, help='Runs from which to fit service times')
+    curve_source = parser.add_mutually_exclusive_group(required=True)
+    curve_source.add_argument('--downloads', nargs='+', help='Quiz attempt downloads giving the submission curve')
+    curve_source.add_argument('--profile', help='Load profile (JSON) giving the submission rate')
+    parser.add_argument('--cohort', type=int, default=None, help='Projected number of students (with --downloads)')
+    parser.add_argument('--mix', default=None, help='Language mix, e.g. PYTHON3=60,C=40 (default: as measured)')
+    parser.add_argument('--workers', type=int, nargs='+', default=WORKERS, help='Numbers of Jobe workers to try')
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT_SECS, help='Secs before a waiting run is rejected')
+    parser.add_argument('--queue-limit', type=int, default=QUEUE_LIMIT, help='Waiting submissions before rejection')
+    parser.add_argument('--replications', type=int, default=REPLICATIONS)
+    parser.add_argument('--timeline', type=int, default=None, help='Print the timeline for this number of workers')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    service_times, counts = fit_service_times(connect(args.db), args.runs)
+    mix = parse_mix(args.mix) if args.mix else counts
+    missing = [language for language in mix if language not in service_times]
+    if missing:
+        parser.error('No measured service times for {} in runs {}'.format(', '.join(missing), args.runs))
+    if args.profile:
+        curve = ArrivalCurve.from_profile(args.profile)
+    else:
+        curve = ArrivalCurve.from_downloads(args.downloads, args.cohort)
+    print('Arrivals: {} over {:.0f} mins'.format(curve.description, curve.duration / 60))
+    print('Service times (secs) from runs {}:'.format(', '.join(str(run_id) for run_id in args.runs)))
+    print_service_times(service_times, mix)
+    worker_counts = sorted(set(args.workers + ([args.timeline] if args.timeline else [])))
+    results = print_predictions(curve, worker_counts, service_times, mix, args.replications,
+                                args.max_wait, args.queue_limit, args.seed)
+    if args.timeline:
+        print_timeline(curve, args.timeline, results[args.timeline])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''Statistical comparison of two load-test runs in a results store.
+
+    Compares a candidate run with a baseline run (e.g. before and after a
+    CodeRunner upgrade or a Jobe change), overall and per question or
+    language. For each group it reports the latency percentiles of the
+    two runs with the change in each and a bootstrap confidence interval
+    for the change, a Mann-Whitney U test of whether the candidate's
+    latencies are distributed differently at all, and the change in
+    throughput (successful requests per second) with a test of the
+    difference between two Poisson rates.
+
+    Used through loadtestresults.py:
+
+        python3 loadtestresults.py compare 3 7 --by language --max-p95-increase 10
+
+    The exit status is 1 if the overall p95 latency rose, or the overall
+    throughput fell, by more than the given percentage AND the change is
+    significant (its confidence interval excludes zero), so that it can
+    gate an upgrade; otherwise 0. Groups whose changes are beyond the
+    thresholds are marked in the report but don't affect the exit status.
+
+    Latencies are sampled from the store (at most max_values per run and
+    group) so that comparisons of long runs still fit in memory.
+'''
+
+import math
+import random
+
+from loadtestresults import group_latencies
+
+COMPARED_PERCENTILES = [50, 90, 95, 99]
+BOOTSTRAP_SAMPLES = 1000
+CONFIDENCE = 0.95
+MAX_VALUES = 5000            # Latencies sampled per run and group
+MAX_P95_INCREASE = 10.0      # Percent
+MAX_THROUGHPUT_DECREASE = 10.0  # Percent
+
+
+def percentile(sorted_values, percent):
+    '''Return the given percentile of a sorted list (nearest rank)'''
+    rank = max(1, int(math.ceil(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def bootstrap_changes(baseline, candidate, percents, rng, samples=BOOTSTRAP_SAMPLES, confidence=CONFIDENCE):
+    '''Return a map from each of the given percentiles to a (low, high)
+       confidence interval for its relative change (candidate / baseline -
+       1), found by resampling both lists of latencies with replacement
+    '''
+    changes = {percent: [] for percent in percents}
+    for _ in range(samples):
+        base_sorted = sorted(rng.choices(baseline, k=len(baseline)))
+        cand_sorted = sorted(rng.choices(candidate, k=len(candidate)))
+        for percent in percents:
+            base = percentile(base_sorted, percent)
+            if base > 0:
+                changes[percent].append(percentile(cand_sorted, percent) / base - 1)
+    tail = (1 - confidence) / 2
+    intervals = {}
+    for percent, values in changes.items():
+        values.sort()
+        if values:
+            intervals[percent] = (values[int(tail * len(values))],
+                                  values[min(len(values) - 1, int((1 - tail) * len(values)))])
+        else:
+            intervals[percent] = (None, None)
+    return intervals
+
+
+def normal_p_value(z):
+    '''Two-sided p-value of a standard normal z statistic'''
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def mann_whitney(baseline, candidate):
+    '''Return the two-sided p-value of the Mann-Whitney U test (normal
+       approximation, with tie correction) that the two samples come from
+       the same distribution
+    '''
+    n1, n2 = len(baseline), len(candidate)
+    if n1 == 0 or n2 == 0:
+        return None
+    values = sorted([(value, 0) for value in baseline] + [(value, 1) for value in candidate])
+    n = n1 + n2
+    rank_sum = 0.0
+    tie_term = 0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        average_rank = (i + j) / 2.0 + 1
+        ties = j - i + 1
+        tie_term += ties ** 3 - ties
+        rank_sum += average_rank * sum(1 for k in range(i, j + 1) if values[k][1] == 0)
+        i = j + 1
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_term / (n * (n - 1.0))) if n > 1 else 0
+    if variance <= 0:
+        return 1.0
+    return normal_p_value((u - n1 * n2 / 2.0) / math.sqrt(variance))
+
+
+def poisson_rate_p_value(count1, secs1, count2, secs2):
+    '''Two-sided p-value of the difference between two Poisson rates'''
+    if count1 + count2 == 0 or not secs1 or not secs2:
+        return None
+    se = math.sqrt(count1 / secs1 ** 2 + count2 / secs2 ** 2)
+    return normal_p_value((count2 / secs2 - count1 / secs1) / se) if se > 0 else 1.0
+
+
+def run_duration(connection, run_id):
+    started, finished = connection.execute('SELECT started, finished FROM runs WHERE id = ?', (run_id,)).fetchone()
+    if finished is None:  # Run didn't finish cleanly, so use its last request
+        finished = connection.execute('SELECT MAX(time) FROM requests WHERE run_id = ?', (run_id,)).fetchone()[0]
+    return (finished or started) - started
+
+
+def ok_counts(connection, run_id, group_by):
+    '''Return a map from group to count of successful requests in a run'''
+    column = group_by or "'all'"
+    return dict(connection.execute(
+        "SELECT {0}, COUNT(*) FROM requests WHERE run_id = ? AND status = 'ok' GROUP BY {0}".format(column),
+        (run_id,)).fetchall())
+
+
+def format_change(change):
+    return '{:+.1f}%'.format(100 * change) if change is not None else '-'
+
+
+def compare_group(label, baseline, candidate, throughputs, rng, max_p95_increase, max_throughput_decrease):
+    '''Print the comparison of one group and return a list of its
+       regressions beyond the thresholds (as descriptive strings)
+    '''
+    (base_count, base_secs), (cand_count, cand_secs) = throughputs
+    regressions = []
+    print('{}: {} vs {} latencies sampled, Mann-Whitney p = {}'.format(
+        label, len(baseline), len(candidate),
+        '{:.4f}'.format(mann_whitney(baseline, candidate)) if baseline and candidate else '-'))
+    print('{:>10} {:>10} {:>10} {:>9} {:>20}'.format('', 'baseline', 'candidate', 'change',
+                                                      '{:.0f}% CI'.format(100 * CONFIDENCE)))
+    if baseline and candidate:
+        base_sorted, cand_sorted = sorted(baseline), sorted(candidate)
+        intervals = bootstrap_changes(baseline, candidate, COMPARED_PERCENTILES, rng)
+        for percent in COMPARED_PERCENTILES:
+            base, cand = percentile(base_sorted, percent), percentile(cand_sorted, percent)
+            change = cand / base - 1 if base > 0 else None
+            low, high = intervals[percent]
+            flag = ''
+            if percent == 95 and change is not None and change * 100 > max_p95_increase and low is not None and low > 0:
+                flag = '  <== REGRESSION'
+                regressions.append('p95 latency {} (threshold +{:g}%)'.format(format_change(change), max_p95_increase))
+            print('{:>10} {:>10.3f} {:>10.3f} {:>9} {:>20}{}'.format(
+                'p{}'.format(percent), base, cand, format_change(change),
+                '[{}, {}]'.format(format_change(low), format_change(high)) if low is not None else '-', flag))
+    base_rate = base_count / base_secs if base_secs else 0
+    cand_rate = cand_count / cand_secs if cand_secs else 0
+    change = cand_rate / base_rate - 1 if base_rate > 0 else None
+    p_value = poisson_rate_p_value(base_count, base_secs, cand_count, cand_secs)
+    flag = ''
+    if (change is not None and -change * 100 > max_throughput_decrease and
+            p_value is not None and p_value < 1 - CONFIDENCE):
+        flag = '  <== REGRESSION'
+        regressions.append('throughput {} (threshold -{:g}%)'.format(format_change(change), max_throughput_decrease))
+    print('{:>10} {:>10.2f} {:>10.2f} {:>9} {:>20}{}'.format(
+        'ok/sec', base_rate, cand_rate, format_change(change),
+        'p = {:.4f}'.format(p_value) if p_value is not None else '-', flag))
+    print()
+    return regressions
+
+
+def compare_runs(connection, baseline_id, candidate_id, group_by=None, max_p95_increase=MAX_P95_INCREASE,
+                 max_throughput_decrease=MAX_THROUGHPUT_DECREASE, max_values=MAX_VALUES, seed=1):
+    '''Print a comparison of the candidate run with the baseline run,
+       overall and by group_by (a requests column) if given. Returns 1 if
+       the overall p95 latency or throughput regressed significantly beyond
+       the thresholds (in percent), else 0.
+    '''
+    rng = random.Random(seed)
+    secs = [run_duration(connection, run_id) for run_id in (baseline_id, candidate_id)]
+    print('Baseline run {} ({:.0f} secs), candidate run {} ({:.0f} secs)'.format(
+        baseline_id, secs[0], candidate_id, secs[1]))
+    print()
+    status = 0
+    for column in [None] + ([group_by] if group_by else []):
+        base_groups = dict(group_latencies(connection, [baseline_id], column, max_values))
+        cand_groups = dict(group_latencies(connection, [candidate_id], column, max_values))
+        base_counts, cand_counts = ok_counts(connection, baseline_id, column), ok_counts(connection, candidate_id, column)
+        for key in sorted(set(base_groups) | set(cand_groups), key=str):
+            label = 'all' if column is None else '{} {}'.format(column, key)
+            regressions = compare_group(
+                label, base_groups.get(key, []), cand_groups.get(key, []),
+                [(base_counts.get(key, 0), secs[0]), (cand_counts.get(key, 0), secs[1])],
+                rng, max_p95_increase, max_throughput_decrease)
+            if column is None and regressions:
+                print('*** REGRESSION: ' + '; '.join(regressions))
+                print()
+                status = 1
+    return status
@@ -0,0 +1,352 @@
+#! /usr/bin/env python3
+
+'''Distributed load generation for the CodeRunner load tester.
+
+    One client machine can't generate enough load to saturate a large
+    Moodle + Jobe cluster, so this runs the load tester of loadtesting3.py
+    on several worker machines under the control of a coordinator.
+
+    The coordinator listens on a TCP port and waits for the given number of
+    workers to connect. It then splits the students START_STUDENT ..
+    START_STUDENT + NUM_STUDENTS - 1 into contiguous ranges, one per worker
+    (and, in open-loop mode, the target submission rate in proportion), and
+    sends each worker its range, the run settings and a shared start time a
+    few seconds ahead. Workers' clocks are assumed to be synchronised (NTP).
+
+    Each worker runs the configured engine (ENGINE and ARRIVAL_MODE in
+    loadtesting3.py) over its range of students, and every REPORT_SECS
+    sends the coordinator a LatencyRecorder (see loadtesthistogram.py) of
+    the results since its last report, plus counters. The coordinator
+    merges these as they arrive, printing progress, and at the end prints a
+    single report for the whole run and saves the merged histograms.
+
+    The protocol is newline-delimited JSON messages over a TCP connection:
+    worker -> coordinator 'hello', coordinator -> worker 'assign', then
+    worker -> coordinator 'results' (repeated) and 'done'. Each worker
+    monitors its own resource use (see loadtestmonitor.py) and its 'done'
+    message lists the windows in which it was saturated, which the
+    coordinator reports, since those windows' merged latencies are suspect.
+
+        python3 loadtestdistributed.py coordinator --workers 4 --port 5555
+        python3 loadtestdistributed.py worker --coordinator controlhost:5555
+
+    To try it out on one machine, 'local' starts a coordinator and the
+    given number of worker processes:
+
+        python3 loadtestdistributed.py local --workers 4
+'''
+
+import argparse
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import loadtesting3 as lt
+from loadtesthistogram import LatencyRecorder, WINDOW_SECS
+from loadtestresults import ResultsStore
+from loadtestmonitor import ClientMonitor
+
+COORDINATOR_PORT = 5555
+START_DELAY_SECS = 5        # Workers start this long after the last one connects
+REPORT_SECS = 5             # Workers report their results this often
+CONNECT_TIMEOUT_SECS = 300  # The coordinator waits this long for all workers to connect
+
+
+def send_message(stream, message):
+    '''Write the given message dictionary to a socket stream as a JSON line'''
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+
+def receive_message(stream):
+    '''Read a message dictionary from a socket stream, or None at end of file'''
+    line = stream.readline()
+    return json.loads(line) if line else None
+
+
+def split_students(start_student, num_students, num_workers):
+    '''Return a list of num_workers (start student, number of students)
+       pairs dividing the given range of students as evenly as possible
+    '''
+    ranges = []
+    for i in range(num_workers):
+        count = num_students // num_workers + (1 if i < num_students % num_workers else 0)
+        ranges.append((start_student, count))
+        start_student += count
+    return ranges
+
+
+def recorder_start_time(assignment):
+    '''The start of the first window of the run's LatencyRecorders which,
+       as for the single-machine engines, is when arrivals start in
+       open-loop mode and when the run starts otherwise
+    '''
+    if assignment['arrival_mode'] == 'open':
+        from loadtestasync import LOGIN_RAMP_SECS
+        return assignment['start_time'] + min(LOGIN_RAMP_SECS, assignment['duration'])
+    return assignment['start_time']
+
+
+# ===== Worker =====
+
+class StreamingRun:
+    '''Stands in for a results store Run (see loadtestresults.py) in a
+       worker: the engines record each result here, and it is accumulated
+       into a LatencyRecorder which send() ships to the coordinator and
+       replaces with an empty one. Results are also passed on to
+       local_run, if given.
+    '''
+    def __init__(self, stream, start_time, window_secs, local_run=None):
+        self.stream = stream
+        self.start_time = start_time
+        self.window_secs = window_secs
+        self.local_run = local_run
+        self.lock = threading.Lock()
+        self.recorder = LatencyRecorder(window_secs, start_time)
+        self.ok = 0
+        self.errors = 0
+
+    def record(self, student=None, question=None, language=None, latency=None, error='',
+               details=None, when=None):
+        cache = (details or {}).get('cache')
+        with self.lock:
+            if error:
+                self.recorder.record_error(error, question, language, when, cache)
+                self.errors += 1
+            else:
+                self.recorder.record(latency, question, language, when, cache)
+                self.ok += 1
+        if self.local_run is not None:
+            self.local_run.record(student, question, language, latency, error, details, when)
+
+    def send(self):
+        '''Send the results recorded since the last send to the coordinator'''
+        with self.lock:
+            recorder = self.recorder
+            self.recorder = LatencyRecorder(self.window_secs, self.start_time)
+            counters = {'ok': self.ok, 'errors': self.errors}
+        send_message(self.stream, {'type': 'results', 'recorder': recorder.to_dict(), 'counters': counters})
+
+
+def report_periodically(run, stopping):
+    '''Worker thread: send results every REPORT_SECS until stopping is set'''
+    while not stopping.wait(REPORT_SECS):
+        run.send()
+
+
+def run_assignment(assignment, run, monitor):
+    '''Run the given assignment from the coordinator, recording results in
+       run and monitoring the worker with the given ClientMonitor'''
+    lt.START_STUDENT = assignment['start_student']
+    lt.NUM_STUDENTS = assignment['num_students']
+    lt.sole_submitter = assignment.get('num_workers', 1) == 1
+    num_students = assignment['num_students']
+    if assignment['arrival_mode'] == 'open':
+        from loadtestasync import simulate_open_loop
+        simulate_open_loop(num_students, assignment['rate_per_min'], assignment['duration'],
+                           assignment['window_secs'], run=run, monitor=monitor)
+    elif assignment['engine'] == 'asyncio':
+        from loadtestasync import simulate_async
+        simulate_async(num_students, assignment['gap_secs'], assignment['duration'], run, monitor)
+    else:
+        lt.simulate(num_students, assignment['gap_secs'], assignment['duration'], run)
+
+
+def worker(coordinator, db=None):
+    '''Connect to the coordinator at host:port, wait for an assignment and
+       run it, streaming results back. If db is given, every request is also
+       recorded in that local results store.
+    '''
+    host, port = coordinator.rsplit(':', 1)
+    connection = socket.create_connection((host, int(port)))
+    stream = connection.makefile('rw')
+    send_message(stream, {'type': 'hello', 'host': socket.gethostname(), 'pid': os.getpid()})
+    assignment = receive_message(stream)
+    if assignment is None or assignment['type'] != 'assign':
+        print('Coordinator closed the connection without an assignment')
+        return
+    if assignment['num_students'] == 0:
+        send_message(stream, {'type': 'done'})
+        return
+    print('Worker {}: students {} .. {}, starting in {:.1f} secs'.format(
+        os.getpid(), assignment['start_student'],
+        assignment['start_student'] + assignment['num_students'] - 1, assignment['start_time'] - time.time()))
+
+    store = local_run = None
+    if db:
+        store = ResultsStore(db)
+        local_run = store.start_run('loadtestdistributed.py', 'worker {}'.format(os.getpid()), assignment)
+    run = StreamingRun(stream, recorder_start_time(assignment), assignment['window_secs'], local_run)
+    time.sleep(max(0, assignment['start_time'] - time.time()))
+    stopping = threading.Event()
+    reporter = threading.Thread(target=report_periodically, args=(run, stopping))
+    reporter.start()
+    monitor = ClientMonitor().start()
+    try:
+        run_assignment(assignment, run, monitor)
+    finally:
+        monitor.stop()
+        stopping.set()
+        reporter.join()
+        run.send()
+        windows = LatencyRecorder(assignment['window_secs'], run.start_time)
+        send_message(stream, {'type': 'done', 'saturated_windows': monitor.saturated_windows(windows)})
+        connection.close()
+        if store is not None:
+            local_run.finish()
+            store.close()
+
+
+# ===== Coordinator =====
+
+def read_worker(worker_num, stream, messages):
+    '''Thread: put each message from the given worker on the messages
+       queue as a (worker_num, message) pair, ending with None at EOF
+    '''
+    try:
+        while True:
+            message = receive_message(stream)
+            messages.put((worker_num, message))
+            if message is None or message['type'] == 'done':
+                return
+    except (OSError, ValueError):
+        messages.put((worker_num, None))
+
+
+def accept_workers(listener, num_workers):
+    '''Return a list of (stream, hello message) pairs for the first
+       num_workers workers to connect to the given listening socket
+    '''
+    workers = []
+    listener.settimeout(CONNECT_TIMEOUT_SECS)
+    while len(workers) < num_workers:
+        connection, address = listener.accept()
+        stream = connection.makefile('rw')
+        hello = receive_message(stream)
+        if hello is None or hello.get('type') != 'hello':
+            connection.close()
+            continue
+        workers.append((stream, hello))
+        print('Worker {} of {} connected: {} pid {}'.format(len(workers), num_workers, hello['host'], hello['pid']))
+    return workers
+
+
+def coordinate(listener, num_workers, num_students=lt.NUM_STUDENTS, duration=lt.SIMULATION_DURATION_SECS,
+               rate_per_min=lt.TARGET_SUBMISSIONS_PER_MIN, window_secs=WINDOW_SECS):
+    '''Wait for num_workers workers to connect to the listening socket,
+       assign them their students and merge the results they send. Returns
+       a triple (merged LatencyRecorder, list of per-worker counters, the
+       time the workers started).
+    '''
+    workers = accept_workers(listener, num_workers)
+    start_time = time.time() + START_DELAY_SECS
+    base = {
+        'type': 'assign', 'start_time': start_time, 'duration': duration, 'window_secs': window_secs,
+        'engine': lt.ENGINE, 'arrival_mode': lt.ARRIVAL_MODE, 'gap_secs': lt.INTER_SUBMISSION_GAP_SECS,
+        'num_workers': num_workers
+    }
+    merged = LatencyRecorder(window_secs, recorder_start_time(base))
+    messages = queue.Queue()
+    counters = []
+    for worker_num, ((stream, hello), (start_student, count)) in enumerate(
+            zip(workers, split_students(lt.START_STUDENT, num_students, num_workers))):
+        assignment = dict(base, start_student=start_student, num_students=count,
+                          rate_per_min=rate_per_min * count / num_students)
+        send_message(stream, assignment)
+        counters.append({'host': hello['host'], 'pid': hello['pid'], 'students': count, 'ok': 0, 'errors': 0})
+        threading.Thread(target=read_worker, args=(worker_num, stream, messages), daemon=True).start()
+
+    running = num_workers
+    last_progress = time.time()
+    while running:
+        try:
+            worker_num, message = messages.get(timeout=REPORT_SECS)
+        except queue.Empty:
+            message = {'type': 'idle'}
+            worker_num = None
+        if message is None:
+            print('*** Lost connection to worker {}'.format(worker_num))
+            running -= 1
+        elif message['type'] == 'results':
+            merged.merge(LatencyRecorder.from_dict(message['recorder']))
+            counters[worker_num].update(message['counters'])
+        elif message['type'] == 'done':
+            running -= 1
+            counters[worker_num]['saturated'] = message.get('saturated_windows', [])
+        if time.time() - last_progress >= REPORT_SECS:
+            last_progress = time.time()
+            print('{:.0f}s: {} ok, {} errors from {} workers ({} still running)'.format(
+                time.time() - start_time, sum(c['ok'] for c in counters),
+                sum(c['errors'] for c in counters), num_workers, running))
+    return merged, counters, start_time
+
+
+def print_workers(counters, window_secs=WINDOW_SECS):
+    '''Print each worker's share of the run and the windows in which it was saturated'''
+    print('{:>20} {:>8} {:>9} {:>8} {:>7}  {}'.format('host', 'pid', 'students', 'ok', 'errors', 'saturated'))
+    for c in counters:
+        saturated = ', '.join('{}s'.format(window * window_secs) for window in c.get('saturated', []))
+        print('{:>20} {:>8} {:>9} {:>8} {:>7}  {}'.format(
+            c['host'], c['pid'], c['students'], c['ok'], c['errors'], saturated or '-'))
+    print()
+    if any(c.get('saturated') for c in counters):
+        print('*** WARNING: some workers were saturated; latencies in those windows measure the client.')
+        print()
+
+
+def listen(port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen()
+    return listener
+
+
+def run_coordinator(listener, args):
+    recorder, counters, start_time = coordinate(listener, args.workers, args.students, args.duration, args.rate)
+    print_workers(counters)
+    lt.print_summary(recorder, time.time() - start_time)
+    recorder.save(args.save)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed CodeRunner load testing')
+    commands = parser.add_subparsers(dest='command')
+    for name in ['coordinator', 'local']:
+        command = commands.add_parser(name)
+        command.add_argument('--workers', type=int, required=True)
+        command.add_argument('--port', type=int, default=COORDINATOR_PORT)
+        command.add_argument('--students', type=int, default=lt.NUM_STUDENTS)
+        command.add_argument('--duration', type=float, default=lt.SIMULATION_DURATION_SECS)
+        command.add_argument('--rate', type=float, default=lt.TARGET_SUBMISSIONS_PER_MIN,
+                             help='Total target submissions per minute, in open-loop mode')
+        command.add_argument('--save', default=lt.HISTOGRAM_FILE, help='File for the merged histograms')
+    command = commands.add_parser('worker')
+    command.add_argument('--coordinator', default='localhost:{}'.format(COORDINATOR_PORT), help='host:port')
+    command.add_argument('--db', default=None, help='Also record every request in this local results store')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        worker(args.coordinator, args.db)
+    elif args.command in ('coordinator', 'local'):
+        listener = listen(args.port)
+        workers = []
+        if args.command == 'local':
+            workers = [subprocess.Popen([sys.executable, __file__, 'worker', '--coordinator',
+                                         'localhost:{}'.format(args.port)]) for _ in range(args.workers)]
+        try:
+            run_coordinator(listener, args)
+        finally:
+            for process in workers:
+                process.wait()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
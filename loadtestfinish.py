@@ -0,0 +1,338 @@
+#! /usr/bin/env python3
+
+'''End-of-exam "finish attempt" load test for CodeRunner.
+
+    At the end of a timed exam most students click "Finish attempt ..."
+    and then "Submit all and finish" within a minute or so of each other.
+    Every answer that hasn't yet been checked is graded during that final
+    submission, so all of those answers hit Jobe at once: a thundering herd
+    that the steady Check loop of loadtesting3.py never produces.
+
+    This scenario reproduces it in two phases:
+
+      * Build: each virtual student logs in (spread over BUILD_RAMP_SECS),
+        starts an attempt at one of the load-testing quizzes and types a
+        (randomised) answer, but doesn't check or save it. Students are
+        assigned to quizzes round robin. Each student holds just one
+        attempt, because Moodle handles one request at a time per session.
+      * Release: once every attempt is built, each student finishes at a
+        time chosen uniformly at random within FINISH_WINDOW_SECS. Finishing
+        is two requests, as in a browser: the attempt page's "Finish attempt
+        ..." button (saving the answer and loading the summary page) and the
+        summary page's "Submit all and finish" button (grading the answer).
+
+    Finish latency is measured from each student's scheduled release time
+    to the final response, so delays in the client are charged to the
+    server as in the open-loop mode of loadtestasync.py. A finish succeeds
+    if Moodle ends on the attempt's review page (or the quiz view page, if
+    review isn't allowed immediately after the attempt).
+
+    Moodle grades the answers within the "Submit all and finish" request,
+    so when the last finish has returned, Moodle's share of the Jobe queue
+    has drained. If the Jobe server is given (--jobe), a small probe run is
+    also submitted to it every PROBE_SECS throughout the test; the Jobe
+    queue is taken to have drained when the probe latency falls back to
+    within DRAIN_FACTOR of its value before the release, and stays there.
+    That includes any load on Jobe from elsewhere, e.g. other Moodle servers.
+
+    Server, course, workload mix, answers and students are taken from
+    loadtesting3.py; results are recorded as for the other load testers.
+
+        python3 loadtestfinish.py --attempts 300 --window 30 --jobe jobe1.example.com
+
+    Requires aiohttp (pip3 install aiohttp).
+'''
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import aiohttp
+
+import loadtesting3 as lt
+from loadtestasync import VirtualStudent, LinkNotFoundError, login, prepare_question, make_connector
+from loadtesthistogram import LatencyRecorder
+from loadtestresults import ResultsStore, RESULTS_DB, error_excerpt
+from loadtesttrace import start_trace, finish_trace
+from loadtestmonitor import ClientMonitor
+
+NUM_ATTEMPTS = lt.NUM_STUDENTS
+FINISH_WINDOW_SECS = 30      # All finishes are released uniformly at random within this time
+BUILD_RAMP_SECS = 60         # Student logins (and attempt builds) are spread uniformly over this time
+RELEASE_DELAY_SECS = 5       # Pause between the last attempt being built and the first release
+REPORT_WINDOW_SECS = 5       # Width of the time windows in the latency report
+JOBE_SERVER = None           # Jobe host[:port] or URL to probe for queue drain time, if any
+PROBE_SECS = 1               # Interval between Jobe probe runs
+DRAIN_FACTOR = 2             # The queue has drained when probe latency is within this factor of the baseline
+DRAIN_TIMEOUT_SECS = 300     # Give up waiting for the Jobe queue to drain after this long
+
+FINISHED_PAGES = ('/mod/quiz/review.php', '/mod/quiz/view.php')
+
+
+async def build_attempt(student, question, login_delay):
+    '''Log the student in after login_delay secs and start an attempt at the
+       given question's quiz, in a language chosen from the workload mix,
+       leaving a fresh answer typed in but unsaved. Returns the pair
+       (attempt form, language).
+    '''
+    await asyncio.sleep(login_delay)
+    await login(student)
+    language = lt.choose_language()
+    answer = lt.randomise(lt.quiz_answers[language][question], language)
+    form, _ = await prepare_question(student, question, answer, language=language)
+    print('Student{} has an attempt in progress at {} Q{}'.format(student.student_num, language, question))
+    return form, language
+
+
+def find_finish_button(form):
+    '''Return the name of the attempt form's "Finish attempt ..." button
+       (the 'next' button of a quiz's last page), or None if there isn't one
+    '''
+    buttons = [name for name in form.names('submit') if name == 'next' or name.endswith(':next')]
+    return buttons[0] if buttons else None
+
+
+async def finish_attempt(student, form, scheduled):
+    '''At the scheduled time, finish the attempt whose attempt form is given:
+       click "Finish attempt ..." and then "Submit all and finish". Return the
+       triple (time from scheduled until the last response, error, details),
+       where details gives the times of the two steps as nav_secs (the
+       summary page) and check_secs (the submission).
+    '''
+    await asyncio.sleep(max(0, scheduled - time.time()))
+    details = {}
+    try:
+        student.phase = 'finish attempt'
+        finish_button = find_finish_button(form)
+        if finish_button is not None:
+            await student.submit(form, finish_button)
+        else:  # Without the button, unsaved answers are lost, but the herd still arrives
+            await student.follow_link('Finish attempt')
+        details['nav_secs'] = time.time() - scheduled
+        submit_start = time.time()
+        finish_forms = [page_form for page_form in student.page.forms if 'finishattempt' in page_form.names('hidden')]
+        if not finish_forms:
+            raise IndexError('No "Submit all and finish" form on the summary page')
+        student.phase = 'submit all'
+        await student.submit(finish_forms[0])
+        details['check_secs'] = time.time() - submit_start
+        dt = time.time() - scheduled
+        if student.page.base_url.split('?')[0].endswith(FINISHED_PAGES):
+            err = ''
+        else:
+            err = '****Serious error****'
+            details['excerpt'] = error_excerpt(student.html)
+    except (aiohttp.ClientError, asyncio.TimeoutError, LinkNotFoundError, IndexError) as e:
+        dt = time.time() - scheduled
+        err = 'Request failed: {!r}'.format(e)
+    return dt, err, details
+
+
+class JobeProbe:
+    '''Submits a small run to a Jobe server every PROBE_SECS, recording the
+       (send time, latency, outcome) of each, to tell when its queue has drained
+    '''
+    def __init__(self, jobe_server):
+        self.jobe_server = jobe_server
+        self.probes = []
+
+    async def run(self, stop):
+        '''Probe until the stop event is set'''
+        from loadtestjobe import make_run_spec, jobe_url, classify, JOBE_API_KEY
+        headers = {'User-Agent': 'CodeRunner', 'Accept': 'application/json'}
+        if JOBE_API_KEY:
+            headers['X-API-KEY'] = JOBE_API_KEY
+        job = {'run_spec': make_run_spec('PYTHON3', lt.FIRST_QUESTION)}
+        timeout = aiohttp.ClientTimeout(total=DRAIN_TIMEOUT_SECS)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while not stop.is_set():
+                start = time.time()
+                try:
+                    async with session.post(jobe_url(self.jobe_server, 'runs'), json=job, headers=headers) as response:
+                        try:
+                            body = await response.json(content_type=None)
+                        except ValueError:
+                            body = None
+                        outcome = classify(response.status, body)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    outcome = 'connection error: ' + type(e).__name__
+                self.probes.append((start, time.time() - start, outcome))
+                try:
+                    await asyncio.wait_for(stop.wait(), max(0, start + PROBE_SECS - time.time()))
+                except asyncio.TimeoutError:
+                    pass
+
+    def baseline(self, before):
+        '''Return the median latency of the successful probes sent before
+           the given time, or None if there were none
+        '''
+        latencies = [latency for (start, latency, outcome) in self.probes if start < before and not outcome]
+        return statistics.median(latencies) if latencies else None
+
+    def drained_time(self, release_start):
+        '''Return the send time of the first probe after release_start from
+           which all probes were successful and within DRAIN_FACTOR of the
+           baseline, or None if the queue never drained
+        '''
+        baseline = self.baseline(release_start)
+        if baseline is None:
+            return None
+        drained = None
+        for start, latency, outcome in self.probes:
+            if start < release_start:
+                continue
+            if outcome or latency > DRAIN_FACTOR * baseline:
+                drained = None
+            elif drained is None:
+                drained = start
+        return drained
+
+    def is_drained(self, release_start):
+        '''True if the most recent probe was back to normal'''
+        baseline = self.baseline(release_start)
+        if baseline is None or not self.probes:
+            return True
+        start, latency, outcome = self.probes[-1]
+        return start >= release_start and not outcome and latency <= DRAIN_FACTOR * baseline
+
+
+class HerdResult:
+    '''The outcome of a finish-attempt herd'''
+    def __init__(self, recorder, num_attempts, num_built, release_start, last_response, probe, drained):
+        self.recorder = recorder
+        self.num_attempts = num_attempts
+        self.num_built = num_built
+        self.release_start = release_start
+        self.last_response = last_response
+        self.probe = probe
+        self.drained = drained
+
+    def print_report(self, monitor=None):
+        self.recorder.print_report()
+        if monitor is not None:
+            monitor.print_report(self.recorder)
+        num_errors = self.recorder.num_errors()
+        print('{} of {} attempts built; {} finishes failed ({:.1f}%)'.format(
+            self.num_built, self.num_attempts, num_errors, 100.0 * num_errors / self.num_built if self.num_built else 0))
+        print('Last finish returned {:.1f} secs after the first release'.format(
+            self.last_response - self.release_start))
+        if self.probe is not None:
+            baseline = self.probe.baseline(self.release_start)
+            peak = max([latency for (start, latency, outcome) in self.probe.probes if start >= self.release_start],
+                       default=None)
+            failed = sum(1 for (start, latency, outcome) in self.probe.probes if start >= self.release_start and outcome)
+            print('Jobe probe: baseline {}, peak {}, {} failed probes after release'.format(
+                '{:.3f} secs'.format(baseline) if baseline is not None else '-',
+                '{:.3f} secs'.format(peak) if peak is not None else '-', failed))
+            if baseline is None:
+                print('Jobe queue drain time unknown: no successful probe before the release')
+            elif peak is not None and peak <= DRAIN_FACTOR * baseline and not failed:
+                print('Jobe queue never backed up (probe latency stayed within {}x baseline)'.format(DRAIN_FACTOR))
+            elif self.drained is None:
+                print('*** Jobe queue had not drained {} secs after the last finish'.format(DRAIN_TIMEOUT_SECS))
+            else:
+                print('Jobe queue drained {:.1f} secs after the first release'.format(
+                    max(0, self.drained - self.release_start)))
+
+
+async def run_herd(num_attempts, window_secs, jobe_server, run, monitor):
+    '''Coroutine that does the work of simulate_finish'''
+    lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+    probe = JobeProbe(jobe_server) if jobe_server else None
+    stop_probing = asyncio.Event()
+    prober = asyncio.ensure_future(probe.run(stop_probing)) if probe else None
+    connector = make_connector()
+    students = [VirtualStudent(student_num, connector)
+                for student_num in range(lt.START_STUDENT, lt.START_STUDENT + num_attempts)]
+    questions = [lt.FIRST_QUESTION + i % lt.NUM_QUESTIONS for i in range(num_attempts)]
+
+    print('BUILDING {} ATTEMPTS'.format(num_attempts))
+    builds = await asyncio.gather(*[
+        build_attempt(student, question, BUILD_RAMP_SECS * i / num_attempts)
+        for i, (student, question) in enumerate(zip(students, questions))], return_exceptions=True)
+    built = []
+    for student, question, build in zip(students, questions, builds):
+        if isinstance(build, BaseException):
+            if not isinstance(build, (aiohttp.ClientError, asyncio.TimeoutError, LinkNotFoundError,
+                                      IndexError, ValueError)):
+                raise build
+            print('OOPS - student{} attempt build failed: {!r}'.format(student.student_num, build))
+        else:
+            built.append((student, question, build))
+
+    release_start = time.time() + RELEASE_DELAY_SECS
+    recorder = LatencyRecorder(REPORT_WINDOW_SECS, start_time=release_start)
+    print('RELEASING {} FINISHES OVER {} SECS'.format(len(built), window_secs))
+
+    async def finish(student, question, form, language):
+        dt, err, details = await finish_attempt(student, form, release_start + random.uniform(0, window_secs))
+        print('Student{}, {} Q{} finished: dt = {:.2f} {}'.format(student.student_num, language, question, dt,
+                                                                   'FAIL' if err else 'OK'))
+        if err:
+            recorder.record_error(err, question, language)
+        else:
+            recorder.record(dt, question, language)
+        if run is not None:
+            run.record(student.student_num, question, language, dt, err, details)
+
+    await asyncio.gather(*[finish(student, question, form, language)
+                           for (student, question, (form, language)) in built])
+    last_response = time.time()
+    if probe:
+        while not probe.is_drained(release_start) and time.time() < last_response + DRAIN_TIMEOUT_SECS:
+            await asyncio.sleep(PROBE_SECS)
+        stop_probing.set()
+        await prober
+
+    for student in students:
+        await student.close()
+    await connector.close()
+    if lag_watcher:
+        lag_watcher.cancel()
+    drained = probe.drained_time(release_start) if probe else None
+    return HerdResult(recorder, num_attempts, len(built), release_start, last_response, probe, drained)
+
+
+def simulate_finish(num_attempts=NUM_ATTEMPTS, window_secs=FINISH_WINDOW_SECS, jobe_server=JOBE_SERVER,
+                    run=None, monitor=None):
+    '''Build num_attempts attempts and release all their finishes within
+       window_secs, probing jobe_server (if given) for its queue drain time.
+       Returns a HerdResult. Each finish is also recorded in the results
+       store Run run, if given, and the event loop's lag is measured by the
+       ClientMonitor monitor, if given.
+    '''
+    return asyncio.run(run_herd(num_attempts, window_secs, jobe_server, run, monitor))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the end-of-exam rush to finish quiz attempts')
+    parser.add_argument('--attempts', type=int, default=NUM_ATTEMPTS,
+                        help='Number of attempts (and students) in progress at the end of the exam')
+    parser.add_argument('--window', type=float, default=FINISH_WINDOW_SECS,
+                        help='Time (secs) within which all finishes are released')
+    parser.add_argument('--jobe', default=JOBE_SERVER, help='Jobe host[:port] or URL to probe for queue drain time')
+    parser.add_argument('--save', help='File in which to save the finish latency histograms')
+    parser.add_argument('--db', default=RESULTS_DB, help='Results store in which to record every finish')
+    parser.add_argument('--description', default='', help='Description of this test, for the results store')
+    args = parser.parse_args()
+
+    config = dict(vars(args), SERVER=lt.SERVER, WORKLOAD_MIX=lt.WORKLOAD_MIX, START_STUDENT=lt.START_STUDENT)
+    store = ResultsStore(args.db)
+    run = store.start_run('loadtestfinish.py', args.description, config)
+    start_trace(lt.TRACE_FILE)
+    monitor = ClientMonitor().start()
+    result = simulate_finish(args.attempts, args.window, args.jobe, run, monitor)
+    monitor.stop()
+    run.finish()
+    store.close()
+    finish_trace(lt.TRACE_FILE)
+    result.print_report(monitor)
+    print('Results stored as run {} in {}'.format(run.run_id, args.db))
+    if args.save:
+        result.recorder.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+'''Constant-memory latency histograms for the CodeRunner load testers.
+
+    A Histogram records latencies into logarithmically-sized buckets, in the
+    style of an HDR histogram: values (recorded in seconds, stored in
+    microseconds) are kept to SUB_BUCKET_BITS significant bits, so
+    percentiles are accurate to better than 1% however many values are
+    recorded, and the memory used depends only on the range of values seen.
+    Histograms can be merged (e.g. from several worker processes or
+    machines) and saved to and loaded from JSON, so runs can be compared
+    later.
+
+    A LatencyRecorder keeps a set of Histograms for a whole run: overall,
+    per question, per language, per expected grading-cache outcome ('hit'
+    or 'miss', when known) and per rolling time window, together with error
+    counts, and prints a percentile report.
+
+    Works with both Python 2 (loadtesting.py) and Python 3 (loadtesting3.py).
+
+    >>> recorder = LatencyRecorder()
+    >>> recorder.record(1.25, question=0, language='PYTHON3')
+    >>> recorder.print_report()
+'''
+
+from __future__ import division, print_function
+
+import json
+import time
+
+SUB_BUCKET_BITS = 7           # Significant bits kept (so relative error < 2 ** -(7 - 1))
+WINDOW_SECS = 30              # Width of the rolling windows in the time-series report
+PERCENTILES = [50, 90, 99, 99.9]
+
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKET_COUNT = SUB_BUCKET_COUNT // 2
+
+
+def bucket_index(micros):
+    '''Return the index of the bucket holding the given non-negative
+       integer number of microseconds
+    '''
+    if micros < SUB_BUCKET_COUNT:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS
+    return shift * HALF_SUB_BUCKET_COUNT + (micros >> shift)
+
+
+def bucket_range(index):
+    '''Return the pair (lowest, highest) of the microsecond values that
+       map to the bucket with the given index
+    '''
+    if index < SUB_BUCKET_COUNT:
+        return index, index
+    shift = index // HALF_SUB_BUCKET_COUNT - 1
+    top = index - shift * HALF_SUB_BUCKET_COUNT
+    return top << shift, ((top + 1) << shift) - 1
+
+
+class Histogram(object):
+    '''A log-bucketed histogram of latencies, recorded in seconds'''
+    def __init__(self):
+        self.counts = {}   # Map from bucket index to count
+        self.total = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, secs, count=1):
+        '''Record the given latency (in seconds) count times'''
+        index = bucket_index(max(0, int(round(secs * 1e6))))
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.sum += secs * count
+        self.min = secs if self.min is None else min(self.min, secs)
+        self.max = secs if self.max is None else max(self.max, secs)
+
+    def merge(self, other):
+        '''Add all the values recorded in the histogram other into self'''
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+    def percentile(self, percent):
+        '''Return the given percentile of the recorded values, in seconds,
+           or None if the histogram is empty
+        '''
+        if self.total == 0:
+            return None
+        rank = max(1, percent / 100.0 * self.total)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lowest, highest = bucket_range(index)
+                value = (lowest + highest) / 2.0 / 1e6
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def percentiles(self, percents=PERCENTILES):
+        '''Return a list of the given percentiles'''
+        return [self.percentile(percent) for percent in percents]
+
+    def to_dict(self):
+        '''Return a JSON-serialisable representation of self'''
+        return {
+            'sub_bucket_bits': SUB_BUCKET_BITS,
+            'counts': {str(index): count for (index, count) in self.counts.items()},
+            'total': self.total,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Rebuild a Histogram from the output of to_dict'''
+        assert data['sub_bucket_bits'] == SUB_BUCKET_BITS, "Histogram saved with a different resolution"
+        hist = cls()
+        hist.counts = {int(index): count for (index, count) in data['counts'].items()}
+        hist.total = data['total']
+        hist.sum = data['sum']
+        hist.min = data['min']
+        hist.max = data['max']
+        return hist
+
+    def __repr__(self):
+        return "Histogram(n={}, p50={}, max={})".format(self.total, self.percentile(50), self.max)
+
+
+class LatencyRecorder(object):
+    '''Histograms of the latencies of a whole load-test run, overall, by
+       question, by language, by grading-cache outcome and by rolling time
+       window, plus error counts keyed in the same way.
+    '''
+    def __init__(self, window_secs=WINDOW_SECS, start_time=None):
+        self.window_secs = window_secs
+        self.start_time = time.time() if start_time is None else start_time
+        self.overall = Histogram()
+        self.by_question = {}
+        self.by_language = {}
+        self.by_cache = {}      # Map from 'hit' or 'miss' to Histogram, if the cache outcome is known
+        self.by_window = {}     # Map from window number (from start_time) to Histogram
+        self.errors = {}        # Map from error message to count
+        self.errors_by_question = {}
+        self.errors_by_language = {}
+        self.errors_by_cache = {}
+        self.errors_by_window = {}
+
+    def window(self, when):
+        '''Return the number of the window containing time when'''
+        return int((when - self.start_time) // self.window_secs)
+
+    @staticmethod
+    def _add(histograms, key, secs):
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].record(secs)
+
+    def record(self, secs, question=None, language=None, when=None, cache=None):
+        '''Record a successful request that took secs seconds and completed
+           at time when (default now). cache is the expected grading-cache
+           outcome, 'hit' or 'miss', or None if unknown.
+        '''
+        when = time.time() if when is None else when
+        self.overall.record(secs)
+        self._add(self.by_question, question, secs)
+        self._add(self.by_language, language, secs)
+        if cache is not None:
+            self._add(self.by_cache, cache, secs)
+        self._add(self.by_window, self.window(when), secs)
+
+    def record_error(self, error, question=None, language=None, when=None, cache=None):
+        '''Count a failed request with the given error message that
+           completed at time when (default now)
+        '''
+        when = time.time() if when is None else when
+        for counts, key in [(self.errors, error), (self.errors_by_question, question),
+                            (self.errors_by_language, language),
+                            (self.errors_by_window, self.window(when))]:
+            counts[key] = counts.get(key, 0) + 1
+        if cache is not None:
+            self.errors_by_cache[cache] = self.errors_by_cache.get(cache, 0) + 1
+
+    def num_errors(self):
+        return sum(self.errors.values())
+
+    def merge(self, other):
+        '''Merge the LatencyRecorder other (e.g. from another worker) into
+           self. Windows are aligned on start times, so the two recorders
+           should have been given the same start_time and window_secs.
+        '''
+        self.overall.merge(other.overall)
+        for mine, theirs in [(self.by_question, other.by_question),
+                             (self.by_language, other.by_language),
+                             (self.by_cache, other.by_cache),
+                             (self.by_window, other.by_window)]:
+            for key, hist in theirs.items():
+                if key not in mine:
+                    mine[key] = Histogram()
+                mine[key].merge(hist)
+        for mine, theirs in [(self.errors, other.errors),
+                             (self.errors_by_question, other.errors_by_question),
+                             (self.errors_by_language, other.errors_by_language),
+                             (self.errors_by_cache, other.errors_by_cache),
+                             (self.errors_by_window, other.errors_by_window)]:
+            for key, count in theirs.items():
+                mine[key] = mine.get(key, 0) + count
+
+    def to_dict(self):
+        '''Return a JSON-serialisable representation of self. Keys are
+           stored as strings; questions and windows are converted back to
+           ints by from_dict.
+        '''
+        def hists(histograms):
+            return {str(key): hist.to_dict() for (key, hist) in histograms.items()}
+
+        def counts(count_map):
+            return {str(key): count for (key, count) in count_map.items()}
+
+        return {
+            'window_secs': self.window_secs,
+            'start_time': self.start_time,
+            'overall': self.overall.to_dict(),
+            'by_question': hists(self.by_question),
+            'by_language': hists(self.by_language),
+            'by_cache': hists(self.by_cache),
+            'by_window': hists(self.by_window),
+            'errors': counts(self.errors),
+            'errors_by_question': counts(self.errors_by_question),
+            'errors_by_language': counts(self.errors_by_language),
+            'errors_by_cache': counts(self.errors_by_cache),
+            'errors_by_window': counts(self.errors_by_window)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Rebuild a LatencyRecorder from the output of to_dict'''
+        def int_key(key):
+            return None if key == 'None' else int(key)
+
+        def hists(histograms, convert=str):
+            return {convert(key): Histogram.from_dict(hist) for (key, hist) in histograms.items()}
+
+        recorder = cls(data['window_secs'], data['start_time'])
+        recorder.overall = Histogram.from_dict(data['overall'])
+        recorder.by_question = hists(data['by_question'], int_key)
+        recorder.by_language = hists(data['by_language'])
+        recorder.by_cache = hists(data.get('by_cache', {}))
+        recorder.by_window = hists(data['by_window'], int)
+        recorder.errors = dict(data['errors'])
+        recorder.errors_by_question = {int_key(key): count for (key, count) in data['errors_by_question'].items()}
+        recorder.errors_by_language = dict(data['errors_by_language'])
+        recorder.errors_by_cache = dict(data.get('errors_by_cache', {}))
+        recorder.errors_by_window = {int(key): count for (key, count) in data.get('errors_by_window', {}).items()}
+        return recorder
+
+    def save(self, filename):
+        '''Write self to the given file as JSON'''
+        with open(filename, 'w') as outfile:
+            json.dump(self.to_dict(), outfile)
+
+    @classmethod
+    def load(cls, filename):
+        '''Read a LatencyRecorder from a JSON file written by save'''
+        with open(filename) as infile:
+            return cls.from_dict(json.load(infile))
+
+    def print_report(self, percents=PERCENTILES):
+        '''Print percentile tables overall, by question, by language, by
+           grading-cache outcome (if known) and by time window
+        '''
+        header = '{:>14} {:>7} {:>6}'.format('', 'count', 'errors') + ''.join(
+            '{:>9}'.format('p' + str(percent)) for percent in percents) + '{:>9}'.format('max')
+
+        def line(label, hist, num_errors):
+            values = hist.percentiles(percents) + [hist.max]
+            return '{:>14} {:>7} {:>6}'.format(label, hist.total, num_errors) + ''.join(
+                '{:>9.3f}'.format(value) if value is not None else '{:>9}'.format('-') for value in values)
+
+        def table(title, histograms, errors, label):
+            print(title)
+            print(header)
+            for key in sorted(set(histograms) | set(errors), key=lambda k: (k is None, k)):
+                print(line(label(key), histograms.get(key, Histogram()), errors.get(key, 0)))
+            print()
+
+        print('Latencies (secs)')
+        print(header)
+        print(line('all', self.overall, self.num_errors()))
+        print()
+        table('By question', self.by_question, self.errors_by_question, lambda q: 'Q{}'.format(q))
+        table('By language', self.by_language, self.errors_by_language, str)
+        if self.by_cache or self.errors_by_cache:
+            table('By grading cache (expected)', self.by_cache, self.errors_by_cache, str)
+        table('By {}-second window'.format(self.window_secs), self.by_window, self.errors_by_window,
+              lambda w: '{}s'.format(w * self.window_secs))
@@ -29,13 +29,14 @@ import time
 from multiprocessing import Pool, Process, Queue
 import itertools
 import sys
-import shelve
 import random
 import traceback
+from loadtesthistogram import Histogram, PERCENTILES
+from loadtestresults import ResultsStore, RESULTS_DB
+from loadtesttrace import tracer_for, start_trace, finish_trace
 
 LANGUAGE = 'PYTHON3'
-
-shelf = shelve.open('coderunner_loadtesting_results')
+TRACE_FILE = None  # If set, e.g. to 'loadtesttrace.json', every request is traced to it (see loadtesttrace.py)
 
 # Correct answers to the four one-question quizzes for each language.
 
@@ -157,6 +158,26 @@ all_args = list(itertools.product(quizzes,students))
 MIN_N, MAX_N = 30, 40  # Range of subrange-lengths of all_args (see run_all_n)
 
 
+def browse(br, phase, student, quiz_num, action, *args, **kwargs):
+    '''Call the browser method action with the given arguments and return
+       its response, recording a span of the given phase in the trace if
+       tracing is on'''
+    tracer = tracer_for(TRACE_FILE)
+    if tracer is None:
+        return action(*args, **kwargs)
+    student_num = student_number(student)
+    start = time.time()
+    try:
+        response = action(*args, **kwargs)
+    except mech.LinkNotFoundError:
+        raise
+    except Exception, e:
+        tracer.span(phase, student_num, quiz_num, start, time.time() - start, getattr(e, 'code', None), error=repr(e))
+        raise
+    tracer.span(phase, student_num, quiz_num, start, time.time() - start, response.code, len(response.get_data()))
+    return response
+
+
 def quiz_runner(arg_tup): #quiz_name, student, [Queue]
     '''Run the given quiz for the given student'''
 
@@ -175,7 +196,7 @@ def quiz_runner(arg_tup): #quiz_name, student, [Queue]
         print 'opening quiz page'
         br = mech.Browser()
         br.set_handle_robots(False)
-        br.open(login)
+        browse(br, 'login', student, None, br.open, login)
 
         print 'Logging in as ' + student
         #print br.response().get_data()
@@ -183,19 +204,19 @@ def quiz_runner(arg_tup): #quiz_name, student, [Queue]
         br.form = log_form
         br['username'] = student
         br['password'] = 'S-tudent0'
-        br.submit()
+        browse(br, 'login', student, None, br.submit)
 
         print "Logged in. Following link to " + course
-        br.follow_link(text_regex=course)
+        browse(br, 'navigate', student, quiz_num, br.follow_link, text_regex=course)
 
         print "Follow link to " + quiz_name
-        br.follow_link(text_regex=quiz_name)
+        browse(br, 'navigate', student, quiz_num, br.follow_link, text_regex=quiz_name)
 
         print "follow link to 'Attempt quiz now' (or 'Re-attempt quiz')"
         #br.follow_link(text_regex='Preview')
         #br.follow_link(text_regex='Re-attempt quiz')
         br.select_form(nr=0)
-        br.submit()
+        browse(br, 'start attempt', student, quiz_num, br.submit)
 
         forms = list(br.forms())
         main_form = forms[0]
@@ -210,7 +231,7 @@ def quiz_runner(arg_tup): #quiz_name, student, [Queue]
 
         print 'submit %s code' % LANGUAGE
         start = time.time()
-        br.submit()
+        browse(br, 'check', student, quiz_num, br.submit)
         res = br.response()
         data = res.get_data()
         dt = time.time() - start
@@ -229,11 +250,11 @@ def quiz_runner(arg_tup): #quiz_name, student, [Queue]
             print data
 
         print 'Finishing attempt'
-        br.follow_link(text_regex='Finish attempt')
+        browse(br, 'finish attempt', student, quiz_num, br.follow_link, text_regex='Finish attempt')
 
         print 'Getting review'
         br.select_form(nr=0)
-        br.submit()
+        browse(br, 'review', student, quiz_num, br.submit)
 
         print 'All done'
         br.close()
@@ -241,19 +262,27 @@ def quiz_runner(arg_tup): #quiz_name, student, [Queue]
         print '*** EXCEPTION', e
         traceback.print_exc()
         print br.response()
-        err = str(e)
-        dt = -1
+        err = repr(e)  # Never empty, so the request is recorded as failed
+        dt = None      # No latency
     if queue:
-        queue.put((dt, err), block=False)
+        queue.put((dt, err, quiz_num, student), block=False)
     return (dt, err)
 
 
-def run_n(n):
+def student_number(student):
+    return int(student[len('student'):])
+
+
+def run_n(n, store):
     '''Run, in parallel, the first n (student, quiz) pairings from
-       the global all_args list'''
+       the global all_args list, recording each in the given ResultsStore'''
     arg_list = all_args[:n]
+    run = store.start_run('loadtesting.py', 'run_n', {'n': n, 'LANGUAGE': LANGUAGE})
     pool = Pool(processes=len(arg_list))
     times = pool.map(quiz_runner, arg_list)
+    for (quiz_name, student), (dt, err) in zip(arg_list, times):
+        run.record(student_number(student), int(quiz_name[-1]) - 1, LANGUAGE, dt, err)
+    run.finish()
     floats = [x for (x, y) in times if y == '']
     errors = [y for (x, y) in times if y != '']
     avg = sum(floats)/len(floats) if len(floats) > 0 else -1
@@ -264,13 +293,13 @@ def run_all_n():
     '''For a range of subranges of the global all_args variable from
        MIN_N to MAX_N, do a simulation run'''
     results = []
+    store = ResultsStore(RESULTS_DB)
     for n in range(MIN_N, MAX_N + 1):
         print n
-        result = run_n(n)
-        shelf[str(n)] = result
+        result = run_n(n, store)
         print result
         results.append(result)
-    shelf.close()
+    store.close()
 
 
 def sim(avg_gap, sim_length):
@@ -279,6 +308,9 @@ def sim(avg_gap, sim_length):
        time of avg_gap'''
 
     name = 'sim_gap_%d_length_%d' % (avg_gap, sim_length)
+    store = ResultsStore(RESULTS_DB)
+    run = store.start_run('loadtesting.py', name, {'avg_gap': avg_gap, 'sim_length': sim_length,
+                                                    'LANGUAGE': LANGUAGE})
     arg_gen = itertools.cycle(all_args)
     lamb = 1.0/avg_gap
     result_q = Queue(10000)
@@ -301,13 +333,14 @@ def sim(avg_gap, sim_length):
     results = []
     errs = []
     while not result_q.empty():
-        (dt, err) = result_q.get(False)
+        (dt, err, quiz_num, student) = result_q.get(False)
+        run.record(student_number(student), quiz_num, LANGUAGE, dt, err)
         if err:
             errs.append(err)
         else:
             results.append(dt)
-    shelf[name] = (results, errs)
-    shelf.close()
+    run.finish()
+    store.close()
     print len(errs), ' exceptions'
     print "Success times:", results
     return (results, errs)
@@ -318,11 +351,18 @@ if __name__ == '__main__':
     SIMULATION_DURATION_SECS = 60
 
     before = time.time()
+    start_trace(TRACE_FILE)
     (results, errs) = sim(SIMULATION_GAP_SECS, SIMULATION_DURATION_SECS)
+    finish_trace(TRACE_FILE)
     after = time.time()
-    print "min:",min(results)
-    print "max:",max(results)
-    print "avg:",sum(results)/len(results)
+    hist = Histogram()
+    for dt in results:
+        hist.record(dt)
+    print "min:", hist.min
+    for percent, value in zip(PERCENTILES, hist.percentiles()):
+        print "p%s: %.3f" % (percent, value)
+    print "max:", hist.max
+    print "avg:", hist.mean()
     print 'total time: %d' % (after-before)
     print 'total successful submissions: %d' % len(results)
     print 'total failed submissions: %d' % len(errs)
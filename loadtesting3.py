@@ -33,14 +33,17 @@ from queue import Empty
 from time import sleep
 
 import sys
-import shelve
 import random
 
+from loadtestworkload import quiz_answers, slow_answers, failing_answers, NUM_QUESTIONS, FIRST_QUESTION
+from loadtesthistogram import LatencyRecorder
+from loadtestresults import ResultsStore, error_excerpt
+from loadtesttrace import tracer_for, start_trace, finish_trace
+from loadtestmonitor import ClientMonitor
+
 SERVER = 'https://quiz2024.csse.canterbury.ac.nz/login/index.php?theme=clean'
 COURSE = 'LoadTestingByRichard'
 LANGUAGE = 'PYTHON3'
-NUM_QUESTIONS = 4
-FIRST_QUESTION = 0
 LAST_QUESTION = FIRST_QUESTION + NUM_QUESTIONS - 1
 DEBUGGING = False
 INTER_SUBMISSION_GAP_SECS = 0
@@ -48,128 +51,23 @@ SIMULATION_DURATION_SECS = 300
 NUM_STUDENTS = 40
 START_STUDENT = 0
 PASSWORD = 'S-tudent0'
-
-# Correct answers to the four one-question quizzes for each language.
-
-quiz_answers = {
-
-# ==== C ====
-'C': ['''
-float addMul(float a, float b, float c)
-{
-    return (a + b) * c;
-}
-''',
-
-'''
-float approx_const(float xxx)
-{
-    long long xScaled = xxx * 1000 + 0.5;
-    return xScaled / 1000.0;
-}
-''',
-
-'''
-float c_to_f(float ccc)
-{
-    return 32.0 + ccc * 9.0 / 5.0;
-}
-''',
-
-'''
-#include <stdio.h>
-
-int main()
-{
-    int n;
-    int i;
-    scanf("%d", &n);
-    for (i = 1; i <= n; i++) {
-        printf("%d", i);
-    }
-    puts("");
-    return 0;
-}
-'''],
-
-# ==== PYTHON3 ====
-
-'PYTHON3': [
-'''
-def addMul(aaa, bbb, ccc):
-    """Return (aaa + bbb) * ccc"""
-    return (aaa + bbb) * ccc
-''',
-
-'''
-def approx_const(xxx):
-    """Return xxx rounded to 3 decimal places"""
-    x_scaled = xxx * 1000 + 0.5
-    return int(x_scaled) / 1000.0
-''',
-
-'''
-def c_to_f(degs_c):
-    """Degs_c converted to degs_f"""
-    return 32.0 + degs_c * 9.0 / 5.0
-''',
-
-'''
-"""Read n from stdin, print 1 to n without spaces"""
-n = int(input())
-for i in range(1, n+1):
-   print(str(i) + ' ', end='')
-print()
-''',
-
-'''
-([[{},{},{1,4,8}],[2,{},{}],[{},3,{}],[3,3,{}],[4,{4,5},{}],[6,{},{}],[{},7,{}],[7,7,{}],[8,{8,9},{}],[10,{},{}],[{},{},{}]],[3,7,10])
-'''],
-
-# ====== MATLAB ======
-
-'MATLAB': [
-'''function result = addMul(a, b, c)
-    result = (a + b) * c;
-end
-''',
-'''function ac = approx_const(f)
-    ac = double(int32(f * 1000))/1000;
-end
-''',
-'''function result = c_to_f(c)
-    result = 32.0 + c * 9.0 / 5.0;
-end
-''',
-'''function crazy(n)
-   s = '';
-   for i = 1 : n
-      s = [s  sprintf('%d ', i)];
-   end
-   disp(s);
-end
-'''
-],
-
-# ====== CLOJURE ======
-"CLOJURE": """
-(defn arg-max [f ls]
-  (reduce (fn [x y] (if (> (f x) (f y)) x y)) (first ls) ls))
-;
-(defn compose [& fns]
-  (fn [x] (reduce (fn [x f] (f x)) x fns)))
-;
-(defn conjoin [& ps]
-  (fn [x] (reduce (fn [v p] (and v (p x))) true ps)))
-;
-(defn transpose [ls] (apply map list ls))
-""".split(';')
-}
+ENGINE = 'processes'  # 'processes' (a mechanize browser per process) or 'asyncio' (see loadtestasync.py)
+ARRIVAL_MODE = 'closed'  # 'closed' (students pause between submissions) or 'open' (asyncio engine only)
+TARGET_SUBMISSIONS_PER_MIN = 600  # Open-loop Poisson arrival rate of Check submissions
+HISTOGRAM_FILE = 'loadtesthistograms.json'  # Latency histograms of the last run are saved here
+RESULTS_DB = 'loadtestresults.sqlite'  # Every request of every run is recorded here (see loadtestresults.py)
+RUN_DESCRIPTION = ''  # Stored with the run, to identify it later
+CACHE_HIT_RATIO = 0.0  # Fraction of answers resubmitted unchanged, so they can hit coderunner_grading_cache
+TRACE_FILE = None  # If set, e.g. to 'loadtesttrace.json', every request is traced to it (see loadtesttrace.py)
+WORKLOAD_MIX = {LANGUAGE: 100}  # Relative weights of languages, e.g. {'PYTHON3': 60, 'C': 25, 'JAVA': 10, 'MATLAB': 5}
+SLOW_ANSWER_RATIO = 0.0  # Fraction of submissions using an answer from slow_answers, where there is one
+FAILING_ANSWER_RATIO = 0.0  # Fraction of submissions using an answer from failing_answers, where there is one
 
 def randomise(answer, language):
     """Randomise the answer for the given language by inserting a random comment"""
     comments = {
         'C': '// ',
+        'JAVA': '// ',
         'MATLAB' : '% ',
         'PYTHON3' : '# '
     }
@@ -177,17 +75,90 @@ def randomise(answer, language):
     return answer + comment_line
 
 
+submitted_unchanged = set()  # (question, language, kind) triples whose unrandomised answer this process has submitted
+sole_submitter = True  # Whether this process makes all the run's submissions, so submitted_unchanged covers the run
+
+
+def choose_language():
+    """Return a language chosen at random with the weights of WORKLOAD_MIX"""
+    if not WORKLOAD_MIX:
+        return LANGUAGE
+    languages = sorted(WORKLOAD_MIX)
+    return random.choices(languages, weights=[WORKLOAD_MIX[language] for language in languages])[0]
+
+
+def choose_answer(question, language=LANGUAGE):
+    """Return the triple (answer, cache, kind) for the given question.
+       kind is 'slow' with probability SLOW_ANSWER_RATIO, 'failing' with
+       probability FAILING_ANSWER_RATIO (if slow_answers or failing_answers
+       has an answer to the question) and otherwise 'correct', and the
+       answer is taken from the matching table. With probability
+       CACHE_HIT_RATIO the answer is the unrandomised one from that table,
+       byte-identical to earlier submissions so that its grading result
+       should come from the grading cache (if enabled with the
+       enablegradecache setting), and otherwise it is randomised to defeat
+       the cache. cache is the expected outcome: 'hit' for a repeated
+       unrandomised answer, else 'miss'. Repeats are only known within
+       this process, so the label of the first unchanged submission of an
+       answer is exact only if this process makes all the run's
+       submissions (sole_submitter), i.e. for the asyncio engines on one
+       machine. Otherwise (the processes engine, or several
+       loadtestdistributed workers) another process may already have
+       filled the cache, and cache is None (unknown), leaving the
+       submission out of both the hit and the miss latencies.
+    """
+    kind, answer = 'correct', quiz_answers[language][question]
+    pick = random.random()
+    if pick < SLOW_ANSWER_RATIO:
+        if question in slow_answers.get(language, {}):
+            kind, answer = 'slow', slow_answers[language][question]
+    elif pick < SLOW_ANSWER_RATIO + FAILING_ANSWER_RATIO:
+        if question in failing_answers.get(language, {}):
+            kind, answer = 'failing', failing_answers[language][question]
+    if random.random() >= CACHE_HIT_RATIO:
+        return randomise(answer, language), 'miss', kind
+    elif (question, language, kind) in submitted_unchanged:
+        return answer, 'hit', kind
+    else:
+        submitted_unchanged.add((question, language, kind))
+        return answer, 'miss' if sole_submitter else None, kind  # First submission here fills the cache
+
+
 def debug(student_num, message):
     if DEBUGGING:
         print('Student{}: {}'.format(student_num, message))
 
 
+def browse(br, phase, student_num, question, action, *args, **kwargs):
+    '''Call the browser method action (br.open, br.follow_link or br.submit)
+       with the given arguments and return its response, recording a span of
+       the given phase in the trace if tracing is on'''
+    tracer = tracer_for(TRACE_FILE)
+    if tracer is None:
+        return action(*args, **kwargs)
+    start = time.time()
+    try:
+        response = action(*args, **kwargs)
+    except mech.LinkNotFoundError:
+        raise  # No request was made
+    except Exception as e:
+        tracer.span(phase, student_num, question, start, time.time() - start, getattr(e, 'code', None), error=repr(e))
+        raise
+    tracer.span(phase, student_num, question, start, time.time() - start, response.code, len(response.get_data()))
+    return response
+
+
 def loop_doing_questions(browser, student_num, sim_gap, duration, result_q):
     '''Using the given browser and for the given student number,
        who at this stage must already be logged in, cycle through the quiz
        questions, pausing for sim_gap seconds on average, terminating
        after the given duration. After each question has been attempted,
-       a result tuple (student, question, time, error) is written to result_q'''
+       a result tuple (student, question, time, error, details) is written
+       to result_q, where details is a dictionary of the navigation time,
+       the Check time, the expected grading-cache outcome, the language
+       and kind of answer (see choose_answer) and an excerpt of any error
+       page. Each question is attempted in a language chosen from
+       WORKLOAD_MIX.'''
 
     br = browser
 
@@ -196,113 +167,119 @@ def loop_doing_questions(browser, student_num, sim_gap, duration, result_q):
     else:
         lamb = 1.0 / sim_gap
     time_end = time.time() + duration
-    err_outfile = open("loadtesterrors.txt", 'a')
 
     while time.time() < time_end:
         for question in range(FIRST_QUESTION, LAST_QUESTION + 1):
+            nav_start = time.time()
             try:
-                br.follow_link(text_regex='Home')
+                browse(br, 'navigate', student_num, question, br.follow_link, text_regex='Home')
             except mech.LinkNotFoundError:
                 pass
             
             debug(student_num, 'Following link to ' + COURSE)
             try:
-                br.follow_link(text_regex='Site home')
+                browse(br, 'navigate', student_num, question, br.follow_link, text_regex='Site home')
             except mech.LinkNotFoundError:
                 pass
-            br.follow_link(text_regex=COURSE)
-            question_name = LANGUAGE + '_LoadTesting' + str(question + 1)
+            browse(br, 'navigate', student_num, question, br.follow_link, text_regex=COURSE)
+            language = choose_language()
+            question_name = language + '_LoadTesting' + str(question + 1)
             debug(student_num, 'Following link to {}'.format(question_name))
-            br.follow_link(text_regex=question_name)
+            browse(br, 'navigate', student_num, question, br.follow_link, text_regex=question_name)
             debug(student_num, "Follow link to 'Attempt quiz now' (or 'Re-attempt quiz')")
 
             br.select_form(nr=0)
-            br.submit()
+            browse(br, 'start attempt', student_num, question, br.submit)
             forms = list(br.forms())
             main_form = forms[0]
             controls = main_form.controls
             textarea = controls[4]
 
             debug(student_num, 'Entering code into textarea')
-            quiz_answer = randomise(quiz_answers[LANGUAGE][question], LANGUAGE)
+            quiz_answer, cache, kind = choose_answer(question, language)
             textarea._value = quiz_answer
 
             br.form = main_form
 
-            debug(student_num, 'submit %s code' % LANGUAGE)
+            debug(student_num, 'submit %s code' % language)
             start = time.time()
+            details = {'nav_secs': start - nav_start, 'cache': cache, 'language': language, 'kind': kind}
 
             # Mechanize wrongly identifies the new Ace window maximise/window-ise buttons as submit buttons,
             # so we have to filter them out to find the actual Check button.
             submit_buttons = [control for control in controls if control.type == 'submitbutton' and control.name.endswith('submit')]
-            br.submit(name=submit_buttons[0].name)
+            browse(br, 'check', student_num, question, br.submit, name=submit_buttons[0].name)
 
             res = br.response()
             data = res.get_data().decode('utf-8')
             dt = time.time() - start
+            details['check_secs'] = dt
             if 'coderunner-test-results' in data:
                 if 'coderunner-test-results good' in data:
                     debug(student_num, 'Success! Test results returned in %.3f secs' % dt)
                     err = ''
 
+                elif kind == 'failing':
+                    debug(student_num, 'Failed as expected. Test results returned in %.3f secs' % dt)
+                    err = ''
+
                 else:
                     debug(student_num, '***Failed***! Test results returned in %.3f secs' % dt)
                     err = 'Wrong answer'
 
             else:
                 err = '****Serious error****'
+                details['excerpt'] = error_excerpt(data)
 
-            if err:
-                err_outfile.write(err + "\n" + data + "\n\n")
-
-            result_q.put((student_num, question, dt, err))
+            result_q.put((student_num, question, dt, err, details))
 
             if sim_gap != 0:
                 sleep_time = random.expovariate(lamb)
                 max_sleep = time_end - time.time()
                 time.sleep(min(max_sleep, sleep_time))
 
-    err_outfile.close()
-
 
 def quiz_runner(student_num, sim_gap, duration, result_q):
     '''For the given student number, login and cycle through the quiz
        questions, pausing for sim_gap seconds on average, terminating
        after the given duration. After each question has been attempted,
-       a result tuple (student, question, time, error) is written to result_q'''
+       a result tuple (student, question, time, error, details) is written
+       to result_q. Runs in its own process, one of many.'''
+    global sole_submitter
+    sole_submitter = False
     try:
         print('Student{} logging in ...'.format(student_num))
         login = SERVER
         ssl._create_default_https_context = ssl._create_unverified_context
         br = mech.Browser()
         br.set_handle_robots(False)
-        br.open(login)
+        browse(br, 'login', student_num, None, br.open, login)
         log_form = list(br.forms())[0]
         br.form = log_form
         br['username'] = 'student' + str(student_num)
         br['password'] = PASSWORD
-        br.submit()
+        browse(br, 'login', student_num, None, br.submit)
 
         print("Student{} logged in.".format(student_num))
         loop_doing_questions(br, student_num, sim_gap, duration, result_q)
     except ValueError as e:
         message = "OOPS - student{} run broke: {}".format(student_num, e)
         print(message);
-        result_q.put((student_num, -1, 0, message), block=False)
+        result_q.put((student_num, -1, 0, message, {}), block=False)
 
 
-def simulate(num_students, avg_gap, sim_length):
+def simulate(num_students, avg_gap, sim_length, run=None):
     '''Do a full simulation run of multiple students
        for a duration of sim_length, with an average inter-submission
-       time of avg_gap'''
+       time of avg_gap. Returns a LatencyRecorder of the results, which
+       are also recorded in the results store Run run, if given.'''
 
     result_q = Queue()
     processes = []
-    errs = []
-    results = []
 
     start = time.time()
     finish = start + sim_length
+    recorder = LatencyRecorder(start_time=start)
 
     for student in range(START_STUDENT, START_STUDENT + NUM_STUDENTS):
         proc = Process(target=quiz_runner, args = ((student, avg_gap, sim_length, result_q)))
@@ -313,36 +290,76 @@ def simulate(num_students, avg_gap, sim_length):
     # Loop reading result queue and displaying status
     while time.time() < finish + 10:
         try:
-            (student, question, delta_t, error) = result_q.get(timeout=1)
+            (student, question, delta_t, error, details) = result_q.get(timeout=1)
             print('Student{}, Q{}: dt = {:.2f} {}'.format(student, question, delta_t, 'FAIL' if error else 'OK'))
+            language = details.get('language', LANGUAGE)
             if error:
-                errs.append(error)
+                recorder.record_error(error, question, language, cache=details.get('cache'))
             else:
-                results.append(delta_t)
+                recorder.record(delta_t, question, language, cache=details.get('cache'))
+            if run is not None:
+                run.record(student, question, language, delta_t, error, details)
         except Empty:
             pass
 
     for p in processes:
         p.join()
 
-    print(len(errs), ' errors')
-    #print("Success times:", results)
-    return (results, errs)
+    print(recorder.num_errors(), ' errors')
+    return recorder
 
 
 
-if __name__ == '__main__':
-    before = time.time()
-    (results, errs) = simulate(NUM_STUDENTS, INTER_SUBMISSION_GAP_SECS, SIMULATION_DURATION_SECS)
-    after = time.time()
-    elapsed = after-before
-    print("min: {:.2f}".format(min(results)))
-    print("max: {:.2f}".format(max(results)))
-    print("avg: {:.2f}".format(sum(results)/len(results)))
+def print_summary(recorder, elapsed, monitor=None):
+    """Print the summary statistics of a simulation run, given its
+       LatencyRecorder and, optionally, the ClientMonitor of the load generator"""
+    recorder.print_report()
+    if monitor is not None:
+        monitor.print_report(recorder)
+    print("avg: {:.2f}".format(recorder.overall.mean() or 0))
     print('total time: %d' % elapsed)
-    print('total successful submissions: %d' % len(results))
-    print('total failed submissions: %d' % len(errs))
-    rate_per_sec = len(results) / elapsed
+    print('total successful submissions: %d' % recorder.overall.total)
+    print('total failed submissions: %d' % recorder.num_errors())
+    rate_per_sec = recorder.overall.total / elapsed
     rate_per_min = 60 * rate_per_sec
     print('submission rate: {:.2f} submissions/sec ({:.0f} submissions/min)'.format(rate_per_sec, rate_per_min))
+    if len(set(recorder.by_language) | set(recorder.errors_by_language)) > 1:
+        print('{:>10} {:>12} {:>10} {:>10} {:>8}'.format('language', 'submits/min', 'mean', 'p95', 'failed'))
+        for language in sorted(set(recorder.by_language) | set(recorder.errors_by_language), key=str):
+            hist = recorder.by_language.get(language)
+            print('{:>10} {:>12.1f} {:>10} {:>10} {:>8}'.format(
+                str(language), 60 * (hist.total if hist else 0) / elapsed,
+                '{:.3f}'.format(hist.mean()) if hist and hist.total else '-',
+                '{:.3f}'.format(hist.percentile(95)) if hist and hist.total else '-',
+                recorder.errors_by_language.get(language, 0)))
+
+
+def run_config():
+    """The settings of this module that define a run, for the results store"""
+    return {name: value for (name, value) in globals().items()
+            if name.isupper() and isinstance(value, (str, int, float, bool, dict))}
 
+
+if __name__ == '__main__':
+    store = ResultsStore(RESULTS_DB)
+    run = store.start_run('loadtesting3.py', RUN_DESCRIPTION, run_config())
+    start_trace(TRACE_FILE)
+    monitor = ClientMonitor().start()
+    before = time.time()
+    if ARRIVAL_MODE == 'open':
+        from loadtestasync import simulate_open_loop
+        recorder = simulate_open_loop(NUM_STUDENTS, TARGET_SUBMISSIONS_PER_MIN, SIMULATION_DURATION_SECS,
+                                      run=run, monitor=monitor)
+    elif ENGINE == 'asyncio':
+        from loadtestasync import simulate_async
+        recorder = simulate_async(NUM_STUDENTS, INTER_SUBMISSION_GAP_SECS, SIMULATION_DURATION_SECS, run, monitor)
+    else:
+        recorder = simulate(NUM_STUDENTS, INTER_SUBMISSION_GAP_SECS, SIMULATION_DURATION_SECS, run)
+    after = time.time()
+    monitor.stop()
+    run.finish()
+    store.close()
+    finish_trace(TRACE_FILE)
+    print_summary(recorder, after - before, monitor)
+    print('Results stored as run {} in {}'.format(run.run_id, RESULTS_DB))
+    recorder.save(HISTOGRAM_FILE)
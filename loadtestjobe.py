@@ -0,0 +1,293 @@
+#! /usr/bin/env python3
+
+'''Jobe server load tester.
+
+    Loads a Jobe server (or pool of servers) directly, bypassing Moodle, so
+    the Jobe pool can be sized separately from the Moodle servers. Runs are
+    POSTed to the Jobe 'runs' resource with the same JSON shape that
+    qtype_coderunner_jobesandbox::execute() builds (language_id, sourcecode,
+    sourcefilename, input, file_list and optional parameters). The
+    workload is the quiz_answers corpus from loadtestworkload.py, each answer
+    wrapped in a small test harness (TEST_HARNESSES below) to make a
+    complete program, much as a CodeRunner template would.
+
+    Two load models are available: closed-loop, with a fixed number of
+    concurrent clients each submitting a new run as soon as the last one
+    completes, or open-loop, with runs arriving as a Poisson process at a
+    fixed rate and latency measured from each run's scheduled arrival time.
+
+    Jobe's overload responses are counted as distinct outcomes: HTTP 200
+    with outcome 21 (the server couldn't get a free jobe user), HTTP 202
+    (run deferred) and HTTP 503 (service unavailable, usually from a
+    fronting proxy). Throughput and latency are reported per language.
+
+    To test the tool itself without a real Jobe server, run fakejobe.py and
+    point this at it, e.g.
+
+        python3 fakejobe.py --port 4000 &
+        python3 loadtestjobe.py --jobe localhost:4000 --rate 20 --duration 60
+
+    Requires aiohttp (pip3 install aiohttp).
+'''
+
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from loadtesthistogram import LatencyRecorder, WINDOW_SECS
+from loadtestworkload import arrival_times, parse_mix, quiz_answers, NUM_QUESTIONS, FIRST_QUESTION
+from loadtestresults import ResultsStore, RESULTS_DB
+from loadtestmonitor import ClientMonitor
+
+JOBE_SERVER = 'localhost:4000'  # As for the jobe_host setting: host[:port] or URL, ';' separated if several
+JOBE_API_KEY = ''
+WORKLOAD_MIX = {'PYTHON3': 60, 'C': 40}  # Relative weights of the quiz_answers languages to use
+SANDBOX_PARAMS = {}             # Passed to Jobe as the run_spec parameters, if non-empty
+DURATION_SECS = 60
+CONCURRENCY = 20                # Closed-loop number of concurrent clients
+MAX_CONNECTIONS = 500
+REQUEST_TIMEOUT_SECS = 120
+CONNECTION_BACKOFF_SECS = 1.0   # Closed-loop pause after a connection error, so a down server isn't hammered
+
+RESULT_COMPILATION_ERROR = 11
+RESULT_RUNTIME_ERROR = 12
+RESULT_TIME_LIMIT = 13
+RESULT_SUCCESS = 15
+RESULT_SERVER_OVERLOAD = 21
+
+OUTCOME_NAMES = {
+    RESULT_COMPILATION_ERROR: 'compile error',
+    RESULT_RUNTIME_ERROR: 'runtime error',
+    RESULT_TIME_LIMIT: 'time limit',
+    RESULT_SERVER_OVERLOAD: 'overload (outcome 21)'
+}
+
+# Map from quiz_answers language to Jobe language_id and source file extension
+JOBE_LANGUAGES = {
+    'PYTHON3': ('python3', 'py'),
+    'C': ('c', 'c'),
+    'JAVA': ('java', 'java'),
+    'MATLAB': ('octave', 'm')
+}
+
+# For each language, a list (one per question) of (harness, stdin) pairs.
+# Each harness is a format string into which the answer is inserted to
+# give a complete program.
+TEST_HARNESSES = {
+    'PYTHON3': [
+        ('{}\nprint(addMul(1, 2, 3))\n', ''),
+        ('{}\nprint(approx_const(3.14159))\n', ''),
+        ('{}\nprint(c_to_f(100))\n', ''),
+        ('{}', '10\n'),
+    ],
+    'C': [
+        ('#include <stdio.h>\n{}\nint main() {{ printf("%f\\n", addMul(1, 2, 3)); return 0; }}\n', ''),
+        ('#include <stdio.h>\n{}\nint main() {{ printf("%f\\n", approx_const(3.14159)); return 0; }}\n', ''),
+        ('#include <stdio.h>\n{}\nint main() {{ printf("%f\\n", c_to_f(100)); return 0; }}\n', ''),
+        ('{}', '10\n'),
+    ],
+    'JAVA': [
+        ('public class Main {{\n{}\npublic static void main(String[] args) {{ System.out.println(addMul(1, 2, 3)); }}\n}}\n', ''),
+        ('public class Main {{\n{}\npublic static void main(String[] args) {{ System.out.println(approx_const(3.14159f)); }}\n}}\n', ''),
+        ('public class Main {{\n{}\npublic static void main(String[] args) {{ System.out.println(c_to_f(100)); }}\n}}\n', ''),
+        ('{}', '10\n'),
+    ],
+    'MATLAB': [
+        ('1;\n{}\ndisp(addMul(1, 2, 3))\n', ''),
+        ('1;\n{}\ndisp(approx_const(3.14159))\n', ''),
+        ('1;\n{}\ndisp(c_to_f(100))\n', ''),
+        ('1;\n{}\ncrazy(10)\n', ''),
+    ]
+}
+
+
+def jobe_url(servers, resource):
+    '''Return the URL for the given REST resource on one of the given
+       ';'-separated Jobe servers (chosen at random, as jobesandbox does)
+    '''
+    jobe = random.choice([server.strip() for server in servers.split(';') if server.strip()])
+    base = jobe if jobe.startswith('http') else 'http://' + jobe
+    return base + '/jobe/index.php/restapi/' + resource
+
+
+def make_run_spec(language, question):
+    '''Return the Jobe run_spec for the given quiz_answers language and
+       question. As in jobesandbox, a Java program's file is named after its
+       public class (always Main here).
+    '''
+    language_id, extension = JOBE_LANGUAGES[language]
+    harness, stdin = TEST_HARNESSES[language][question]
+    run_spec = {
+        'language_id': language_id,
+        'sourcecode': harness.format(quiz_answers[language][question]),
+        'sourcefilename': 'Main.java' if language_id == 'java' else '__tester__.' + extension,
+        'input': stdin,
+        'file_list': []
+    }
+    if SANDBOX_PARAMS:
+        run_spec['parameters'] = SANDBOX_PARAMS
+    return run_spec
+
+
+def classify(status, response):
+    '''Return a short description of the outcome of a run given the HTTP
+       status and the decoded response body. Successful runs give ''.
+    '''
+    if status in (200, 203):
+        if not isinstance(response, dict) or 'outcome' not in response:
+            return 'bad response'
+        outcome = response['outcome']
+        return '' if outcome == RESULT_SUCCESS else OUTCOME_NAMES.get(outcome, 'outcome {}'.format(outcome))
+    elif status == 202:
+        return 'deferred (202)'
+    elif status == 503:
+        return 'overloaded (503)'
+    else:
+        return 'HTTP {}'.format(status)
+
+
+class JobeLoadTester:
+    '''Submits runs to Jobe and records the outcomes, also in the results
+       store Run results, if given'''
+    def __init__(self, jobe_servers, mix, api_key=JOBE_API_KEY, window_secs=WINDOW_SECS, results=None):
+        self.jobe_servers = jobe_servers
+        self.mix = mix   # Map from language to relative weight, as WORKLOAD_MIX
+        self.languages = sorted(mix)
+        self.headers = {'User-Agent': 'CodeRunner', 'Accept': 'application/json'}
+        if api_key:
+            self.headers['X-API-KEY'] = api_key
+        self.recorder = LatencyRecorder(window_secs)
+        self.outcomes = {}   # Map from (language, outcome) to count
+        self.results = results
+        self.session = None
+
+    def choose_job(self):
+        '''Return a random (language, question) pair from the workload, the
+           language chosen with the weights of the mix'''
+        language = random.choices(self.languages, weights=[self.mix[language] for language in self.languages])[0]
+        return language, random.randint(FIRST_QUESTION, FIRST_QUESTION + NUM_QUESTIONS - 1)
+
+    async def submit(self, language, question, start=None):
+        '''Submit one run, recording its latency (from start, if given, else
+           from when it is sent) and outcome. Returns the outcome ('' if OK).
+        '''
+        if start is None:
+            start = time.time()
+        job = {'run_spec': make_run_spec(language, question)}
+        try:
+            async with self.session.post(jobe_url(self.jobe_servers, 'runs'), json=job,
+                                         headers=self.headers) as response:
+                status = response.status
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = None
+            outcome = classify(status, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            outcome = 'connection error: ' + type(e).__name__
+        dt = time.time() - start
+        key = (language, outcome or 'ok')
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+        if outcome:
+            self.recorder.record_error(outcome, question, language)
+        else:
+            self.recorder.record(dt, question, language)
+        if self.results is not None:
+            self.results.record(None, question, language, dt, outcome)
+        return outcome
+
+    async def closed_loop(self, concurrency, duration):
+        '''Run concurrency clients, each submitting runs back-to-back for
+           duration secs, except for a pause after a connection error
+        '''
+        time_end = time.time() + duration
+
+        async def client():
+            while time.time() < time_end:
+                outcome = await self.submit(*self.choose_job())
+                if outcome.startswith('connection error'):
+                    await asyncio.sleep(CONNECTION_BACKOFF_SECS)
+
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+
+    async def open_loop(self, rate_per_sec, duration):
+        '''Submit runs as a Poisson process at the given rate (a number or a
+           function of elapsed time, see loadtestworkload.arrival_times) for
+           duration secs. Latency is measured from each run's scheduled time.
+        '''
+        time_start = time.time()
+        tasks = []
+        for scheduled in arrival_times(rate_per_sec, time_start, time_start + duration):
+            await asyncio.sleep(max(0, scheduled - time.time()))
+            language, question = self.choose_job()
+            tasks.append(asyncio.ensure_future(self.submit(language, question, start=scheduled)))
+        await asyncio.gather(*tasks)
+
+    async def run(self, rate_per_sec, concurrency, duration, monitor=None):
+        '''Run the load test, open-loop if rate_per_sec is given, else
+           closed-loop. If a ClientMonitor is given, it also measures the
+           event loop's lag.
+        '''
+        lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECS)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            self.recorder.start_time = time.time()
+            if rate_per_sec:
+                await self.open_loop(rate_per_sec, duration)
+            else:
+                await self.closed_loop(concurrency, duration)
+        if lag_watcher:
+            lag_watcher.cancel()
+
+    def print_report(self, elapsed, monitor=None):
+        '''Print latency percentiles, the load generator's resource use (if
+           monitored) and per-language throughput and outcomes'''
+        self.recorder.print_report()
+        if monitor is not None:
+            monitor.print_report(self.recorder)
+        all_outcomes = sorted(set(outcome for (language, outcome) in self.outcomes))
+        print('{:>10} {:>10}'.format('language', 'runs/sec') + ''.join(
+            ' {:>22}'.format(outcome) for outcome in all_outcomes))
+        for language in self.languages:
+            ok_runs = self.outcomes.get((language, 'ok'), 0)
+            print('{:>10} {:>10.2f}'.format(language, ok_runs / elapsed) + ''.join(
+                ' {:>22}'.format(self.outcomes.get((language, outcome), 0)) for outcome in all_outcomes))
+        print('total time: {:.0f} secs'.format(elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a Jobe server directly')
+    parser.add_argument('--jobe', default=JOBE_SERVER, help="Jobe host[:port] or URL, ';' separated if several")
+    parser.add_argument('--api-key', default=JOBE_API_KEY)
+    parser.add_argument('--languages', default=','.join('{}={}'.format(*item) for item in WORKLOAD_MIX.items()),
+                        help='Weighted quiz_answers languages, e.g. PYTHON3=60,C=40 (a bare language has weight 1)')
+    parser.add_argument('--duration', type=float, default=DURATION_SECS)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Open-loop arrival rate (runs/sec). If omitted, run closed-loop')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Closed-loop number of clients')
+    parser.add_argument('--save', default=None, help='File in which to save the latency histograms')
+    parser.add_argument('--db', default=RESULTS_DB, help='Results store in which to record every run')
+    parser.add_argument('--description', default='', help='Description of this test, for the results store')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    run = store.start_run('loadtestjobe.py', args.description, vars(args))
+    tester = JobeLoadTester(args.jobe, parse_mix(args.languages), args.api_key, results=run)
+    monitor = ClientMonitor().start()
+    before = time.time()
+    asyncio.run(tester.run(args.rate, args.concurrency, args.duration, monitor))
+    monitor.stop()
+    run.finish()
+    store.close()
+    tester.print_report(time.time() - before, monitor)
+    print('Results stored as run {} in {}'.format(run.run_id, args.db))
+    if args.save:
+        tester.recorder.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
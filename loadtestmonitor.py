@@ -0,0 +1,231 @@
+'''Self-monitoring of the machine generating the load.
+
+    If the load generator itself runs out of CPU (40 processes each parsing
+    full Moodle pages with mechanize, or one asyncio event loop driving
+    thousands of students), requests queue up on the client and the
+    latencies it reports are its own, not the server's. A ClientMonitor
+    samples, every SAMPLE_SECS from a background thread:
+
+      * the CPU use of the load tester's main process and of its whole
+        process tree (as a percentage of one core) and of the machine as a
+        whole (as a percentage of all cores);
+      * the resident memory of the process tree;
+      * the number of open sockets of the process tree;
+      * scheduling lag: how late the sampling thread wakes up, and, for the
+        asyncio engines, how late the event loop runs a timer (see
+        watch_event_loop).
+
+    The samples are then summarised per time window of the run's
+    LatencyRecorder, and any window in which the generator was saturated
+    (main process or machine CPU, or lag, over the limits below) is
+    flagged, since its latencies can't be trusted.
+
+    Process-tree figures come from /proc, so are Linux only; elsewhere only
+    the main process's own CPU time and (where the resource module exists,
+    i.e. not on Windows) peak memory are reported.
+'''
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLE_SECS = 1.0
+MAX_MAIN_CPU_PERCENT = 90      # Of one core: the asyncio event loop, or the results collector
+MAX_MACHINE_CPU_PERCENT = 90   # Of all cores together
+MAX_LAG_SECS = 0.1             # Thread or event-loop scheduling lag
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = resource.getpagesize() if resource else None
+HAVE_PROC = os.path.exists('/proc/self/stat')
+
+
+def read_process_stats():
+    '''Return a map from pid to (parent pid, cpu secs, rss bytes) for all
+       processes, read from /proc
+    '''
+    stats = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as infile:
+                fields = infile.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue  # Process has exited
+        # Fields after the command: state, ppid, ... utime (12), stime (13), ... rss (22)
+        stats[int(name)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+                            int(fields[21]) * PAGE_SIZE)
+    return stats
+
+
+def process_tree(stats, root):
+    '''Return the set of pids of the process root and all its descendants'''
+    children = {}
+    for pid, (ppid, _, _) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, todo = set(), [root]
+    while todo:
+        pid = todo.pop()
+        tree.add(pid)
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+def count_sockets(pids):
+    '''Return the number of open sockets of the given processes'''
+    count = 0
+    for pid in pids:
+        try:
+            fd_dir = '/proc/{}/fd'.format(pid)
+            for fd in os.listdir(fd_dir):
+                try:
+                    if os.readlink(os.path.join(fd_dir, fd)).startswith('socket:'):
+                        count += 1
+                except OSError:
+                    pass
+        except OSError:
+            pass
+    return count
+
+
+def machine_cpu_times():
+    '''Return the pair (busy, total) of machine-wide CPU clock ticks'''
+    with open('/proc/stat') as infile:
+        ticks = [int(field) for field in infile.readline().split()[1:]]
+    idle = ticks[3] + (ticks[4] if len(ticks) > 4 else 0)  # idle + iowait
+    return sum(ticks) - idle, sum(ticks)
+
+
+class Sample:
+    '''Load-generator resource use over one sampling interval'''
+    def __init__(self, when, main_cpu, tree_cpu, machine_cpu, rss, sockets, lag):
+        self.when = when
+        self.main_cpu = main_cpu        # Percent of one core
+        self.tree_cpu = tree_cpu        # Percent of one core, or None
+        self.machine_cpu = machine_cpu  # Percent of all cores, or None
+        self.rss = rss                  # Bytes
+        self.sockets = sockets          # Or None
+        self.lag = lag                  # Secs
+
+    def is_saturated(self):
+        return (self.main_cpu >= MAX_MAIN_CPU_PERCENT or self.lag >= MAX_LAG_SECS or
+                (self.machine_cpu is not None and self.machine_cpu >= MAX_MACHINE_CPU_PERCENT))
+
+
+class ClientMonitor:
+    '''Samples the load generator's own resource use from a background thread'''
+    def __init__(self, sample_secs=SAMPLE_SECS):
+        self.sample_secs = sample_secs
+        self.samples = []
+        self.loop_lag = 0.0   # Worst event-loop lag since the last sample
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._sample_periodically, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _cpu_and_memory(self):
+        '''Return (main cpu secs, tree cpu secs, tree rss bytes, tree pids)'''
+        if not HAVE_PROC:
+            times = os.times()
+            if resource is None:
+                return times.user + times.system, None, None, None
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return times.user + times.system, None, max_rss * (1 if sys.platform == 'darwin' else 1024), None
+        stats = read_process_stats()
+        pids = process_tree(stats, os.getpid())
+        return (stats[os.getpid()][1], sum(stats[pid][1] for pid in pids if pid in stats),
+                sum(stats[pid][2] for pid in pids if pid in stats), pids)
+
+    def _sample_periodically(self):
+        last_time = time.time()
+        last_main, last_tree, _, _ = self._cpu_and_memory()
+        last_machine = machine_cpu_times() if HAVE_PROC else None
+        while not self.stopping.is_set():
+            wake_time = last_time + self.sample_secs
+            self.stopping.wait(max(0, wake_time - time.time()))
+            now = time.time()
+            thread_lag = max(0, now - wake_time)
+            main, tree, rss, pids = self._cpu_and_memory()
+            interval = now - last_time
+            machine_cpu = None
+            if last_machine is not None:
+                machine = machine_cpu_times()
+                total = machine[1] - last_machine[1]
+                machine_cpu = 100.0 * (machine[0] - last_machine[0]) / total if total else 0.0
+                last_machine = machine
+            self.samples.append(Sample(
+                when=now,
+                main_cpu=100.0 * (main - last_main) / interval,
+                tree_cpu=max(0.0, 100.0 * (tree - last_tree) / interval) if tree is not None else None,  # < 0 if children exit
+                machine_cpu=machine_cpu,
+                rss=rss,
+                sockets=count_sockets(pids) if pids is not None else None,
+                lag=max(thread_lag, self.loop_lag)))
+            self.loop_lag = 0.0
+            last_time, last_main, last_tree = now, main, tree
+
+    async def watch_event_loop(self, interval=0.05):
+        '''Coroutine to run (as a task) in an asyncio engine's event loop,
+           measuring how late the loop runs a timer. Cancel it at the end.
+        '''
+        while True:
+            expected = time.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag = max(self.loop_lag, time.time() - expected)
+
+    def window_summary(self, recorder):
+        '''Return a sorted list of (window number, list of Samples) pairs,
+           using the windows of the given LatencyRecorder
+        '''
+        windows = {}
+        for sample in self.samples:
+            windows.setdefault(recorder.window(sample.when), []).append(sample)
+        return sorted(windows.items())
+
+    def saturated_windows(self, recorder):
+        '''Return a list of the numbers of the recorder's windows in which
+           the load generator was saturated
+        '''
+        return [window for (window, samples) in self.window_summary(recorder)
+                if any(sample.is_saturated() for sample in samples)]
+
+    def print_report(self, recorder):
+        '''Print the peak resource use in each of the recorder's windows,
+           flagging saturated windows. Returns the list of saturated windows.
+        '''
+        def peak(samples, attr, scale=1):
+            values = [getattr(sample, attr) for sample in samples if getattr(sample, attr) is not None]
+            return '{:.0f}'.format(max(values) * scale) if values else '-'
+
+        print('Load generator (peak per {}-second window)'.format(recorder.window_secs))
+        print('{:>14} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+            '', 'main cpu%', 'tree cpu%', 'host cpu%', 'rss MB', 'sockets', 'lag ms'))
+        saturated = []
+        for window, samples in self.window_summary(recorder):
+            flag = any(sample.is_saturated() for sample in samples)
+            if flag:
+                saturated.append(window)
+            print('{:>14} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}{}'.format(
+                '{}s'.format(window * recorder.window_secs), peak(samples, 'main_cpu'), peak(samples, 'tree_cpu'),
+                peak(samples, 'machine_cpu'), peak(samples, 'rss', 1 / 2 ** 20), peak(samples, 'sockets'),
+                peak(samples, 'lag', 1000), '  SATURATED' if flag else ''))
+        print()
+        if saturated:
+            print('*** WARNING: the load generator was saturated in {} window(s) ({}). '
+                  'Latencies there measure the client, not the server.'.format(
+                      len(saturated), ', '.join('{}s'.format(w * recorder.window_secs) for w in saturated)))
+            print()
+        return saturated
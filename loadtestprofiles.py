@@ -0,0 +1,267 @@
+#! /usr/bin/env python3
+
+'''Load profiles and capacity finding for the CodeRunner load testers.
+
+    A load profile describes how the offered load (the open-loop arrival
+    rate of submissions, per second) varies through a run, as a sequence of
+    stages, typically read from a JSON file such as
+
+        {"window_secs": 30,
+         "stages": [
+            {"type": "ramp", "from": 1, "to": 30, "duration": 600},
+            {"type": "step", "rates": [10, 20, 30], "step_secs": 120},
+            {"type": "spike", "rate": 5, "peak": 40, "spike_secs": 30, "duration": 300},
+            {"type": "soak", "rate": 10, "duration": 3600}
+         ]}
+
+    A ramp rises linearly, a step stage holds each rate for step_secs, a
+    spike holds the base rate except for spike_secs at the peak rate in the
+    middle of the stage, and a soak holds one rate for a long time.
+
+    The profile is run against a target, either a Jobe server directly
+    (loadtestjobe.py) or Moodle (the open-loop mode of loadtestasync.py,
+    configured from loadtesting3.py). The run is then cut into windows of
+    window_secs, and for each the offered rate, throughput (successful
+    submissions per second), p95 latency and error rate are tabulated. The
+    knee is the first window in which the server is saturated: either
+    throughput falls short of the offered rate while p95 latency climbs
+    well above its initial level, or the error rate exceeds a limit. The
+    capacity figure is the best throughput achieved below the knee.
+
+    Alternatively, --search does a bisection search for the highest
+    constant rate whose p95 latency and error rate meet a given SLO.
+
+    A saved LatencyRecorder can also be analysed offline against its profile
+    with --analyse.
+'''
+
+import argparse
+import collections
+import json
+
+WINDOW_SECS = 30
+KNEE_EFFICIENCY = 0.9       # Throughput below this fraction of offered load is falling short
+KNEE_LATENCY_FACTOR = 2.0   # p95 above this multiple of its initial value is climbing
+MAX_ERROR_RATE = 0.05       # Windows with a higher error rate than this are saturated
+TRIAL_SECS = 60             # Length of each trial in an SLO search
+SEARCH_ITERATIONS = 6
+
+WindowStats = collections.namedtuple('WindowStats',
+    ['start', 'offered', 'throughput', 'p95', 'error_rate', 'count'])
+
+
+class LoadProfile:
+    '''A sequence of load stages giving the offered rate as a function of time'''
+    def __init__(self, stages, window_secs=WINDOW_SECS):
+        self.stages = []  # List of (start time, duration, stage) triples
+        self.window_secs = window_secs
+        start = 0
+        for stage in stages:
+            duration = self.stage_duration(stage)
+            self.stages.append((start, duration, stage))
+            start += duration
+        self.duration = start
+
+    @staticmethod
+    def stage_duration(stage):
+        kind = stage.get('type')
+        if kind == 'step':
+            return len(stage['rates']) * stage['step_secs']
+        elif kind in ('ramp', 'spike', 'soak'):
+            return stage['duration']
+        else:
+            raise ValueError("Unknown load profile stage type '{}'".format(kind))
+
+    @classmethod
+    def load(cls, filename):
+        '''Read a profile from a JSON file'''
+        with open(filename) as infile:
+            spec = json.load(infile)
+        return cls(spec['stages'], spec.get('window_secs', WINDOW_SECS))
+
+    def rate_at(self, elapsed):
+        '''Return the offered rate (per second) at the given number of
+           seconds into the profile, or 0 outside it
+        '''
+        for start, duration, stage in self.stages:
+            if start <= elapsed < start + duration:
+                t = elapsed - start
+                kind = stage['type']
+                if kind == 'ramp':
+                    return stage['from'] + (stage['to'] - stage['from']) * t / duration
+                elif kind == 'step':
+                    return stage['rates'][int(t // stage['step_secs'])]
+                elif kind == 'spike':
+                    spike_start = (duration - stage['spike_secs']) / 2
+                    in_spike = spike_start <= t < spike_start + stage['spike_secs']
+                    return stage['peak'] if in_spike else stage['rate']
+                else:
+                    return stage['rate']
+        return 0
+
+    def mean_rate(self, start, end, samples=20):
+        '''Return the mean offered rate over the given time interval'''
+        step = (end - start) / samples
+        return sum(self.rate_at(start + (i + 0.5) * step) for i in range(samples)) / samples
+
+
+def window_stats(profile, recorder):
+    '''Return a list of WindowStats, one per window of the given
+       LatencyRecorder (which must have been started at the start of the
+       profile) lying wholly within the profile
+    '''
+    stats = []
+    window_secs = recorder.window_secs
+    for window in range(int(profile.duration // window_secs)):
+        hist = recorder.by_window.get(window)
+        ok = hist.total if hist else 0
+        errors = recorder.errors_by_window.get(window, 0)
+        start = window * window_secs
+        stats.append(WindowStats(
+            start=start,
+            offered=profile.mean_rate(start, start + window_secs),
+            throughput=ok / window_secs,
+            p95=hist.percentile(95) if hist else None,
+            error_rate=errors / (ok + errors) if ok + errors else 0,
+            count=ok + errors))
+    return stats
+
+
+def is_saturated(window, baseline_p95):
+    '''True if the given WindowStats show the server to be saturated'''
+    if window.error_rate > MAX_ERROR_RATE:
+        return True
+    falling_short = window.throughput < KNEE_EFFICIENCY * window.offered
+    climbing = window.p95 is None or window.p95 > KNEE_LATENCY_FACTOR * baseline_p95
+    return falling_short and climbing
+
+
+def find_knee(stats):
+    '''Return the pair (knee, capacity), where knee is the WindowStats of the
+       saturated window with the lowest offered rate (or None if the server
+       never saturated) and capacity is the best throughput achieved in any
+       window with a lower offered rate
+    '''
+    busy = [window for window in stats if window.offered > 0 and window.p95 is not None]
+    if not busy:
+        return None, 0
+    initial = busy[:max(1, len(busy) // 4)]
+    baseline_p95 = min(window.p95 for window in initial)
+    saturated = [window for window in stats if window.offered > 0 and is_saturated(window, baseline_p95)]
+    knee = min(saturated, key=lambda window: window.offered) if saturated else None
+    below_knee = [window.throughput for window in stats
+                  if knee is None or window.offered < knee.offered]
+    return knee, max(below_knee, default=0)
+
+
+def print_analysis(stats):
+    '''Print the per-window table, the knee and the capacity figure'''
+    knee, capacity = find_knee(stats)
+    print('{:>8} {:>9} {:>11} {:>8} {:>8} {:>7}'.format(
+        'start', 'offered/s', 'throughput', 'p95', 'errors', 'count'))
+    for window in stats:
+        print('{:>7}s {:>9.2f} {:>11.2f} {:>8} {:>7.1f}% {:>7}{}'.format(
+            window.start, window.offered, window.throughput,
+            '{:.3f}'.format(window.p95) if window.p95 is not None else '-',
+            100 * window.error_rate, window.count, '  <== knee' if window is knee else ''))
+    print()
+    if knee is None:
+        print('No saturation seen. Capacity is at least {:.2f}/sec'.format(capacity))
+    else:
+        print('Saturation first seen at an offered rate of {:.2f}/sec ({}s into the run)'.format(
+            knee.offered, knee.start))
+        print('Capacity: {:.2f}/sec ({:.0f}/min)'.format(capacity, 60 * capacity))
+    return knee, capacity
+
+
+def run_profile(target, rate, duration, window_secs, options):
+    '''Run the given rate (a number or a function of elapsed time, per
+       second) against the given target for duration secs. Return the
+       LatencyRecorder, with windows starting when arrivals start.
+    '''
+    if target == 'jobe':
+        import asyncio
+        from loadtestjobe import JobeLoadTester
+        from loadtestworkload import parse_mix
+        tester = JobeLoadTester(options.jobe, parse_mix(options.languages), window_secs=window_secs)
+        asyncio.run(tester.run(rate, None, duration))
+        return tester.recorder
+    else:
+        import loadtesting3
+        from loadtestasync import simulate_open_loop, LOGIN_RAMP_SECS
+        rate_per_min = (lambda elapsed: 60 * rate(elapsed)) if callable(rate) else 60 * rate
+        return simulate_open_loop(loadtesting3.NUM_STUDENTS, rate_per_min,
+                                  LOGIN_RAMP_SECS + duration, window_secs)
+
+
+def search_max_rate(run_trial, low, high, slo_p95, max_error_rate=MAX_ERROR_RATE,
+                    iterations=SEARCH_ITERATIONS):
+    '''Bisection search between low and high for the highest constant rate
+       at which the p95 latency is at most slo_p95 and the error rate at
+       most max_error_rate. run_trial(rate) must run a trial at the given
+       rate and return its LatencyRecorder. Returns the best rate found, or
+       None if even low failed.
+    '''
+    best = None
+    for _ in range(iterations):
+        rate = (low + high) / 2 if best is not None or low == 0 else low
+        recorder = run_trial(rate)
+        p95 = recorder.overall.percentile(95)
+        ok_count = recorder.overall.total
+        error_rate = recorder.num_errors() / max(1, ok_count + recorder.num_errors())
+        meets_slo = p95 is not None and p95 <= slo_p95 and error_rate <= max_error_rate
+        print('Trial at {:.2f}/sec: p95 {}, errors {:.1f}% - {}'.format(
+            rate, '{:.3f}'.format(p95) if p95 is not None else '-', 100 * error_rate,
+            'meets SLO' if meets_slo else 'FAILS SLO'))
+        if meets_slo:
+            best = rate
+            low = rate
+        elif best is None and rate == low:
+            return None
+        else:
+            high = rate
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a load profile and find the saturation knee')
+    parser.add_argument('profile', nargs='?', help='JSON load profile file')
+    parser.add_argument('--target', choices=['jobe', 'moodle'], default='jobe')
+    parser.add_argument('--jobe', default='localhost:4000', help='Jobe server(s), for --target jobe')
+    parser.add_argument('--languages', default='PYTHON3,C', help='Weighted languages, e.g. PYTHON3=60,C=40, for --target jobe')
+    parser.add_argument('--save', help='File in which to save the run\'s latency histograms')
+    parser.add_argument('--analyse', metavar='HISTOGRAMS',
+                        help='Analyse saved histograms against the profile instead of running it')
+    parser.add_argument('--search', metavar='LOW,HIGH', help='Search for the highest rate meeting the SLO')
+    parser.add_argument('--slo-p95', type=float, default=2.0, help='p95 latency SLO in secs, for --search')
+    parser.add_argument('--max-error-rate', type=float, default=MAX_ERROR_RATE)
+    parser.add_argument('--trial-secs', type=float, default=TRIAL_SECS)
+    parser.add_argument('--iterations', type=int, default=SEARCH_ITERATIONS)
+    args = parser.parse_args()
+
+    if args.search:
+        low, high = [float(rate) for rate in args.search.split(',')]
+        best = search_max_rate(
+            lambda rate: run_profile(args.target, rate, args.trial_secs, WINDOW_SECS, args),
+            low, high, args.slo_p95, args.max_error_rate, args.iterations)
+        if best is None:
+            print('Even {:.2f}/sec fails the SLO'.format(low))
+        else:
+            print('Capacity at p95 <= {:.2f} secs: {:.2f}/sec ({:.0f}/min)'.format(args.slo_p95, best, 60 * best))
+        return
+
+    if not args.profile:
+        parser.error('A profile is required unless using --search')
+    profile = LoadProfile.load(args.profile)
+    if args.analyse:
+        from loadtesthistogram import LatencyRecorder
+        recorder = LatencyRecorder.load(args.analyse)
+    else:
+        recorder = run_profile(args.target, profile.rate_at, profile.duration, profile.window_secs, args)
+        if args.save:
+            recorder.save(args.save)
+    print_analysis(window_stats(profile, recorder))
+
+
+if __name__ == '__main__':
+    main()
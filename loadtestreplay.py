@@ -0,0 +1,230 @@
+#! /usr/bin/env python3
+
+'''Replay real quiz traffic against a CodeRunner server.
+
+    Turns one or more quiz-attempt downloads (the CSV files read by
+    quizsubmissions.py) into a load schedule: every Precheck and Check
+    click of every student, with the answer they actually submitted, at
+    the time they clicked, optionally compressed in time by a speed-up
+    factor. Synthetic Poisson traffic misses the bursts around deadlines
+    and the end of an exam; a replay reproduces them.
+
+    Each real student is mapped to one of the load-testing students of
+    loadtesting3.py (student0, student1, ...; if there are more real
+    students than NUM_STUDENTS they are shared round robin) and each real
+    question to one of its LoadTesting quizzes, cycling through them. The
+    answers are therefore graded against the load-testing questions, so
+    most are marked wrong, but they are still compiled and run, which is
+    the load that matters. A submission counts as successful if it is
+    graded at all. The downloads don't record the questions' languages, so
+    every answer is submitted to the LANGUAGE (of loadtesting3.py) quizzes,
+    graded as that language and recorded under it: replay downloads of
+    quizzes in that language.
+
+    Each virtual student works through its own events in order, navigating
+    to the next question ahead of time so that the click itself happens
+    on schedule. As in the open-loop mode of loadtestasync.py, latency is
+    measured from the scheduled click time, so a student who falls behind
+    shows up as increased latency rather than a quietly reduced load.
+
+    By default each download is aligned to start at time 0, so several
+    downloads (e.g. the labs of several streams) are overlaid; use
+    --no-align to keep their absolute timestamps.
+
+        python3 loadtestreplay.py exam.csv --speedup 6
+        python3 loadtestreplay.py lab1.csv lab2.csv --speedup 10 --dry-run
+
+    Requires aiohttp (pip3 install aiohttp) and, through loadtesting3.py,
+    mechanize, except for --dry-run.
+'''
+
+import argparse
+import asyncio
+import collections
+import time
+
+from loadtesthistogram import LatencyRecorder
+from loadtestresults import ResultsStore, RESULTS_DB, error_excerpt
+from loadtesttrace import start_trace, finish_trace
+from loadtestmonitor import ClientMonitor
+from loadtestworkload import NUM_QUESTIONS, FIRST_QUESTION
+from quizsubmissions import read_quiz_attempts
+
+SPEEDUP = 1.0
+REPLAYED_ACTIONS = ('precheck', 'submit')
+
+ReplayEvent = collections.namedtuple('ReplayEvent', ['time', 'email', 'qnum', 'action', 'answer'])
+
+
+def load_events(filenames, align=True):
+    '''Return a time-ordered list of ReplayEvents for all the Precheck and
+       Check clicks (with an answer) in the given quiz-attempt downloads.
+       Times are in seconds from the first event. If align is true, each
+       file's events are shifted to start at time 0.
+    '''
+    events = []
+    for filename in filenames:
+        file_events = []
+        for quiz_attempt in read_quiz_attempts(filename):
+            email = quiz_attempt.email
+            for qnum, question_attempt in quiz_attempt.submissions.items():
+                for step in question_attempt.steps:
+                    if step.action in REPLAYED_ACTIONS and step.answer is not None:
+                        file_events.append(ReplayEvent(step.time, email, qnum, step.action, step.answer))
+        if align and file_events:
+            offset = min(event.time for event in file_events)
+            file_events = [event._replace(time=event.time - offset) for event in file_events]
+        events.extend(file_events)
+    events.sort()
+    if events:
+        first = events[0].time
+        events = [event._replace(time=event.time - first) for event in events]
+    return events
+
+
+def assign_students(events, num_students, start_student):
+    '''Return a map from virtual student number to the list of events that
+       student is to replay. Real students are given virtual student
+       numbers from start_student in order of their first event, round
+       robin over num_students.
+    '''
+    virtual = {}
+    schedule = collections.defaultdict(list)
+    for event in events:
+        if event.email not in virtual:
+            virtual[event.email] = start_student + len(virtual) % num_students
+        schedule[virtual[event.email]].append(event)
+    if len(virtual) > num_students:
+        print('*** Warning: {} real students are sharing {} virtual students'.format(len(virtual), num_students))
+    return schedule
+
+
+def load_test_question(qnum):
+    '''The LoadTesting question onto which real question qnum is replayed'''
+    return FIRST_QUESTION + (qnum - 1) % NUM_QUESTIONS
+
+
+def print_schedule_summary(events, speedup):
+    '''Print the size and shape of the replay schedule'''
+    if not events:
+        print('Nothing to replay')
+        return
+    span = events[-1].time / speedup
+    per_minute = collections.Counter(int(event.time / speedup // 60) for event in events)
+    actions = collections.Counter(event.action for event in events)
+    print('{} events ({}) from {} students over {:.0f} mins, replayed in {:.1f} mins'.format(
+        len(events), ', '.join('{} {}'.format(n, action) for (action, n) in sorted(actions.items())),
+        len(set(event.email for event in events)), events[-1].time / 60, span / 60))
+    busiest_minute, busiest_count = per_minute.most_common(1)[0]
+    print('Mean replay rate {:.1f}/min, peak {}/min (in minute {})'.format(
+        len(events) / max(span / 60, 1 / 60), busiest_count, busiest_minute))
+
+
+async def replay_student(student_num, events, replay_start, speedup, login_delay, connector, recorder, run):
+    '''Log the given virtual student in and replay their events'''
+    import aiohttp
+    import loadtesting3 as lt
+    from loadtestasync import VirtualStudent, login, prepare_question, submit_check, LinkNotFoundError
+    await asyncio.sleep(login_delay)
+    student = VirtualStudent(student_num, connector)
+    try:
+        await login(student)
+        for event in events:
+            question = load_test_question(event.qnum)
+            scheduled = replay_start + event.time / speedup
+            details = {}
+            try:
+                nav_start = time.time()
+                form, button = await prepare_question(student, question, event.answer, event.action)
+                details['nav_secs'] = time.time() - nav_start
+                await asyncio.sleep(max(0, scheduled - time.time()))
+                dt, err = await submit_check(student, form, button, start=scheduled)
+                details['check_secs'] = dt
+                if err == 'Wrong answer':
+                    err = ''  # Graded, which is all we need
+                elif err:
+                    details['excerpt'] = error_excerpt(student.html)
+            except (aiohttp.ClientError, asyncio.TimeoutError, LinkNotFoundError, IndexError) as e:
+                dt = time.time() - scheduled
+                err = 'Request failed: {!r}'.format(e)
+            if err:
+                recorder.record_error(err, question, lt.LANGUAGE)
+            else:
+                recorder.record(dt, question, lt.LANGUAGE)
+            if run is not None:
+                run.record(student_num, question, lt.LANGUAGE, dt, err, details)
+            print('Student{}, Q{} {}: dt = {:.2f} {}'.format(
+                student_num, question, event.action, dt, 'FAIL' if err else 'OK'))
+    except (aiohttp.ClientError, asyncio.TimeoutError, IndexError, ValueError) as e:
+        print("OOPS - student{} replay broke: {!r}".format(student_num, e))
+        recorder.record_error('Replay broke', -1, lt.LANGUAGE)
+    finally:
+        await student.close()
+
+
+async def run_replay(events, speedup, run, monitor):
+    '''Coroutine that does the work of replay'''
+    import loadtesting3 as lt
+    from loadtestasync import make_connector, LOGIN_RAMP_SECS
+    lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+    schedule = assign_students(events, lt.NUM_STUDENTS, lt.START_STUDENT)
+    connector = make_connector()
+    replay_start = time.time() + LOGIN_RAMP_SECS
+    recorder = LatencyRecorder(start_time=replay_start)
+    await asyncio.gather(*[
+        replay_student(student_num, student_events, replay_start, speedup,
+                       LOGIN_RAMP_SECS * i / len(schedule), connector, recorder, run)
+        for i, (student_num, student_events) in enumerate(sorted(schedule.items()))])
+    await connector.close()
+    if lag_watcher:
+        lag_watcher.cancel()
+    return recorder
+
+
+def replay(events, speedup=SPEEDUP, run=None, monitor=None):
+    '''Replay the given events, speeded up by the given factor. Returns a
+       LatencyRecorder of the results, with windows starting at the start of
+       the replay. Each result is also recorded in the results store Run
+       run, if given, and the event loop's lag is measured by the
+       ClientMonitor monitor, if given.
+    '''
+    return asyncio.run(run_replay(events, speedup, run, monitor))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay real quiz submissions against a server')
+    parser.add_argument('downloads', nargs='+', help='Quiz attempt download (.csv) files')
+    parser.add_argument('--speedup', type=float, default=SPEEDUP, help='Time compression factor')
+    parser.add_argument('--no-align', action='store_true', help="Keep each download's absolute times")
+    parser.add_argument('--dry-run', action='store_true', help='Just summarise the replay schedule')
+    parser.add_argument('--save', help="File in which to save the replay's latency histograms")
+    parser.add_argument('--db', default=RESULTS_DB, help='Results store in which to record every submission')
+    parser.add_argument('--trace', default=None,
+                        help='File to which to write a trace of every request (default: TRACE_FILE of loadtesting3.py)')
+    args = parser.parse_args()
+
+    events = load_events(args.downloads, align=not args.no_align)
+    print_schedule_summary(events, args.speedup)
+    if args.dry_run or not events:
+        return
+    import loadtesting3 as lt  # Needs mechanize, so only imported for a real replay
+    store = ResultsStore(args.db)
+    run = store.start_run('loadtestreplay.py', ' '.join(args.downloads), vars(args))
+    if args.trace:
+        lt.TRACE_FILE = args.trace
+    start_trace(lt.TRACE_FILE)
+    monitor = ClientMonitor().start()
+    before = time.time()
+    recorder = replay(events, args.speedup, run, monitor)
+    monitor.stop()
+    run.finish()
+    store.close()
+    finish_trace(lt.TRACE_FILE)
+    lt.print_summary(recorder, time.time() - before, monitor)
+    print('Results stored as run {} in {}'.format(run.run_id, args.db))
+    if args.save:
+        recorder.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+
+'''Append-only store of CodeRunner load-test results.
+
+    Every request made by a load tester is recorded as one row of an SQLite
+    database: run id, completion time, student, question, language, the
+    reported latency, the time spent navigating to the question and in the
+    Check request itself, a status class ('ok', 'wrong', 'server error',
+    'request failed', ...), the expected grading-cache outcome ('hit' or
+    'miss', if known), the kind of answer submitted ('correct', 'slow' or
+    'failing', if known) and a truncated excerpt of any error (not the
+    whole error page). Each run also has a row recording the tool that made
+    it, a description and its configuration.
+
+    Rows are written in batches by a background thread, so recording a
+    result on the hot path is just a queue put.
+
+    >>> store = ResultsStore('loadtestresults.sqlite')
+    >>> run = store.start_run('loadtesting3.py', 'Exam rehearsal', {'students': 200})
+    >>> run.record(student=3, question=1, language='PYTHON3', latency=1.2, error='')
+    >>> run.finish()
+    >>> store.close()
+
+    Run as a program it queries a store without loading it into memory:
+
+        python3 loadtestresults.py runs
+        python3 loadtestresults.py report 3 4 --by language
+        python3 loadtestresults.py errors 3
+        python3 loadtestresults.py compare 3 4 --by question
+
+    The compare command (Python 3 only; see loadtestcompare.py) tests
+    whether a candidate run is significantly slower than a baseline run,
+    exiting with status 1 if it regressed beyond the given thresholds.
+
+    Works with both Python 2 (loadtesting.py) and Python 3.
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+RESULTS_DB = 'loadtestresults.sqlite'
+BATCH_SIZE = 500          # Rows written per transaction, at most
+FLUSH_SECS = 1.0          # Maximum time a row waits to be written
+EXCERPT_CHARS = 500       # Error excerpts are truncated to this length
+PERCENTILES = [50, 90, 95, 99]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    tool TEXT,
+    description TEXT,
+    config TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS requests (
+    run_id INTEGER,
+    time REAL,
+    student INTEGER,
+    question INTEGER,
+    language TEXT,
+    latency REAL,
+    nav_secs REAL,
+    check_secs REAL,
+    status TEXT,
+    error TEXT,
+    cache TEXT,
+    kind TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_by_run ON requests (run_id, status, latency);
+'''
+
+# Columns added since the first version of the schema, with their types
+ADDED_COLUMNS = [('cache', 'TEXT'), ('kind', 'TEXT')]
+
+INSERT = 'INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+
+def status_class(error):
+    '''Return the status class of a result, given its error message'''
+    if not error:
+        return 'ok'
+    elif error == 'Wrong answer':
+        return 'wrong'
+    elif error.startswith('****Serious error'):
+        return 'server error'
+    elif error.startswith('Request failed') or error.startswith('Navigation failed'):
+        return 'request failed'
+    elif error.startswith('OOPS'):
+        return 'broken'
+    elif 'overload' in error:
+        return 'overload'
+    else:
+        return 'error'
+
+
+def error_excerpt(page, max_chars=EXCERPT_CHARS):
+    '''Return the start of the visible text of an HTML error page'''
+    text = re.sub(r'(?is)<(script|style)\b.*?</\1>', ' ', page)
+    text = re.sub(r'<[^>]*>', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()[:max_chars]
+
+
+def connect(filename):
+    '''Return a connection to the given store, creating it if necessary'''
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(requests)')]
+    for column, column_type in ADDED_COLUMNS:
+        if column not in columns:
+            connection.execute('ALTER TABLE requests ADD COLUMN {} {}'.format(column, column_type))
+    return connection
+
+
+class Run(object):
+    '''A handle for recording the requests of one run in a ResultsStore'''
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+
+    def record(self, student=None, question=None, language=None, latency=None, error='',
+               details=None, when=None):
+        '''Queue a result for writing. details is an optional dictionary
+           that may have keys nav_secs, check_secs, status, cache, kind and
+           excerpt.
+        '''
+        details = details or {}
+        error_text = error
+        if details.get('excerpt'):
+            error_text = error + ': ' + details['excerpt']
+        self.store.queue_row((
+            self.run_id, time.time() if when is None else when, student, question, language, latency,
+            details.get('nav_secs'), details.get('check_secs'),
+            details.get('status') or status_class(error),
+            error_text[:EXCERPT_CHARS] if error_text else None,
+            details.get('cache'), details.get('kind')))
+
+    def finish(self):
+        '''Record the run's finishing time'''
+        self.store.flush()
+        with self.store.connection:
+            self.store.connection.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self.run_id))
+
+
+class ResultsStore(object):
+    '''An SQLite store of load-test runs and requests with a background
+       writer thread
+    '''
+    def __init__(self, filename=RESULTS_DB):
+        self.filename = filename
+        self.connection = connect(filename)
+        self.rows = queue.Queue()
+        self.flushed = threading.Condition()
+        self.queued = 0    # Rows queued so far
+        self.written = 0   # Rows written so far
+        self.closing = False
+        self.writer = threading.Thread(target=self._write_rows)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def start_run(self, tool, description='', config=None):
+        '''Create a new run and return a Run handle for it'''
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (tool, description, config, started) VALUES (?, ?, ?, ?)',
+                (tool, description, json.dumps(config or {}, default=str), time.time()))
+        return Run(self, cursor.lastrowid)
+
+    def queue_row(self, row):
+        '''Queue a row of the requests table for the writer thread'''
+        with self.flushed:
+            self.queued += 1
+        self.rows.put(row)
+
+    def _write_rows(self):
+        '''Writer thread: write queued rows in batches'''
+        connection = connect(self.filename)
+        while True:
+            batch = []
+            deadline = time.time() + FLUSH_SECS
+            while len(batch) < BATCH_SIZE:
+                try:
+                    row = self.rows.get(timeout=max(0.01, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    self.closing = True
+                    break
+                batch.append(row)
+            if batch:
+                with connection:
+                    connection.executemany(INSERT, batch)
+            with self.flushed:
+                self.written += len(batch)
+                self.flushed.notify_all()
+            if self.closing and self.rows.empty():
+                connection.close()
+                return
+
+    def flush(self):
+        '''Wait until every row queued so far has been written'''
+        with self.flushed:
+            target = self.queued
+            while self.written < target and self.writer.is_alive():
+                self.flushed.wait(FLUSH_SECS)
+
+    def close(self):
+        '''Write all queued rows and stop the writer thread'''
+        self.rows.put(None)
+        self.writer.join()
+        self.connection.close()
+
+
+# ===== Queries =====
+
+def run_ids_clause(run_ids):
+    return 'run_id IN ({})'.format(', '.join('?' * len(run_ids)))
+
+
+def percentiles(connection, where, params, count, percents=PERCENTILES):
+    '''Return the given percentiles of the latencies of the (count) rows
+       matching where, fetching one row per percentile rather than all rows
+    '''
+    values = []
+    for percent in percents:
+        if count == 0:
+            values.append(None)
+            continue
+        offset = min(count - 1, max(0, int(round(percent / 100.0 * count)) - 1))
+        row = connection.execute(
+            'SELECT latency FROM requests WHERE {} ORDER BY latency LIMIT 1 OFFSET ?'.format(where),
+            list(params) + [offset]).fetchone()
+        values.append(row[0] if row else None)
+    return values
+
+
+def group_latencies(connection, run_ids, group_by, limit=None, column='latency'):
+    '''Yield (group, values) for each distinct value of the column group_by
+       (or a single group 'all' if None) in the given runs, where values is
+       a list of up to limit (default all) successful latencies (or other
+       values of the given column or SQL expression)
+    '''
+    where = run_ids_clause(run_ids) + " AND status = 'ok'"
+    if group_by is None:
+        groups = [('all', where, list(run_ids))]
+    else:
+        keys = [row[0] for row in connection.execute(
+            'SELECT DISTINCT {0} FROM requests WHERE {1} ORDER BY {0}'.format(group_by, where), run_ids)]
+        groups = [(key, where + ' AND {} IS ?'.format(group_by), list(run_ids) + [key]) for key in keys]
+    for key, group_where, params in groups:
+        sql = 'SELECT {} FROM requests WHERE {} ORDER BY random()'.format(column, group_where)
+        if limit:
+            sql += ' LIMIT {}'.format(int(limit))
+        yield key, [row[0] for row in connection.execute(sql, params)]
+
+
+def print_runs(connection):
+    '''List all the runs in the store'''
+    print('{:>4} {:>19} {:>8} {:>8} {:>7}  {:<16} {}'.format(
+        'run', 'started', 'secs', 'requests', 'ok %', 'tool', 'description'))
+    for run_id, tool, description, started, finished in connection.execute(
+            'SELECT id, tool, description, started, finished FROM runs ORDER BY id'):
+        total, ok = connection.execute(
+            "SELECT COUNT(*), SUM(status = 'ok') FROM requests WHERE run_id = ?", (run_id,)).fetchone()
+        print('{:>4} {:>19} {:>8} {:>8} {:>7}  {:<16} {}'.format(
+            run_id, time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(started)),
+            '{:.0f}'.format(finished - started) if finished else '-', total,
+            '{:.1f}'.format(100.0 * ok / total) if total else '-', tool, description))
+
+
+def print_report(connection, run_ids, group_by=None):
+    '''Print counts, throughput and latency percentiles of successful
+       requests across the given runs, grouped by the given column
+    '''
+    where = run_ids_clause(run_ids)
+    secs = connection.execute(
+        'SELECT SUM(finished - started) FROM runs WHERE id IN ({})'.format(', '.join('?' * len(run_ids))),
+        run_ids).fetchone()[0]
+    group_column = group_by or "'all'"
+    print('{:>10} {:>8} {:>8} {:>8}'.format(group_by or '', 'requests', 'ok', 'ok/sec') + ''.join(
+        '{:>9}'.format('p' + str(percent)) for percent in PERCENTILES))
+    rows = connection.execute(
+        "SELECT {0}, COUNT(*), SUM(status = 'ok') FROM requests WHERE {1} GROUP BY {0} ORDER BY {0}".format(
+            group_column, where), run_ids).fetchall()
+    for key, total, ok in rows:
+        if group_by:
+            ok_where, params = where + " AND status = 'ok' AND {} IS ?".format(group_by), list(run_ids) + [key]
+        else:
+            ok_where, params = where + " AND status = 'ok'", list(run_ids)
+        values = percentiles(connection, ok_where, params, ok)
+        print('{:>10} {:>8} {:>8} {:>8}'.format(
+            str(key), total, ok, '{:.2f}'.format(ok / secs) if secs else '-') + ''.join(
+            '{:>9.3f}'.format(value) if value is not None else '{:>9}'.format('-') for value in values))
+    print()
+    print('Status classes:')
+    for status, count in connection.execute(
+            'SELECT status, COUNT(*) FROM requests WHERE {} GROUP BY status ORDER BY COUNT(*) DESC'.format(where),
+            run_ids):
+        print('{:>16} {:>8}'.format(status, count))
+
+
+def print_errors(connection, run_ids, limit=20):
+    '''Print the commonest error excerpts in the given runs'''
+    for status, error, count in connection.execute(
+            '''SELECT status, substr(error, 1, 100), COUNT(*) FROM requests
+               WHERE {} AND status != 'ok' GROUP BY status, substr(error, 1, 100)
+               ORDER BY COUNT(*) DESC LIMIT ?'''.format(run_ids_clause(run_ids)),
+            list(run_ids) + [limit]):
+        print('{:>7} {:<16} {}'.format(count, status, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a store of load-test results')
+    parser.add_argument('--db', default=RESULTS_DB, help='The results store')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('runs', help='List all runs')
+    report = commands.add_parser('report', help='Latency percentiles and throughput of one or more runs')
+    report.add_argument('run_ids', type=int, nargs='+')
+    report.add_argument('--by', choices=['question', 'language', 'student', 'cache', 'kind'], default=None)
+    errors = commands.add_parser('errors', help='The commonest errors in one or more runs')
+    errors.add_argument('run_ids', type=int, nargs='+')
+    compare = commands.add_parser('compare', help='Test a candidate run against a baseline run for regressions')
+    compare.add_argument('baseline', type=int)
+    compare.add_argument('candidate', type=int)
+    compare.add_argument('--by', choices=['question', 'language', 'cache', 'kind'], default=None)
+    compare.add_argument('--max-p95-increase', type=float, default=10.0, help='Percent (default 10)')
+    compare.add_argument('--max-throughput-decrease', type=float, default=10.0, help='Percent (default 10)')
+    args = parser.parse_args()
+
+    connection = connect(args.db)
+    if args.command == 'compare':
+        from loadtestcompare import compare_runs
+        sys.exit(compare_runs(connection, args.baseline, args.candidate, args.by,
+                              args.max_p95_increase, args.max_throughput_decrease))
+    elif args.command == 'report':
+        print_report(connection, args.run_ids, args.by)
+    elif args.command == 'errors':
+        print_errors(connection, args.run_ids)
+    else:
+        print_runs(connection)
+
+
+if __name__ == '__main__':
+    main()
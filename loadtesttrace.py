@@ -0,0 +1,103 @@
+'''Per-request tracing for the CodeRunner load testers.
+
+    When tracing is on (TRACE_FILE in loadtesting3.py), every HTTP request
+    a virtual student makes is recorded as a span: its phase (login,
+    navigate, start attempt, check, precheck, finish attempt, submit all,
+    review), student, question, start time, duration, HTTP status and
+    response size.
+    At the end of the run the spans are written to TRACE_FILE in the Chrome
+    trace-event format, which loads in chrome://tracing or
+    https://ui.perfetto.dev, with one track per student. That shows where a
+    slow submission spent its time, and whether students were all stalled
+    at once (e.g. head-of-line blocking on a shared connection or lock).
+
+    While the run is in progress, spans are appended one per line to
+    TRACE_FILE + EVENTS_SUFFIX by whichever process (or coroutine) makes
+    the request, so the processes of the multiprocessing engines can all
+    trace into the same file.
+
+    Works with both Python 2 (loadtesting.py) and Python 3.
+
+    >>> start_trace('trace.json')
+    >>> tracer_for('trace.json').span('check', 3, 1, time.time() - 1.5, 1.5, 200, 51234)
+    >>> finish_trace('trace.json')
+'''
+
+from __future__ import division, print_function
+
+import json
+import os
+
+EVENTS_SUFFIX = '.events'
+TRACE_PID = 1  # All students are shown as threads of a single process
+
+_tracers = {}  # Map from (process id, trace filename) to that process's Tracer
+
+
+class Tracer(object):
+    '''Appends spans to an events file, one JSON object per line'''
+    def __init__(self, events_filename):
+        self.outfile = open(events_filename, 'a', 1)  # Line buffered, so each span is a single write
+
+    def span(self, phase, student, question, start, duration, status=None, size=None, error=None):
+        '''Record a span of the given phase that started at time start and
+           took duration secs. status is the HTTP status and size the
+           response size in bytes, if known; error describes any failure.
+        '''
+        args = {'question': question, 'status': status, 'bytes': size}
+        if error:
+            args['error'] = error
+        self.outfile.write(json.dumps({
+            'name': phase, 'cat': 'request', 'ph': 'X', 'pid': TRACE_PID, 'tid': student,
+            'ts': int(start * 1e6), 'dur': int(duration * 1e6), 'args': args}) + '\n')
+
+    def close(self):
+        self.outfile.close()
+
+
+def tracer_for(filename):
+    '''Return this process's Tracer for the given trace file, or None if
+       filename is None (tracing off)
+    '''
+    if not filename:
+        return None
+    key = (os.getpid(), filename)
+    if key not in _tracers:
+        _tracers[key] = Tracer(filename + EVENTS_SUFFIX)
+    return _tracers[key]
+
+
+def start_trace(filename):
+    '''Discard any spans left over from an earlier run traced to filename'''
+    if filename:
+        open(filename + EVENTS_SUFFIX, 'w').close()
+
+
+def finish_trace(filename):
+    '''Write the spans recorded for the given trace file, by all processes,
+       to that file in Chrome trace-event format (the JSON object format,
+       written one event at a time so the spans needn't fit in memory)
+    '''
+    if not filename:
+        return
+    tracer = _tracers.pop((os.getpid(), filename), None)
+    if tracer is not None:
+        tracer.close()
+    events_filename = filename + EVENTS_SUFFIX
+    students = set()
+    with open(events_filename) as infile, open(filename, 'w') as outfile:
+        outfile.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        outfile.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': TRACE_PID,
+                                  'args': {'name': 'Virtual students'}}))
+        for line in infile:
+            if not line.endswith('\n'):
+                continue  # Truncated by a process being killed
+            event = json.loads(line)
+            students.add(event['tid'])
+            outfile.write(',\n' + line.rstrip('\n'))
+        for student in sorted(students, key=str):
+            outfile.write(',\n' + json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': TRACE_PID, 'tid': student,
+                                              'args': {'name': 'student{}'.format(student)}}))
+        outfile.write('\n]}\n')
+    os.remove(events_filename)
+    print('Trace of {} students written to {}'.format(len(students), filename))
@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+
+'''Load tester for CodeRunner's sandbox web service.
+
+    The scratchpad UI's Run button calls the qtype_coderunner_run_in_sandbox
+    web service (classes/external/run_in_sandbox.php) through Moodle's AJAX
+    endpoint, lib/ajax/service.php, which is the path taken by core/ajax
+    calls from amd/src/outputdisplayarea.js. Unlike Check, those runs are
+    never graded or cached, and they're limited per user (actually per
+    Moodle session) by qtype_coderunner_wsthrottle to wsmaxhourlyrate runs
+    in any hour, and each to wsmaxcputime secs of CPU time.
+
+    Here each virtual student logs in, opens the course page (to get the
+    session key and a context in which students have the
+    qtype/coderunner:sandboxwsaccess capability) and then makes web-service
+    runs as a Poisson process at RUNS_PER_MIN runs per minute, without
+    waiting for earlier runs to finish, so a student can have several runs
+    in progress at once. Each run is a randomised answer from quiz_answers
+    plus a line of scratchpad code, inserted into a wrapper as the
+    scratchpad UI does (default: the input_wrapper_json.py wrapper from the
+    tests), and is run as python3. Latency is measured from each run's
+    scheduled time.
+
+    Responses are classified as OK, throttled (the wssubmissionrateexceeded
+    error), refused for other reasons (e.g. too much CPU time requested),
+    sandbox overload, or failed. Throttled runs are counted as errors in
+    the latency report, so the report gives the throttled fraction
+    overall and per time window. The throttle is also checked: as each
+    student has a new session, in a test of up to an hour it should
+    accept exactly MAX_HOURLY_RATE runs (the server's wsmaxhourlyrate
+    setting, which must be given, as the client can't read it) from any
+    student making more than that, and throttle the rest. Runs that failed
+    (e.g. connection errors) may or may not have been counted by the
+    throttle, so are allowed for either way. Students for whom the
+    throttle was wrong are listed: the throttle's state is kept in the
+    Moodle session, so concurrent runs that weren't serialised by the
+    session lock could lose each other's updates.
+
+    Server, course, students and answers are taken from loadtesting3.py.
+    The web service must be enabled (the wsenabled setting).
+
+        python3 loadtestwebservice.py --users 20 --rate 30 --duration 300 --max-hourly-rate 100
+
+    Requires aiohttp (pip3 install aiohttp).
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from urllib.parse import urljoin
+
+import aiohttp
+
+import loadtesting3 as lt
+from loadtestasync import VirtualStudent, LinkNotFoundError, login, make_connector, arrival_times
+from loadtesthistogram import LatencyRecorder
+from loadtestresults import ResultsStore, RESULTS_DB
+from loadtesttrace import start_trace, finish_trace
+from loadtestmonitor import ClientMonitor
+
+NUM_USERS = lt.NUM_STUDENTS
+RUNS_PER_MIN = 10            # Per user
+DURATION_SECS = 120
+LOGIN_RAMP_SECS = 30         # User logins are spread uniformly over this time, before the runs start
+MAX_HOURLY_RATE = 200        # The server's wsmaxhourlyrate setting, to check the throttle against (0 if off)
+CPU_TIME = None              # If set, the cputime sandbox parameter of each run (refused if over wsmaxcputime)
+WRAPPER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'input_wrapper_json.py')
+ESCAPE = True                # JSON-escape the code before inserting it into the wrapper (the UI's escape parameter)
+
+SERVICE = 'qtype_coderunner_run_in_sandbox'
+
+# Scratchpad code run after each PYTHON3 answer, and the standard input for the run
+SCRATCHPAD_CODE = [
+    ('print(addMul(1, 2, 3))', ''),
+    ('print(approx_const(3.14159))', ''),
+    ('print(c_to_f(100))', ''),
+    ('', '10\n'),
+]
+
+# Map from a fragment of each web-service error message (see
+# lang/en/qtype_coderunner.php) to the outcome it signifies
+REFUSALS = {
+    'maximum hourly': 'throttled',
+    'exceeds set maximum CPU time': 'cpu time refused',
+    'web service disabled': 'disabled',
+    'Only logged-in non-guest users': 'no access',
+}
+
+# Outcomes of runs that got past the throttle, which counts a run before
+# checking its CPU time or passing it to the sandbox (see run_in_sandbox.php)
+PASSED_THROTTLE = ('ok', 'cpu time refused', 'sandbox ', 'run result ', 'wrapper return code ')
+
+SANDBOX_SERVER_OVERLOAD = 9   # qtype_coderunner_sandbox::SERVER_OVERLOAD
+SANDBOX_RESULT_SUCCESS = 15   # qtype_coderunner_sandbox::RESULT_SUCCESS
+
+CODE_VARIABLE = r'(?:\{\{|\{\|)\s*%s\s*(?:\}\}|\|\})'  # {| NAME |}, as in ui_scratchpad.js, or {{ NAME }}
+
+
+def wrap(wrapper, answer_code, scratchpad_code, escape=ESCAPE):
+    '''Insert the answer and scratchpad code into the wrapper, as the
+       scratchpad UI does, optionally JSON-escaping them first
+    '''
+    if escape:
+        answer_code, scratchpad_code = json.dumps(answer_code)[1:-1], json.dumps(scratchpad_code)[1:-1]
+    wrapped = re.sub(CODE_VARIABLE % 'ANSWER_CODE', lambda match: answer_code, wrapper)
+    return re.sub(CODE_VARIABLE % 'SCRATCHPAD_CODE', lambda match: scratchpad_code, wrapped)
+
+
+def page_config(page_html):
+    '''Return the (wwwroot, sesskey, contextid) of a Moodle page, from its M.cfg'''
+    def setting(name, pattern):
+        match = re.search(r'"{}":\s*{}'.format(name, pattern), page_html)
+        if match is None:
+            raise ValueError('No {} in the page'.format(name))
+        return json.loads(match.group(1))
+    return setting('wwwroot', r'("(?:[^"\\]|\\.)*")'), setting('sesskey', r'("[^"]*")'), setting('contextid', r'(\d+)')
+
+
+def classify(status, response):
+    '''Return the outcome of a web-service call given its HTTP status and
+       decoded response body: '' if the code ran successfully, else a short
+       description
+    '''
+    if status != 200:
+        return 'HTTP {}'.format(status)
+    if not isinstance(response, list) or not response or not isinstance(response[0], dict):
+        return 'bad response'
+    if response[0].get('error'):
+        message = (response[0].get('exception') or {}).get('message', '')
+        for fragment, outcome in REFUSALS.items():
+            if fragment in message:
+                return outcome
+        return 'service error: ' + message[:80]
+    try:
+        result = json.loads(response[0]['data'])
+    except (KeyError, TypeError, ValueError):
+        return 'bad response'
+    if result.get('error') == SANDBOX_SERVER_OVERLOAD:
+        return 'sandbox overload'
+    elif result.get('error'):
+        return 'sandbox error {}'.format(result['error'])
+    elif result.get('result') != SANDBOX_RESULT_SUCCESS:
+        return 'run result {}'.format(result.get('result'))
+    try:
+        returncode = json.loads(result.get('output') or '')['returncode']
+    except (KeyError, TypeError, ValueError):
+        return ''  # Not a JSON wrapper, so the sandbox result is all we have
+    return '' if returncode == 0 else 'wrapper return code {}'.format(returncode)
+
+
+class WebServiceUser:
+    '''A logged-in student making web-service runs, and their outcomes'''
+    def __init__(self, student, wrapper, recorder, run):
+        self.student = student
+        self.wrapper = wrapper
+        self.recorder = recorder
+        self.run = run
+        self.service_url = None
+        self.body_args = None
+        self.outcomes = {}  # Map from outcome ('ok' if none) to count
+
+    async def open_course(self):
+        '''Go to the course page and set up the web service url and context'''
+        self.student.phase = 'navigate'
+        self.student.question = None
+        for link in ['Home', 'Site home']:
+            try:
+                await self.student.follow_link(link)
+            except LinkNotFoundError:
+                pass
+        await self.student.follow_link(lt.COURSE)
+        wwwroot, sesskey, contextid = page_config(self.student.html)
+        self.service_url = urljoin(wwwroot + '/', 'lib/ajax/service.php?sesskey={}&info={}'.format(sesskey, SERVICE))
+        self.body_args = {'contextid': contextid, 'language': 'python3',
+                          'params': json.dumps({'cputime': CPU_TIME}) if CPU_TIME else ''}
+
+    async def run_once(self, scheduled):
+        '''Make one web-service run, recording its latency from the scheduled time'''
+        question = random.randint(lt.FIRST_QUESTION, lt.LAST_QUESTION)
+        scratchpad, stdin = SCRATCHPAD_CODE[question]
+        answer = lt.randomise(lt.quiz_answers['PYTHON3'][question], 'PYTHON3')
+        args = dict(self.body_args, sourcecode=wrap(self.wrapper, answer, scratchpad), stdin=stdin)
+        body = [{'index': 0, 'methodname': SERVICE, 'args': args}]
+        start = time.time()
+        status = None
+        try:
+            async with self.student.session.post(self.service_url, json=body) as response:
+                status = response.status
+                text = await response.text(errors='replace')
+            try:
+                outcome = classify(status, json.loads(text))
+            except ValueError:
+                outcome = classify(status, None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            outcome = 'Request failed: {!r}'.format(e)
+        now = time.time()
+        if self.student.tracer:
+            self.student.tracer.span('web service', self.student.student_num, question, start, now - start,
+                                     status, error=outcome or None)
+        dt = now - scheduled
+        key = outcome or 'ok'
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+        if outcome:
+            self.recorder.record_error(outcome, question, 'PYTHON3')
+        else:
+            self.recorder.record(dt, question, 'PYTHON3')
+        if self.run is not None:
+            self.run.record(self.student.student_num, question, 'PYTHON3', dt, outcome,
+                            {'status': 'throttled'} if outcome == 'throttled' else None)
+
+    async def make_runs(self, rate_per_sec, time_start, time_end):
+        '''Make runs as a Poisson process until time_end, not waiting for
+           earlier runs to finish
+        '''
+        runs = []
+        for scheduled in arrival_times(rate_per_sec, time_start, time_end):
+            await asyncio.sleep(max(0, scheduled - time.time()))
+            runs.append(asyncio.ensure_future(self.run_once(scheduled)))
+        await asyncio.gather(*runs)
+
+
+async def run_users(num_users, runs_per_min, duration, run, monitor):
+    '''Coroutine that does the work of simulate_web_service'''
+    lag_watcher = asyncio.ensure_future(monitor.watch_event_loop()) if monitor else None
+    with open(WRAPPER_FILE) as infile:
+        wrapper = infile.read()
+    connector = make_connector()
+    time_start = time.time() + LOGIN_RAMP_SECS
+    recorder = LatencyRecorder(start_time=time_start)
+    users = []
+
+    async def user_runner(student_num, login_delay):
+        await asyncio.sleep(login_delay)
+        user = WebServiceUser(VirtualStudent(student_num, connector), wrapper, recorder, run)
+        try:
+            await login(user.student)
+            await user.open_course()
+            users.append(user)
+            await user.make_runs(runs_per_min / 60.0, time_start, time_start + duration)
+        except (aiohttp.ClientError, asyncio.TimeoutError, IndexError, ValueError) as e:
+            print('OOPS - student{} run broke: {!r}'.format(student_num, e))
+            recorder.record_error('User broke', -1, 'PYTHON3')
+        finally:
+            await user.student.close()
+
+    await asyncio.gather(*[user_runner(student_num, LOGIN_RAMP_SECS * i / num_users)
+                           for i, student_num in enumerate(range(lt.START_STUDENT, lt.START_STUDENT + num_users))])
+    await connector.close()
+    if lag_watcher:
+        lag_watcher.cancel()
+    return recorder, users
+
+
+def simulate_web_service(num_users=NUM_USERS, runs_per_min=RUNS_PER_MIN, duration=DURATION_SECS,
+                         run=None, monitor=None):
+    '''Have num_users students each make web-service runs at runs_per_min
+       for duration secs. Returns the pair (LatencyRecorder, list of
+       WebServiceUsers). Each run is also recorded in the results store
+       Run run, if given, and the event loop's lag is measured by the
+       ClientMonitor monitor, if given.
+    '''
+    return asyncio.run(run_users(num_users, runs_per_min, duration, run, monitor))
+
+
+def passed_throttle(outcome):
+    '''Whether a run with the given outcome ('ok' if none) got past the throttle'''
+    return outcome.startswith(PASSED_THROTTLE)
+
+
+def check_throttle(users, max_hourly_rate):
+    '''Print the outcomes of all runs and check each user's throttling
+       against max_hourly_rate. Runs that failed without showing whether
+       they got past the throttle (connection errors, HTTP errors, bad
+       responses, ...) are counted separately, and a user is only reported
+       if the throttle was wrong whichever way their failed runs went.
+       Returns the number of users whose runs weren't throttled as expected.
+    '''
+    all_outcomes = sorted(set(outcome for user in users for outcome in user.outcomes))
+    totals = {outcome: sum(user.outcomes.get(outcome, 0) for user in users) for outcome in all_outcomes}
+    num_runs = sum(totals.values())
+    print('{} web-service runs by {} users'.format(num_runs, len(users)))
+    for outcome in all_outcomes:
+        print('{:>24} {:>7} ({:.1f}%)'.format(outcome, totals[outcome], 100.0 * totals[outcome] / num_runs))
+    print()
+    if not max_hourly_rate:
+        return 0
+    bad_users = failed_users = 0
+    for user in sorted(users, key=lambda user: user.student.student_num):
+        accepted = sum(count for outcome, count in user.outcomes.items() if passed_throttle(outcome))
+        throttled = user.outcomes.get('throttled', 0)
+        failed = sum(user.outcomes.values()) - accepted - throttled
+        failed_users += failed > 0
+        if accepted > max_hourly_rate:
+            problem = 'throttle leaked'
+        elif throttled and accepted + failed < max_hourly_rate:
+            problem = 'throttled early'
+        else:
+            continue
+        bad_users += 1
+        print('*** student{}: {} runs accepted, {} throttled and {} failed; expected {} accepted ({})'.format(
+            user.student.student_num, accepted, throttled, failed,
+            min(accepted + throttled, max_hourly_rate), problem))
+    if failed_users:
+        print('{} of {} users had runs that failed before the throttle could be seen to accept them: '
+              'their checks allow for either outcome'.format(failed_users, len(users)))
+    if bad_users:
+        print('*** Throttling was wrong for {} of {} users'.format(bad_users, len(users)))
+    else:
+        print('Throttling engaged correctly at {} runs per hour for all {} users'.format(max_hourly_rate, len(users)))
+    print()
+    return bad_users
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the CodeRunner sandbox web service')
+    parser.add_argument('--users', type=int, default=NUM_USERS, help='Number of students making runs')
+    parser.add_argument('--rate', type=float, default=RUNS_PER_MIN, help='Runs per minute per user')
+    parser.add_argument('--duration', type=float, default=DURATION_SECS)
+    parser.add_argument('--max-hourly-rate', type=int, default=MAX_HOURLY_RATE,
+                        help="The server's wsmaxhourlyrate setting, or 0 to skip the throttle check")
+    parser.add_argument('--save', help='File in which to save the latency histograms')
+    parser.add_argument('--db', default=RESULTS_DB, help='Results store in which to record every run')
+    parser.add_argument('--description', default='', help='Description of this test, for the results store')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    run = store.start_run('loadtestwebservice.py', args.description,
+                          dict(vars(args), SERVER=lt.SERVER, START_STUDENT=lt.START_STUDENT, CPU_TIME=CPU_TIME))
+    start_trace(lt.TRACE_FILE)
+    monitor = ClientMonitor().start()
+    before = time.time()
+    recorder, users = simulate_web_service(args.users, args.rate, args.duration, run, monitor)
+    monitor.stop()
+    run.finish()
+    store.close()
+    finish_trace(lt.TRACE_FILE)
+    lt.print_summary(recorder, time.time() - before, monitor)
+    check_throttle(users, args.max_hourly_rate)
+    print('Results stored as run {} in {}'.format(run.run_id, args.db))
+    if args.save:
+        recorder.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+'''The workload of the CodeRunner load testers.
+
+    The correct, slow and failing answers to each of the load-testing
+    quiz questions, for each language, the parsing of language mixes and
+    the Poisson arrival process of the open-loop testers. They are kept apart from loadtesting3.py,
+    which needs mechanize, so that loadtestjobe.py can submit the answers
+    to Jobe directly without it.
+'''
+
+import random
+
+NUM_QUESTIONS = 4
+FIRST_QUESTION = 0
+RATE_SLICE_SECS = 1.0  # arrival_times bounds a varying rate over slices of this length
+RATE_SAMPLES = 10      # and samples it at this many intervals across each slice
+
+# Correct answers to the four one-question quizzes for each language.
+# Each language in loadtesting3.WORKLOAD_MIX needs its own quizzes, called
+# <LANGUAGE>_LoadTesting1 .. <LANGUAGE>_LoadTesting4, in loadtesting3.COURSE.
+
+quiz_answers = {
+
+# ==== C ====
+'C': ['''
+float addMul(float a, float b, float c)
+{
+    return (a + b) * c;
+}
+''',
+
+'''
+float approx_const(float xxx)
+{
+    long long xScaled = xxx * 1000 + 0.5;
+    return xScaled / 1000.0;
+}
+''',
+
+'''
+float c_to_f(float ccc)
+{
+    return 32.0 + ccc * 9.0 / 5.0;
+}
+''',
+
+'''
+#include <stdio.h>
+
+int main()
+{
+    int n;
+    int i;
+    scanf("%d", &n);
+    for (i = 1; i <= n; i++) {
+        printf("%d", i);
+    }
+    puts("");
+    return 0;
+}
+'''],
+
+# ==== PYTHON3 ====
+
+'PYTHON3': [
+'''
+def addMul(aaa, bbb, ccc):
+    """Return (aaa + bbb) * ccc"""
+    return (aaa + bbb) * ccc
+''',
+
+'''
+def approx_const(xxx):
+    """Return xxx rounded to 3 decimal places"""
+    x_scaled = xxx * 1000 + 0.5
+    return int(x_scaled) / 1000.0
+''',
+
+'''
+def c_to_f(degs_c):
+    """Degs_c converted to degs_f"""
+    return 32.0 + degs_c * 9.0 / 5.0
+''',
+
+'''
+"""Read n from stdin, print 1 to n without spaces"""
+n = int(input())
+for i in range(1, n+1):
+   print(str(i) + ' ', end='')
+print()
+''',
+
+'''
+([[{},{},{1,4,8}],[2,{},{}],[{},3,{}],[3,3,{}],[4,{4,5},{}],[6,{},{}],[{},7,{}],[7,7,{}],[8,{8,9},{}],[10,{},{}],[{},{},{}]],[3,7,10])
+'''],
+
+# ====== MATLAB ======
+
+'MATLAB': [
+'''function result = addMul(a, b, c)
+    result = (a + b) * c;
+end
+''',
+'''function ac = approx_const(f)
+    ac = double(int32(f * 1000))/1000;
+end
+''',
+'''function result = c_to_f(c)
+    result = 32.0 + c * 9.0 / 5.0;
+end
+''',
+'''function crazy(n)
+   s = '';
+   for i = 1 : n
+      s = [s  sprintf('%d ', i)];
+   end
+   disp(s);
+end
+'''
+],
+
+# ====== JAVA ======
+# Questions 1 to 3 are java_method questions, question 4 a java_program.
+
+'JAVA': [
+'''
+static float addMul(float a, float b, float c) {
+    return (a + b) * c;
+}
+''',
+'''
+static float approx_const(float x) {
+    long xScaled = (long) (x * 1000 + 0.5);
+    return xScaled / 1000.0f;
+}
+''',
+'''
+static float c_to_f(float c) {
+    return 32.0f + c * 9.0f / 5.0f;
+}
+''',
+'''
+import java.util.Scanner;
+
+public class Main {
+    public static void main(String[] args) {
+        Scanner in = new Scanner(System.in);
+        int n = in.nextInt();
+        StringBuilder s = new StringBuilder();
+        for (int i = 1; i <= n; i++) {
+            s.append(i);
+        }
+        System.out.println(s);
+    }
+}
+'''
+],
+
+# ====== CLOJURE ======
+"CLOJURE": """
+(defn arg-max [f ls]
+  (reduce (fn [x y] (if (> (f x) (f y)) x y)) (first ls) ls))
+;
+(defn compose [& fns]
+  (fn [x] (reduce (fn [x f] (f x)) x fns)))
+;
+(defn conjoin [& ps]
+  (fn [x] (reduce (fn [v p] (and v (p x))) true ps)))
+;
+(defn transpose [ls] (apply map list ls))
+""".split(';')
+}
+
+# Correct but deliberately slow answers (about a second of CPU time each),
+# as a map from language to a map from question to answer.
+
+slow_answers = {
+'PYTHON3': {
+0: '''
+def addMul(aaa, bbb, ccc):
+    """Return (aaa + bbb) * ccc, slowly"""
+    total = 0
+    for i in range(10 ** 7):
+        total += i
+    return (aaa + bbb) * ccc
+'''},
+
+'C': {
+0: '''
+float addMul(float a, float b, float c)
+{
+    volatile long i;
+    for (i = 0; i < 500000000; i++) {}
+    return (a + b) * c;
+}
+'''},
+
+'JAVA': {
+0: '''
+static float addMul(float a, float b, float c) {
+    long total = 0;
+    for (long i = 0; i < 300000000L; i++) {
+        total += i % 7;
+    }
+    return total >= 0 ? (a + b) * c : 0;
+}
+'''},
+
+'MATLAB': {
+0: '''function result = addMul(a, b, c)
+    total = 0;
+    for i = 1:1000000
+        total = total + i;
+    end
+    result = (a + b) * c;
+end
+'''}
+}
+
+# Answers that are graded as wrong, either because they give the wrong
+# result or because they fail at run time, in the same form as slow_answers.
+# (Answers that fail to compile aren't included, as CodeRunner reports
+# those without a results table.) Submitting them is expected to give a
+# 'Wrong answer', which is counted as a success.
+
+failing_answers = {
+'PYTHON3': {
+0: '''
+def addMul(aaa, bbb, ccc):
+    """Return (aaa + bbb) * ccc, but get the precedence wrong"""
+    return aaa + bbb * ccc
+''',
+2: '''
+def c_to_f(degs_c):
+    """Degs_c converted to degs_f, with a run-time error"""
+    return 32.0 + degs_c * 9.0 / five
+'''},
+
+'C': {
+0: '''
+float addMul(float a, float b, float c)
+{
+    return a + b * c;
+}
+''',
+2: '''
+float c_to_f(float ccc)
+{
+    int *p = 0;
+    return *p + ccc;
+}
+'''},
+
+'JAVA': {
+0: '''
+static float addMul(float a, float b, float c) {
+    return a + b * c;
+}
+''',
+2: '''
+static float c_to_f(float c) {
+    int[] scale = new int[1];
+    return 32.0f + c * scale[5];
+}
+'''},
+
+'MATLAB': {
+0: '''function result = addMul(a, b, c)
+    result = a + b * c;
+end
+'''}
+}
+
+
+def parse_mix(text):
+    '''Return a map from language to weight from a string like PYTHON3=60,C=40.
+       A language given without a weight has weight 1.
+    '''
+    mix = {}
+    for item in text.split(','):
+        language, _, weight = item.partition('=')
+        mix[language.strip()] = float(weight) if weight else 1.0
+    return mix
+
+
+def arrival_times(rate_per_sec, time_start, time_end, rng=random):
+    '''Generate the times of a Poisson process from time_start to time_end.
+       rate_per_sec is either a number or a function of the time elapsed
+       since time_start. A varying rate is followed by thinning: time is cut
+       into slices of RATE_SLICE_SECS, arrivals in each slice are drawn at
+       its peak rate (the largest of the rates at RATE_SAMPLES + 1 evenly
+       spaced points) and each is kept with probability rate / peak. A gap
+       running past the end of a slice is discarded and drawing restarts
+       there, at the next slice's peak, which is exact as the exponential
+       is memoryless. So steps (including the quiet-then-busy kind), ramps
+       and spikes are all followed exactly, unless the rate changes within
+       a slice for less than the gap between sample points. rng is the
+       source of random numbers, by default the random module.
+    '''
+    rate_fn = rate_per_sec if callable(rate_per_sec) else (lambda elapsed: rate_per_sec)
+    slice_start = time_start
+    while slice_start < time_end:
+        slice_end = min(slice_start + RATE_SLICE_SECS, time_end)
+        peak = max(rate_fn(slice_start - time_start + (slice_end - slice_start) * i / RATE_SAMPLES)
+                   for i in range(RATE_SAMPLES + 1))
+        scheduled = slice_start
+        while peak > 0:
+            scheduled += rng.expovariate(peak)
+            if scheduled >= slice_end:
+                break
+            if rng.random() * peak < rate_fn(scheduled - time_start):
+                yield scheduled
+        slice_start = slice_end
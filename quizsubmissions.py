@@ -8,6 +8,49 @@
    >>> submissions = QuizSubmissions('lab4download.csv')
    >>> submissions['zba25']   # Get the QuizAttempt for zba25@uclive.ac.nz
 
+   A QuizSubmissions object holds every attempt in memory. To process a large
+   download with bounded memory, iterate over read_quiz_attempts(csvfilename)
+   instead, which yields each QuizAttempt as soon as all its rows have been
+   read, relying on the download's rows being ordered by quiz attempt (as
+   they are by getallsubmissions.sql). For example
+
+   >>> for attempt in read_quiz_attempts('exam.csv'):
+   ...     print(attempt.email, attempt.totalmark)
+
+   The parsed download is cached in a sidecar file next to it (the download's
+   name plus '.qscache'), so opening the same download again just maps the
+   cache and unpickles each student's QuizAttempt when it's first used. The
+   cache is rebuilt automatically whenever the download changes; pass
+   use_cache=False to bypass it.
+
+   A big download can be parsed on several cores with
+   QuizSubmissions(csvfilename, processes=8), or processes=None for all of
+   them (see load_quiz_attempts_parallel).
+
+   A whole course's downloads (labs, tests, exam) can be loaded together,
+   concurrently, into a CourseSubmissions object, with one entry per student
+   and indexes by student and by question across all the quizzes:
+
+   >>> course = CourseSubmissions(['lab1.csv', 'lab2.csv', 'exam.csv'])
+   >>> course['zba25']                  # Map from quiz name to QuizAttempt
+   >>> course.question_attempts('sum_list')
+
+   Steps can be found without walking every attempt through secondary
+   indexes, by question, action, time and mark, built on first use. For
+   example, all the Checks on question 3 in a five minute window that
+   scored 0:
+
+   >>> submissions.index.steps(qnum=3, action='submit', max_fraction=0,
+   ...                         start=datetime(2018, 6, 24, 10, 0),
+   ...                         end=datetime(2018, 6, 24, 10, 5))
+
+   During an exam, a QuizSubmissions can be brought up to date with a later
+   download of the same quiz with submissions.refresh(csvfilename), which
+   builds only the steps it doesn't already have (see QuizSubmissions.refresh).
+
+   For cohort analytics, submissions.as_arrays() gives a columnar NumPy view
+   of every step (see quizsubmissionsarrays.py).
+
    A QuizAttempt object contains information about the user, when the
    quiz was started, when it was finished and the mark obtained. It also
    contains a list of the submissions made for each question in the form of
@@ -28,24 +71,51 @@
    @author Richard Lobb
    @version 24 June 2018
 """
+import bisect
 import csv
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
 from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 TOLERANCE = 0.01  # Floating point error in fraction tolerated for equality
+CACHE_SUFFIX = '.qscache'
+CACHE_MAGIC = b'QSCACHE2'  # Change the version digit whenever the classes change
+CACHE_TRAILER = struct.Struct('<Q')  # Offset of the header at the end of the cache
+MIN_CHUNK_BYTES = 1 << 20  # Smallest chunk of a download parsed by one process
+CHUNKS_PER_PROCESS = 4  # More ranges than processes balance the load
+SCAN_BYTES = 1 << 16  # Bytes read at a time when looking for a record boundary
+FRACTION_BUCKETS = 10  # Steps are indexed by fraction in tenths, full marks separately
 
 
 class QuestionAttemptStep:
-    """Wraps a single attempt step on a quiz"""
+    """Wraps a single attempt step on a quiz. A download can have millions
+       of steps, so they have fixed slots rather than a __dict__ and their
+       state, action and attribute-name strings are interned, i.e. shared
+       by all steps.
+    """
+    __slots__ = ('time', 'state', 'rawfraction', 'action', 'answer', 'fraction', '_attributes')
+
     def __init__(self, rows):  #time, action=None, fraction=0, answer=None):
         """Initialise given all the relevant attemptstepid rows from the database"""
         assert len(rows), "Empty row list passed to QuestionAttemptStep constructor"
         self.time = int(rows[0]['timestamp'])  # Unix timestamp
-        self.state = rows[0]['state']
+        self.state = sys.intern(rows[0]['state'])
         self.rawfraction = None
         self.action = None
         self.answer = None
-        self.attributes = {}  # Other attributes from the database we don't handle
+        self._attributes = None  # Created only if the step has any
         try:
             self.fraction = float(rows[0]['fraction'])
         except ValueError:
@@ -55,9 +125,9 @@ class QuestionAttemptStep:
             name = row['qasdname']
             ignore_one_answer = False
             if name == '-_rawfraction':
-                self.rawfraction = row['value']
+                self.rawfraction = sys.intern(row['value'])
             elif name.startswith('-'):
-                action = name[1:]
+                action = sys.intern(name[1:])
                 if self.action is not None:
                     if set([self.action, action]) == set(['precheck', 'submit']):
                         self.action = 'precheck'
@@ -73,7 +143,14 @@ class QuestionAttemptStep:
                 elif not ignore_one_answer:
                     self.answer += ', ' + row['value']  # Concatenate answers
             else:
-                self.attributes[name] = row['value']
+                self.attributes[sys.intern(name)] = row['value']
+
+    @property
+    def attributes(self):
+        """Other attributes from the database we don't handle"""
+        if self._attributes is None:
+            self._attributes = {}
+        return self._attributes
 
     @staticmethod
     def format_time(timestamp):
@@ -95,6 +172,8 @@ class QuestionAttempt:
        times, marks, etc.
 
     """
+    __slots__ = ('qnum', 'slot', 'name', 'mark_out_of', 'fraction', 'steps')
+
     def __init__(self, qnum, slot, rows):
         """Initialise given the the question number, its slot and the set
            of rows from the download pertaining to that question
@@ -103,7 +182,7 @@ class QuestionAttempt:
         assert int(rows[0]['slot']) == slot, "Wrong slot number in row passed to QuestionAttempt"
         self.qnum = qnum
         self.slot = slot
-        self.name = rows[0]['qname']
+        self.name = sys.intern(rows[0]['qname'])  # Shared by all attempts on the question
         self.mark_out_of = float(rows[0]['mark'])
         self.fraction = 0
         self.steps = []  # A time-ordered list of student actions/steps on this question
@@ -163,11 +242,18 @@ class QuizAttempt:
        timestamps at which the student started and ended the quiz, totalmark
        is the sum of the individual question marks and submissions is a dictionary
        mapping from question number to QuestionAttempt objects.
+       quizattemptid is the attempt's question usage id, or None if the
+       download doesn't have one. laststepid is the highest attemptstepid
+       in the attempt, i.e. that of its latest step.
     """
+    __slots__ = ('email', 'quizattemptid', 'firstname', 'lastname', 'starttime', 'endtime',
+                 'totalmark', 'maxmark', 'submissions', 'laststepid')
+
     def __init__(self, email, rows, slot2qnum_map):
         assert len(rows), "Empty rows for student {}?!".format(email)
         #print("Loading", email)
         self.email = email
+        self.quizattemptid = int(rows[0]['quizattemptid']) if rows[0].get('quizattemptid') else None
         self.firstname = rows[0]['firstname']
         self.lastname = rows[0]['lastname']
         self.starttime = int(rows[0]['timestart'])
@@ -175,6 +261,7 @@ class QuizAttempt:
         self.totalmark = 0
         self.maxmark = 0
         self.submissions = {}
+        self.laststepid = max(int(row['attemptstepid']) for row in rows)
 
         # Sort rows by question number
         question_rows = defaultdict(list)
@@ -197,6 +284,24 @@ class QuizAttempt:
         return self.submissions[qnum]
 
 
+    def add_attempt(self, other):
+        """Combine a later attempt by the same student, or the later steps
+           of this attempt, into this one, as if all their rows had been read
+           together: the steps of each question in other are appended to those
+           of self and the marks recomputed.
+        """
+        for qnum, question_attempt in other.submissions.items():
+            if qnum in self.submissions:
+                mine = self.submissions[qnum]
+                mine.steps.extend(question_attempt.steps)
+                mine.fraction = mine.steps[-1].fraction
+            else:
+                self.submissions[qnum] = question_attempt
+        self.maxmark = sum(qa.mark_out_of for qa in self.submissions.values())
+        self.totalmark = sum(qa.mark for qa in self.submissions.values())
+        self.laststepid = max(self.laststepid, other.laststepid)
+
+
     def __repr__(self):
         return "QuizAttempt({!r} ({} {}), {!r}, {!r}, {:.2f}/{:.2f}, {})".format(
             self.email, self.firstname, self.lastname,
@@ -206,49 +311,691 @@ class QuizAttempt:
 
 
 
+def slot_to_qnum_map(filename):
+    """Return the map from quiz slot to question number (1, 2, ... in slot
+       order, plus 0 for slot 0) for the given download. Reads the whole file,
+       but keeps only the slot numbers.
+    """
+    slots = set()
+    with open(filename) as infile:
+        rdr = csv.reader(infile)
+        slot_column = next(rdr).index('slot')
+        for row in rdr:
+            try:
+                slots.add(int(row[slot_column]))
+            except ValueError:
+                pass
+            except IndexError:
+                pass
+    slot2qnum_map = {slot: qnum for qnum, slot in enumerate(sorted(slots), 1)}
+    slot2qnum_map[0] = 0
+    return slot2qnum_map
+
+
+def read_quiz_attempts(filename, slot2qnum_map=None):
+    """Generate the QuizAttempt objects of the given download one at a time,
+       in file order, each as soon as the rows for its quiz attempt end, so
+       that only one attempt's rows are held in memory. The rows of each
+       attempt must be contiguous, as they are when ordered by quiz attempt id
+       (quiza.uniqueid in getallsubmissions.sql); downloads without a
+       quizattemptid column are grouped by email instead. A ValueError is
+       raised if an attempt's rows turn out not to be contiguous.
+       slot2qnum_map (see slot_to_qnum_map) is computed with an extra pass
+       over the file if not given.
+    """
+    if slot2qnum_map is None:
+        slot2qnum_map = slot_to_qnum_map(filename)
+    finished = set()  # Keys of the attempts already yielded
+    with open(filename) as infile:
+        rdr = csv.DictReader(infile)
+        key, rows = None, []
+        for row in rdr:
+            row_key = row.get('quizattemptid') or row['email']
+            if row_key != key:
+                if rows:
+                    finished.add(key)
+                    yield QuizAttempt(rows[0]['email'], rows, slot2qnum_map)
+                if row_key in finished:
+                    raise ValueError("Rows of quiz attempt {} aren't contiguous in {}".format(row_key, filename))
+                key, rows = row_key, []
+            rows.append(row)
+        if rows:
+            yield QuizAttempt(rows[0]['email'], rows, slot2qnum_map)
+
+
+def download_signature(filename, with_hash=True):
+    """Return (size, mtime in ns, content hash) for the given download, the
+       key its cache is valid for. The hash is None if with_hash is false.
+    """
+    status = os.stat(filename)
+    digest = None
+    if with_hash:
+        hasher = hashlib.blake2b()
+        with open(filename, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+    return status.st_size, status.st_mtime_ns, digest
+
+
+class CachedQuizAttempts(MutableMapping):
+    """A mapping from email to QuizAttempt backed by a memory-mapped cache
+       file, in which each QuizAttempt is pickled separately. An attempt is
+       unpickled when it's first looked up, and its questions numbered with
+       slot2qnum_map (as they may have been pickled numbered by slot).
+       Attempts added or replaced are just held in memory.
+    """
+    def __init__(self, buffer, index, slot2qnum_map):
+        self._buffer = buffer
+        self._index = index  # Map from email to (offset, length) in buffer, or None
+        self._loaded = {}
+        self.slot2qnum_map = slot2qnum_map
+
+    def blob(self, email):
+        """Return the pickled QuizAttempt for email if it hasn't been loaded
+           (so can't have changed), else None
+        """
+        if email in self._loaded or self._index[email] is None:
+            return None
+        offset, length = self._index[email]
+        return self._buffer[offset:offset + length]
+
+    def __getitem__(self, email):
+        if email not in self._loaded:
+            quiz_attempt = pickle.loads(self.blob(email))
+            _renumber(quiz_attempt, self.slot2qnum_map)
+            self._loaded[email] = quiz_attempt
+        return self._loaded[email]
+
+    def __setitem__(self, email, quiz_attempt):
+        self._loaded[email] = quiz_attempt
+        self._index.setdefault(email, None)
+
+    def __delitem__(self, email):
+        del self._index[email]
+        self._loaded.pop(email, None)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def write_cache(filename, submissions, signature):
+    """Write the cache for the given download, holding the given
+       QuizSubmissions. Attempts still pickled in an old cache are copied
+       as they are. The cache is written to a temporary file that then
+       replaces any old one, so readers never see half a cache.
+    """
+    quiz_attempts = submissions.quiz_attempts
+    cache_filename = filename + CACHE_SUFFIX
+    temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    try:
+        with open(temp_filename, 'wb') as outfile:
+            outfile.write(CACHE_MAGIC)
+            index = {}
+            for email in quiz_attempts:
+                blob = quiz_attempts.blob(email) if isinstance(quiz_attempts, CachedQuizAttempts) else None
+                if blob is None:
+                    blob = pickle.dumps(quiz_attempts[email], pickle.HIGHEST_PROTOCOL)
+                index[email] = (outfile.tell(), len(blob))
+                outfile.write(blob)
+            header_offset = outfile.tell()
+            header = {'signature': signature, 'index': index, 'slot2qnum_map': submissions.slot2qnum_map,
+                      'last_step_ids': submissions.last_step_ids}
+            pickle.dump(header, outfile, pickle.HIGHEST_PROTOCOL)
+            outfile.write(CACHE_TRAILER.pack(header_offset))
+        os.replace(temp_filename, cache_filename)
+    except OSError:  # E.g. a read-only directory: just go without a cache
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def read_cache(filename):
+    """Return (CachedQuizAttempts, slot2qnum_map, last_step_ids) for the
+       given download from its cache, or None if there's no usable cache. The cache is usable if the
+       download's size and mtime are unchanged, or if its size is unchanged
+       and its content hash is too (e.g. it was copied or touched), so the
+       download only has to be read when its mtime has changed.
+    """
+    try:
+        with open(filename + CACHE_SUFFIX, 'rb') as infile:
+            buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            return None
+        header_offset, = CACHE_TRAILER.unpack(buffer[-CACHE_TRAILER.size:])
+        header = pickle.loads(buffer[header_offset:-CACHE_TRAILER.size])
+        size, mtime_ns, digest = header['signature']
+        current_size, current_mtime_ns, _ = download_signature(filename, with_hash=False)
+        if current_size != size:
+            return None
+        if current_mtime_ns != mtime_ns and download_signature(filename)[2] != digest:
+            return None
+        slot2qnum_map = header['slot2qnum_map']
+        return CachedQuizAttempts(buffer, header['index'], slot2qnum_map), slot2qnum_map, header['last_step_ids']
+    except (OSError, ValueError, EOFError, KeyError, struct.error, pickle.UnpicklingError):
+        return None  # Missing, empty or corrupt
+
+
+def full_email(email):
+    """Return the given email, or the email for the given username"""
+    return email if '@' in email else email + '@uclive.ac.nz'
+
+
+class _IdentityMap(dict):
+    """A slot to question number map for when the real one isn't known yet"""
+    def __missing__(self, slot):
+        return slot
+
+
+def _renumber(quiz_attempt, slot2qnum_map):
+    """Change the question numbers of a QuizAttempt built with an _IdentityMap
+       (i.e. numbered by slot), or with an older map, to those given by
+       slot2qnum_map
+    """
+    submissions = {}
+    for question_attempt in quiz_attempt.submissions.values():
+        question_attempt.qnum = slot2qnum_map[question_attempt.slot]
+        submissions[question_attempt.qnum] = question_attempt
+    quiz_attempt.submissions = submissions
+
+
+def _record_start(infile, offset, quotes_before):
+    """Return the offset of the first record starting at or after the given
+       offset, i.e. just after a newline outside any quoted field, given the
+       number of double quotes before offset (or just its parity). A newline
+       is outside quotes iff an even number of quotes precede it, since
+       escaped quotes come in pairs.
+    """
+    infile.seek(offset)
+    while True:
+        block = infile.read(SCAN_BYTES)
+        if not block:
+            return offset
+        position, newline = 0, block.find(b'\n')
+        while newline >= 0:
+            quotes_before += block.count(b'"', position, newline)
+            if quotes_before % 2 == 0:
+                return offset + newline + 1
+            position, newline = newline, block.find(b'\n', newline + 1)
+        quotes_before += block.count(b'"', position)
+        offset += len(block)
+
+
+def _looks_like_record(infile, offset, fieldnames):
+    """True if the text at offset parses as whole download records, i.e.
+       ones with every field and integers where the download has them:
+       the first record and the next too, unless it runs past what's read
+    """
+    infile.seek(offset)
+    text = infile.read(SCAN_BYTES).decode(errors='replace')
+    stream = io.StringIO(text)
+    rdr = csv.reader(stream)
+    columns = [fieldnames.index(name) for name in ('timestart', 'slot', 'timestamp', 'attemptstepid')]
+    for count in range(2):
+        row = next(rdr, None)
+        if row is None or (count > 0 and stream.tell() >= len(text)):  # Nothing more to check
+            return count > 0
+        try:
+            if len(row) != len(fieldnames) or any(int(row[column]) < 0 for column in columns):
+                return False
+        except ValueError:
+            return False
+    return True
+
+
+def _guess_record_start(infile, offset, fieldnames):
+    """Return the offset of the first record starting at or after offset,
+       without knowing whether offset is inside a quoted field: the newline
+       found assuming it isn't is taken unless it doesn't start a plausible
+       record and the one found assuming it is does. The guess is checked
+       by load_quiz_attempts_parallel.
+    """
+    outside = _record_start(infile, offset, 0)
+    if _looks_like_record(infile, outside, fieldnames):
+        return outside
+    inside = _record_start(infile, offset, 1)
+    return inside if _looks_like_record(infile, inside, fieldnames) else outside
+
+
+def _parse_range(task):
+    """Parse part of a download in a worker process, from the first record
+       at or after nominal_start (which is itself a record start if
+       start_known) up to the first record at or after nominal_end. The
+       QuizAttempts that lie wholly inside the range are pickled, one after
+       another, into part_filename. The first and last quiz attempts in the
+       range may continue in the neighbouring ranges, so their rows are
+       returned unparsed as (key, rows) pairs, the last being None if the
+       range has only one attempt. Returns a dict with the byte range
+       parsed (start, end), first, last, the attempts' index entries
+       (email, key, offset, length, laststepid) and the slots they used.
+       If the start was only guessed and the range doesn't parse, start is
+       None, so that the range is parsed again from the right place.
+    """
+    filename, fieldnames, nominal_start, nominal_end, start_known, part_filename, slot2qnum_map = task
+    with open(filename, 'rb') as infile:
+        start = nominal_start if start_known else _guess_record_start(infile, nominal_start, fieldnames)
+        infile.seek(start)
+        data = infile.read(max(0, nominal_end - start))
+        end = _record_start(infile, start + len(data), data.count(b'"'))
+        infile.seek(start + len(data))
+        data += infile.read(end - start - len(data))
+
+    result = {'start': start, 'end': end, 'first': None, 'last': None, 'entries': [], 'slots': set()}
+    try:
+        groups = []
+        key, rows = None, []
+        text = io.TextIOWrapper(io.BytesIO(data))  # Decoded just as open() would
+        for row in csv.DictReader(text, fieldnames=fieldnames):
+            row_key = row.get('quizattemptid') or row['email']
+            if row_key != key:
+                if rows:
+                    groups.append((key, rows))
+                key, rows = row_key, []
+            rows.append(row)
+        if rows:
+            groups.append((key, rows))
+
+        if groups:
+            result['first'] = groups[0]
+            result['last'] = groups[-1] if len(groups) > 1 else None
+        with open(part_filename, 'wb') as outfile:
+            for key, rows in groups[1:-1]:
+                quiz_attempt = QuizAttempt(rows[0]['email'], rows, slot2qnum_map)
+                result['slots'].update(qa.slot for qa in quiz_attempt.submissions.values())
+                blob = pickle.dumps(quiz_attempt, pickle.HIGHEST_PROTOCOL)
+                result['entries'].append((quiz_attempt.email, key, outfile.tell(), len(blob), quiz_attempt.laststepid))
+                outfile.write(blob)
+    except (ValueError, TypeError, KeyError, IndexError, AssertionError, csv.Error):
+        if start_known:
+            raise
+        result['start'] = None  # A wrong guess
+    return result
+
+
+def load_quiz_attempts_parallel(filename, processes=None, signature=None):
+    """Parse the given download with the given number of worker processes
+       (None for one per core) into a cache (see write_cache) and return
+       (CachedQuizAttempts, slot2qnum_map, last_step_ids) for it, as
+       read_cache does. If signature (see download_signature) is given
+       the cache is the download's sidecar cache, otherwise an anonymous
+       temporary file.
+
+       The download is split into byte ranges, each of which a worker
+       starts at the first record after its nominal start, guessing
+       whether that is inside a quoted field (see _guess_record_start), so
+       the file is read just once. Each range must then start where the one
+       before it, itself started correctly, ended; one that doesn't is
+       parsed again from there, so multi-line answers are never split
+       even if a guess is wrong. Workers pickle the attempts wholly inside
+       their range into part files, returning only their index entries,
+       and the parent joins up the attempts spanning ranges and copies the
+       parts into the cache, so no attempt is unpickled here. The attempts
+       are numbered by slot and renumbered as they're loaded from the cache.
+       A student with more than one attempt has them combined, as for
+       QuizSubmissions.
+    """
+    processes = processes or os.cpu_count() or 1
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as infile:
+        fieldnames = next(csv.reader(io.TextIOWrapper(io.BytesIO(infile.readline()))))
+        data_start = infile.tell()
+    chunk_bytes = max(MIN_CHUNK_BYTES, -(-(size - data_start) // (processes * CHUNKS_PER_PROCESS)))
+    starts = list(range(data_start, size, chunk_bytes)) or [data_start]
+    try:  # Parts next to the download rather than in a /tmp that may be in memory
+        part_dir = tempfile.mkdtemp(prefix='quizsubmissions', dir=os.path.dirname(os.path.abspath(filename)))
+    except OSError:
+        part_dir = tempfile.mkdtemp(prefix='quizsubmissions')
+    tasks = [(filename, fieldnames, start, end, i == 0, os.path.join(part_dir, '{}.part'.format(i)), _IdentityMap())
+             for i, (start, end) in enumerate(zip(starts, starts[1:] + [size]))]
+
+    cache_filename = filename + CACHE_SUFFIX
+    temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    index = {}  # Map from email to (offset, length) in the cache
+    last_step_ids = {}
+    slots = set()
+    repeats = []  # (email, offset, length) of students' later attempts
+    finished = set()  # Keys of the attempts already added
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_parse_range, tasks)
+            for i in range(1, len(results)):
+                if results[i]['start'] != results[i - 1]['end']:  # A wrong guess
+                    task = tasks[i][:2] + (results[i - 1]['end'], max(tasks[i][3], results[i - 1]['end']), True) + tasks[i][5:]
+                    results[i] = pool.apply(_parse_range, (task,))
+
+        outfile = None
+        if signature is not None:
+            try:
+                outfile = open(temp_filename, 'w+b')
+            except OSError:  # E.g. a read-only directory: just go without a cache
+                signature = None
+        if outfile is None:
+            outfile = tempfile.TemporaryFile()
+        with outfile:
+            outfile.write(CACHE_MAGIC)
+
+            def add(email, key, offset, length, laststepid):
+                if key in finished:
+                    raise ValueError("Rows of quiz attempt {} aren't contiguous in {}".format(key, filename))
+                finished.add(key)
+                if email in index:
+                    repeats.append((email, offset, length))
+                else:
+                    index[email] = (offset, length)
+                    last_step_ids[email] = laststepid
+
+            def add_rows(key, rows):
+                quiz_attempt = QuizAttempt(rows[0]['email'], rows, _IdentityMap())
+                slots.update(qa.slot for qa in quiz_attempt.submissions.values())
+                blob = pickle.dumps(quiz_attempt, pickle.HIGHEST_PROTOCOL)
+                offset = outfile.seek(0, os.SEEK_END)
+                outfile.write(blob)
+                add(quiz_attempt.email, key, offset, len(blob), quiz_attempt.laststepid)
+
+            pending = None  # The (key, rows) of an attempt that may continue in the next range
+            for task, result in zip(tasks, results):
+                first, last = result['first'], result['last']
+                if first is None:
+                    continue
+                if pending is not None and pending[0] == first[0]:
+                    pending[1].extend(first[1])
+                else:
+                    if pending is not None:
+                        add_rows(*pending)
+                    pending = first
+                if last is not None:
+                    add_rows(*pending)
+                    base = outfile.seek(0, os.SEEK_END)
+                    with open(task[5], 'rb') as part:
+                        shutil.copyfileobj(part, outfile)
+                    for email, key, offset, length, laststepid in result['entries']:
+                        add(email, key, base + offset, length, laststepid)
+                    slots.update(result['slots'])
+                    pending = last
+            if pending is not None:
+                add_rows(*pending)
+
+            slot2qnum_map = {slot: qnum for qnum, slot in enumerate(sorted(slots), 1)}
+            slot2qnum_map[0] = 0
+            for email, offset, length in repeats:  # Rare, so just combine them here
+                quiz_attempts = []
+                for at, num_bytes in (index[email], (offset, length)):
+                    outfile.seek(at)
+                    quiz_attempts.append(pickle.loads(outfile.read(num_bytes)))
+                    _renumber(quiz_attempts[-1], slot2qnum_map)
+                quiz_attempts[0].add_attempt(quiz_attempts[1])
+                blob = pickle.dumps(quiz_attempts[0], pickle.HIGHEST_PROTOCOL)
+                index[email] = (outfile.seek(0, os.SEEK_END), len(blob))
+                last_step_ids[email] = quiz_attempts[0].laststepid
+                outfile.write(blob)
+
+            header_offset = outfile.seek(0, os.SEEK_END)
+            header = {'signature': signature, 'index': index, 'slot2qnum_map': slot2qnum_map,
+                      'last_step_ids': last_step_ids}
+            pickle.dump(header, outfile, pickle.HIGHEST_PROTOCOL)
+            outfile.write(CACHE_TRAILER.pack(header_offset))
+            outfile.flush()
+            buffer = mmap.mmap(outfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if signature is not None:
+            try:
+                os.replace(temp_filename, cache_filename)
+            except OSError:  # The mapped temporary file still works without a cache
+                os.remove(temp_filename)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return CachedQuizAttempts(buffer, index, slot2qnum_map), slot2qnum_map, last_step_ids
+
+
+def _timestamp(when):
+    """Return the Unix timestamp of a datetime, or the given timestamp"""
+    return int(when.timestamp()) if isinstance(when, datetime) else when
+
+
+def _fraction_bucket(fraction):
+    """Return the index bucket of a step's fraction, 0 .. FRACTION_BUCKETS"""
+    return max(0, min(FRACTION_BUCKETS, int(fraction * FRACTION_BUCKETS + TOLERANCE)))
+
+
+class SubmissionsIndex:
+    """Secondary indexes over all the steps of a map from email to QuizAttempt.
+       The steps are held sorted by time, each as an (email, QuestionAttempt,
+       QuestionAttemptStep) tuple, and there are indexes of their positions
+       in that order by question number, by action and by fraction bucket.
+       Each list of positions is ascending, so the steps in a time window
+       are found by bisection in each.
+    """
+    def __init__(self, quiz_attempts):
+        entries = []
+        for email, quiz_attempt in quiz_attempts.items():
+            for question_attempt in quiz_attempt.submissions.values():
+                for step in question_attempt.steps:
+                    entries.append((step.time, email, question_attempt, step))
+        entries.sort(key=lambda entry: entry[0])
+        self.times = array('q', [entry[0] for entry in entries])
+        self.entries = [entry[1:] for entry in entries]
+        self.slot2qnum = {}
+        self.by_qnum = defaultdict(lambda: array('l'))
+        self.by_action = defaultdict(lambda: array('l'))
+        self.by_fraction = defaultdict(lambda: array('l'))
+        for position, (email, question_attempt, step) in enumerate(self.entries):
+            self.slot2qnum[question_attempt.slot] = question_attempt.qnum
+            self.by_qnum[question_attempt.qnum].append(position)
+            self.by_action[step.action].append(position)
+            self.by_fraction[_fraction_bucket(step.fraction)].append(position)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @staticmethod
+    def _within(positions, low, high):
+        """The part of an ascending list of positions in [low, high)"""
+        return positions[bisect.bisect_left(positions, low):bisect.bisect_left(positions, high)]
+
+
+    def steps(self, qnum=None, slot=None, action=None, start=None, end=None,
+              min_fraction=None, max_fraction=None):
+        """Return a time-ordered list of (email, QuestionAttempt,
+           QuestionAttemptStep) for all steps matching every given filter:
+           the question (by number or slot), the action ('submit' for
+           Check, 'precheck', 'finish', ...), a time window from start up
+           to but excluding end (Unix timestamps or datetimes) and a range
+           of fractions (inclusive, with the usual TOLERANCE). The smallest
+           of the candidate lists from the indexes is scanned and the other
+           filters checked on its steps.
+        """
+        if slot is not None:
+            slot_qnum = self.slot2qnum.get(slot)
+            if qnum is not None and qnum != slot_qnum:
+                return []
+            qnum = slot_qnum if slot_qnum is not None else -1
+        low = 0 if start is None else bisect.bisect_left(self.times, _timestamp(start))
+        high = len(self.times) if end is None else bisect.bisect_left(self.times, _timestamp(end))
+        min_fraction = None if min_fraction is None else min_fraction - TOLERANCE
+        max_fraction = None if max_fraction is None else max_fraction + TOLERANCE
+
+        candidates = [range(low, high)]
+        if qnum is not None:
+            candidates.append(self._within(self.by_qnum.get(qnum, []), low, high))
+        if action is not None:
+            candidates.append(self._within(self.by_action.get(action, []), low, high))
+        if min_fraction is not None or max_fraction is not None:
+            first = 0 if min_fraction is None else _fraction_bucket(min_fraction)
+            last = FRACTION_BUCKETS if max_fraction is None else _fraction_bucket(max_fraction)
+            positions = [position for bucket in range(first, last + 1)
+                         for position in self._within(self.by_fraction.get(bucket, []), low, high)]
+            candidates.append(sorted(positions))
+
+        matches = []
+        for position in min(candidates, key=len):
+            email, question_attempt, step = self.entries[position]
+            if (low <= position < high
+                    and (qnum is None or question_attempt.qnum == qnum)
+                    and (action is None or step.action == action)
+                    and (min_fraction is None or step.fraction >= min_fraction)
+                    and (max_fraction is None or step.fraction <= max_fraction)):
+                matches.append(self.entries[position])
+        return matches
+
+
 class QuizSubmissions:
     """A class that reads a download file of all quiz submission data.
        An object of this class behaves like a dictionary mapping from
-       email to a QuizAttempt object.
+       email to a QuizAttempt object. It is built from read_quiz_attempts,
+       so the download's rows must be ordered by quiz attempt. A student
+       with more than one attempt has them combined into a single QuizAttempt.
+       The parsed attempts are cached next to the download unless use_cache
+       is false. If processes isn't 1 the download is parsed by that many
+       processes (None for one per core) with load_quiz_attempts_parallel,
+       and its attempts are then loaded lazily, as from the cache.
+       last_step_ids maps each email to the laststepid of its QuizAttempt,
+       so that refresh needn't load every attempt from the cache.
     """
-    def __init__(self, filename):
-        """Read the .csv file given and record all vital information
-           for querying.
+    def __init__(self, filename, use_cache=True, processes=1):
+        """Read the .csv file given (or its cache) and record all vital
+           information for querying.
+        """
+        self._index = None
+        if use_cache:
+            cached = read_cache(filename)
+            if cached is not None:
+                self.quiz_attempts, self.slot2qnum_map, self.last_step_ids = cached
+                return
+            signature = download_signature(filename)
+
+        if processes != 1:  # Straight into a cache, which is written even without use_cache
+            self.quiz_attempts, self.slot2qnum_map, self.last_step_ids = load_quiz_attempts_parallel(
+                filename, processes, signature if use_cache else None)
+            return
+
+        self.slot2qnum_map = slot_to_qnum_map(filename)
+        self.quiz_attempts = {}  # Map from email to QuizAttempt
+        self.last_step_ids = {}  # Map from email to its QuizAttempt's laststepid
+        self._add_attempts(read_quiz_attempts(filename, self.slot2qnum_map))
+
+        if use_cache:
+            write_cache(filename, self, signature)
+
+
+    def _add_attempts(self, quiz_attempts):
+        """Add the given QuizAttempts, combining any with those of the same
+           student already held
         """
-        self.quiz_attempts = {}  # Map from email to StudentQuizAttempt
+        for quiz_attempt in quiz_attempts:
+            email = quiz_attempt.email
+            if email in self.quiz_attempts:
+                self.quiz_attempts[email].add_attempt(quiz_attempt)
+            else:
+                self.quiz_attempts[email] = quiz_attempt
+            self.last_step_ids[email] = self.quiz_attempts[email].laststepid
+
 
-        # First read all rows, sorting them by student email into a dictionary
-        # Record all slot numbers in order to compute question numbers
+    def _slots_map(self, new_slots):
+        """Return the slot to question number map for the slots of all the
+           attempts held plus the given new ones
+        """
+        slots = set(new_slots)
+        for quiz_attempt in self.quiz_attempts.values():
+            slots.update(qa.slot for qa in quiz_attempt.submissions.values())
+        slot2qnum_map = {slot: qnum for qnum, slot in enumerate(sorted(slots), 1)}
+        slot2qnum_map[0] = 0
+        return slot2qnum_map
+
+
+    def ingest_rows(self, rows):
+        """Add the steps in the given download rows (dicts, as from a
+           csv.DictReader) that are later than the latest step held for
+           their student, i.e. have a greater attemptstepid, and return the
+           number of new steps. The rows can be a whole later download or
+           just its new rows (e.g. from getallsubmissions.sql restricted to
+           recent timestamps); the work done grows only with the new rows.
+           The new steps of each attempt are built as a partial QuizAttempt
+           and combined into the one held, which updates its marks from
+           those of its questions. A quiz slot never seen before renumbers
+           the questions of every attempt, as a full reload would.
+        """
+        new_rows = defaultdict(list)  # Map from attempt key to its new rows
+        for row in rows:
+            if int(row['attemptstepid']) > self.last_step_ids.get(row['email'], -1):
+                new_rows[row.get('quizattemptid') or row['email']].append(row)
+        if not new_rows:
+            return 0
+
+        new_slots = {int(row['slot']) for key_rows in new_rows.values() for row in key_rows}
+        if not new_slots.issubset(self.slot2qnum_map):
+            self.slot2qnum_map = self._slots_map(new_slots)
+            if isinstance(self.quiz_attempts, CachedQuizAttempts):
+                self.quiz_attempts.slot2qnum_map = self.slot2qnum_map  # For attempts not loaded yet
+            for quiz_attempt in self.quiz_attempts.values():
+                _renumber(quiz_attempt, self.slot2qnum_map)
+
+        partial_attempts = []
+        for key_rows in new_rows.values():
+            partial_attempt = QuizAttempt(key_rows[0]['email'], key_rows, self.slot2qnum_map)
+            existing = self.quiz_attempts.get(partial_attempt.email)
+            if existing is not None and existing.quizattemptid == partial_attempt.quizattemptid:
+                # timefinish is set when the attempt is finished
+                existing.endtime = max([existing.endtime] + [int(row['timefinish']) for row in key_rows])
+            partial_attempts.append(partial_attempt)
+        self._add_attempts(partial_attempts)
+        self._index = None  # Rebuilt on next use
+        return len({int(row['attemptstepid']) for key_rows in new_rows.values() for row in key_rows})
+
+
+    def refresh(self, filename, use_cache=True):
+        """Bring self up to date with a later download of the same quiz,
+           building only the steps it doesn't already have, and return the
+           number of new steps. The download is scanned as plain csv rows
+           and only the new ones are turned into dicts and steps. The cache
+           of the new download is then written, reusing the pickles of the
+           attempts that haven't changed, unless use_cache is false.
+        """
+        signature = download_signature(filename) if use_cache else None
+        new_rows = []
         with open(filename) as infile:
-            rdr = csv.DictReader(infile)
-            submissions = defaultdict(list)
-            slots = set()
+            rdr = csv.reader(infile)
+            fieldnames = next(rdr)
+            email_column = fieldnames.index('email')
+            step_column = fieldnames.index('attemptstepid')
+            last_step_ids = self.last_step_ids
             for row in rdr:
-                email = row['email']
-                try:
-                    slot = int(row['slot'])
-                    slots.add(slot)
-                except ValueError:
-                    pass
-                except TypeError:
-                    pass
-                submissions[email].append(row)
-
-            # We now have all slots, so can compute question numbers
-            slotnums = sorted(slots)
-            slot2qnum_map = { slot : qnum for qnum, slot in enumerate(slotnums, 1)}
-            slot2qnum_map[0] = 0
+                if len(row) == len(fieldnames) and int(row[step_column]) > last_step_ids.get(row[email_column], -1):
+                    new_rows.append(dict(zip(fieldnames, row)))
+        num_new_steps = self.ingest_rows(new_rows)
+        if use_cache:
+            write_cache(filename, self, signature)
+        return num_new_steps
+
 
-            for email, rows in submissions.items():
-                self.quiz_attempts[email] = QuizAttempt(email, rows, slot2qnum_map)
+    @classmethod
+    def from_attempts(cls, quiz_attempts):
+        """Return a QuizSubmissions holding the given map from email to
+           QuizAttempt, rather than one read from a download
+        """
+        submissions = cls.__new__(cls)
+        submissions.quiz_attempts = quiz_attempts
+        submissions.last_step_ids = {email: qa.laststepid for email, qa in quiz_attempts.items()}
+        submissions.slot2qnum_map = submissions._slots_map(set())
+        submissions._index = None
+        return submissions
+
+
+    @property
+    def index(self):
+        """The SubmissionsIndex of all the steps, built on first use"""
+        if self._index is None:
+            self._index = SubmissionsIndex(self.quiz_attempts)
+        return self._index
 
 
     def __getitem__(self, email):
         """Subscripting self with an email (or a username) returns the
            QuizAttempt object for the specified student
         """
-        key = email if '@' in email else email + '@uclive.ac.nz'
-        return self.quiz_attempts[key]
+        return self.quiz_attempts[full_email(email)]
 
 
     def __iter__(self):
@@ -269,7 +1016,120 @@ class QuizSubmissions:
         return self.quiz_attempts.keys()
 
 
+    def as_arrays(self):
+        """Returns a columnar view of all the attempts for vectorised
+           analytics (see quizsubmissionsarrays.py, which needs NumPy)
+        """
+        from quizsubmissionsarrays import SubmissionArrays
+        return SubmissionArrays(self.quiz_attempts.values())
+
+
     def __repr__(self):
-        return "QuizSubmissions({})".format(self.quiz_attempts)
+        return "QuizSubmissions({})".format(dict(self.quiz_attempts))
+
+
+
+
+
+class User:
+    """A student in a CourseSubmissions, shared by all their QuizAttempts"""
+    __slots__ = ('email', 'firstname', 'lastname')
+
+    def __init__(self, email, firstname, lastname):
+        self.email = email
+        self.firstname = firstname
+        self.lastname = lastname
 
+    def __repr__(self):
+        return "User({!r}, {!r}, {!r})".format(self.email, self.firstname, self.lastname)
+
+
+def _load_quiz(task):
+    """Parse a download in a worker process. With use_cache the parsed
+       download goes to its sidecar cache, which the parent then maps, so
+       nothing is returned; otherwise the map from email to QuizAttempt is.
+    """
+    filename, use_cache = task
+    submissions = QuizSubmissions(filename, use_cache)
+    return None if use_cache else submissions.quiz_attempts
+
+
+class CourseSubmissions:
+    """The downloads of several quizzes in a course, e.g. all its labs, tests
+       and exam, held as one QuizSubmissions partition per quiz plus a single
+       user table (each student's name and email strings are shared by all
+       their QuizAttempts) and indexes by student and by question name.
+       filenames is a list of downloads, each named after its file (less
+       the .csv), or a map from quiz name to download. The downloads are
+       parsed concurrently by the given number of processes (None for one
+       per core) and cached as for QuizSubmissions unless use_cache is false.
+    """
+    def __init__(self, filenames, processes=None, use_cache=True):
+        if not isinstance(filenames, dict):
+            filenames = {os.path.splitext(os.path.basename(filename))[0]: filename for filename in filenames}
+        self.quizzes = {}  # Map from quiz name to its QuizSubmissions
+        self.users = {}  # Map from email to User
+        self._by_user = {}  # Map from email to a map from quiz name to QuizAttempt
+        self._by_question = defaultdict(list)  # Map from question name to (quiz, email, QuestionAttempt)s
+
+        tasks = [(filename, use_cache) for filename in filenames.values()]
+        if processes == 1 or len(tasks) <= 1:
+            loaded = [_load_quiz(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                loaded = list(pool.map(_load_quiz, tasks))
+
+        for quiz, filename, quiz_attempts in zip(filenames, filenames.values(), loaded):
+            if quiz_attempts is None:
+                self.quizzes[quiz] = QuizSubmissions(filename)  # Now a cache hit
+            else:
+                self.quizzes[quiz] = QuizSubmissions.from_attempts(quiz_attempts)
+            self._index(quiz)
 
+
+    def _index(self, quiz):
+        """Add the attempts of the given quiz's partition to the user table
+           and the indexes
+        """
+        for email, quiz_attempt in self.quizzes[quiz].items():
+            user = self.users.get(email)
+            if user is None:
+                user = self.users[email] = User(email, quiz_attempt.firstname, quiz_attempt.lastname)
+            quiz_attempt.email, quiz_attempt.firstname, quiz_attempt.lastname = (
+                user.email, user.firstname, user.lastname)
+            self._by_user.setdefault(email, {})[quiz] = quiz_attempt
+            for question_attempt in quiz_attempt.submissions.values():
+                self._by_question[question_attempt.name].append((quiz, email, question_attempt))
+
+
+    def __getitem__(self, email):
+        """Subscripting self with an email (or a username) returns the map
+           from quiz name to QuizAttempt for the specified student
+        """
+        return self._by_user[full_email(email)]
+
+
+    def __iter__(self):
+        """Iterates over the emails of all the students"""
+        return iter(self.users)
+
+
+    def __len__(self):
+        return len(self.users)
+
+
+    def question_names(self):
+        """Returns the names of all the questions in all the quizzes"""
+        return self._by_question.keys()
+
+
+    def question_attempts(self, name, quiz=None):
+        """Returns a list of (quiz name, email, QuestionAttempt) for every
+           attempt on the named question, in any quiz or just the given one
+        """
+        attempts = self._by_question.get(name, [])
+        return attempts if quiz is None else [attempt for attempt in attempts if attempt[0] == quiz]
+
+
+    def __repr__(self):
+        return "CourseSubmissions({})".format(list(self.quizzes))
@@ -0,0 +1,238 @@
+'''A columnar (NumPy) view of quiz submissions for cohort analytics.
+
+    A SubmissionArrays object holds every question attempt step of a set of
+    QuizAttempts (see quizsubmissions.py) as parallel arrays, one per field,
+    with one element per step:
+
+      * attempt: the index of the step's quiz attempt in self.emails (and
+        self.quizattemptids and self.starttimes);
+      * qnum and slot: the question number and quiz slot;
+      * step: the index of the step in its QuestionAttempt's steps;
+      * time: the step's Unix timestamp;
+      * fraction: the fraction of the question's mark the step earned;
+      * action: a code for the step's action, an index into self.actions
+        (0, i.e. None, if the step had no action).
+
+    The steps are ordered by attempt, then question number, then step, so
+    the steps of each question attempt are contiguous. The analytics work
+    on whole arrays rather than looping over attempts in Python, and return
+    either arrays with one row per quiz attempt (labelled by self.emails)
+    and one column per question (labelled by self.qnums) or flat arrays.
+
+    >>> submissions = QuizSubmissions('exam.csv')
+    >>> arrays = submissions.as_arrays()
+    >>> arrays.first_right_times()      # Seconds from start to first right answer
+    >>> arrays.submissions_per_minute()
+
+    A large download can be loaded without building a QuizSubmissions first,
+    although a student's separate attempts then stay separate rows:
+
+    >>> arrays = SubmissionArrays.from_file('exam.csv')
+
+    Run as a program it prints a per-question summary of a download:
+
+        python3 quizsubmissionsarrays.py exam.csv
+
+    Requires NumPy.
+'''
+
+import argparse
+from array import array
+
+import numpy as np
+
+from quizsubmissions import TOLERANCE, read_quiz_attempts
+
+ACTIONS = [None, 'precheck', 'submit', 'finish']  # Action codes, extended as others turn up
+MINUTE = 60
+
+
+class SubmissionArrays:
+    '''The steps of a set of QuizAttempts as one array per field'''
+
+    def __init__(self, quiz_attempts):
+        '''Build the arrays from an iterable of QuizAttempts, which is
+           consumed just once so can be a read_quiz_attempts stream
+        '''
+        self.actions = list(ACTIONS)
+        action_codes = {action: code for code, action in enumerate(self.actions)}
+        self.emails = []
+        quizattemptids, starttimes = array('q'), array('q')
+        attempt, qnum, slot, step, time = array('l'), array('l'), array('l'), array('l'), array('q')
+        fraction, action = array('d'), array('b')
+        mark_out_of = {}
+
+        for index, quiz_attempt in enumerate(quiz_attempts):
+            self.emails.append(quiz_attempt.email)
+            quizattemptids.append(-1 if quiz_attempt.quizattemptid is None else quiz_attempt.quizattemptid)
+            starttimes.append(quiz_attempt.starttime)
+            for question_num, question_attempt in sorted(quiz_attempt.submissions.items()):
+                mark_out_of.setdefault(question_num, question_attempt.mark_out_of)
+                for step_index, attempt_step in enumerate(question_attempt.steps):
+                    code = action_codes.get(attempt_step.action)
+                    if code is None:
+                        code = action_codes[attempt_step.action] = len(self.actions)
+                        self.actions.append(attempt_step.action)
+                    attempt.append(index)
+                    qnum.append(question_num)
+                    slot.append(question_attempt.slot)
+                    step.append(step_index)
+                    time.append(attempt_step.time)
+                    fraction.append(attempt_step.fraction)
+                    action.append(code)
+
+        self.quizattemptids = np.array(quizattemptids, dtype=np.int64)
+        self.starttimes = np.array(starttimes, dtype=np.int64)
+        self.attempt = np.array(attempt, dtype=np.int64)
+        self.qnum = np.array(qnum, dtype=np.int64)
+        self.slot = np.array(slot, dtype=np.int64)
+        self.step = np.array(step, dtype=np.int64)
+        self.time = np.array(time, dtype=np.int64)
+        self.fraction = np.array(fraction, dtype=np.float64)
+        self.action = np.array(action, dtype=np.int8)
+        self.qnums = np.array(sorted(mark_out_of), dtype=np.int64)
+        self.mark_out_of = np.array([mark_out_of[q] for q in self.qnums], dtype=np.float64)
+
+        # Each question attempt is a group of contiguous steps, numbered in order
+        self._column = np.searchsorted(self.qnums, self.qnum)
+        self._group = self.attempt * len(self.qnums) + self._column
+        self._groups, self._group_starts = np.unique(self._group, return_index=True)
+        self._group_ends = np.append(self._group_starts[1:], len(self._group))
+
+
+    @classmethod
+    def from_file(cls, filename):
+        '''Return the arrays for the given download, streamed with
+           read_quiz_attempts so only one attempt is materialised at a time
+        '''
+        return cls(read_quiz_attempts(filename))
+
+
+    def __len__(self):
+        '''The number of steps'''
+        return len(self.time)
+
+
+    def action_code(self, action):
+        '''Return the code for the given action name (e.g. 'submit')'''
+        return self.actions.index(action)
+
+
+    def _grid(self, fill, dtype=np.float64):
+        '''A new attempts x questions array filled with fill'''
+        return np.full((len(self.emails), len(self.qnums)), fill, dtype=dtype)
+
+
+    def _put(self, grid, groups, values):
+        '''Store values in grid at the cells of the given group numbers'''
+        grid.flat[groups] = values
+        return grid
+
+
+    def _first_right(self, mark_threshold):
+        '''Return the group numbers of the question attempts that reached
+           mark_threshold and the index of the first step that did in each
+        '''
+        right = np.flatnonzero(self.fraction >= mark_threshold)
+        groups, first = np.unique(self._group[right], return_index=True)
+        return groups, right[first]
+
+
+    def marks(self):
+        '''Return the attempts x questions array of final marks, i.e. the
+           fraction of each question's last step times its mark, with NaN
+           for questions not attempted
+        '''
+        last = self._group_ends - 1
+        columns = self._column[last]
+        return self._put(self._grid(np.nan), self._groups, self.fraction[last] * self.mark_out_of[columns])
+
+
+    def total_marks(self):
+        '''Return the array of total marks, one per quiz attempt'''
+        return np.nansum(self.marks(), axis=1)
+
+
+    def mark_distribution(self, bins=10):
+        '''Return (counts, bin_edges) of the histogram of total marks, with
+           bins as for numpy.histogram
+        '''
+        return np.histogram(self.total_marks(), bins=bins)
+
+
+    def first_right_times(self, mark_threshold=1 - TOLERANCE):
+        '''Return the attempts x questions array of the seconds from the
+           start of each quiz attempt to the first step earning at least
+           mark_threshold on each question, with NaN if none did
+        '''
+        groups, first = self._first_right(mark_threshold)
+        elapsed = self.time[first] - self.starttimes[self.attempt[first]]
+        return self._put(self._grid(np.nan), groups, elapsed)
+
+
+    def attempts_to_threshold(self, mark_threshold=1 - TOLERANCE, action='submit'):
+        '''Return the attempts x questions array of the number of steps with
+           the given action (Check, by default) made on each question up to
+           and including the first step earning at least mark_threshold,
+           with -1 if no step did
+        '''
+        if action in self.actions:
+            is_action = self.action == self.action_code(action)
+        else:
+            is_action = np.zeros(len(self), dtype=bool)
+        counts = np.concatenate(([0], np.cumsum(is_action)))
+        groups, first = self._first_right(mark_threshold)
+        starts = self._group_starts[np.searchsorted(self._groups, groups)]
+        return self._put(self._grid(-1, np.int64), groups, counts[first + 1] - counts[starts])
+
+
+    def submissions_per_minute(self, action='submit'):
+        '''Return (minutes, counts): the Unix timestamps of the start of
+           every minute from the first to the last step with the given
+           action (None for all steps) and the number of such steps in each
+        '''
+        if action is None:
+            times = self.time
+        elif action in self.actions:
+            times = self.time[self.action == self.action_code(action)]
+        else:
+            times = self.time[:0]
+        if len(times) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        first = times.min() // MINUTE
+        counts = np.bincount(times // MINUTE - first)
+        return (first + np.arange(len(counts))) * MINUTE, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise a quiz-attempt download per question')
+    parser.add_argument('filename', help='The download (.csv) from getallsubmissions.sql')
+    parser.add_argument('--threshold', type=float, default=1 - TOLERANCE,
+                        help='Fraction counted as a right answer')
+    args = parser.parse_args()
+
+    arrays = SubmissionArrays.from_file(args.filename)
+    marks = arrays.marks()
+    times = arrays.first_right_times(args.threshold)
+    tries = arrays.attempts_to_threshold(args.threshold).astype(np.float64)
+    tries[tries < 0] = np.nan
+    print('{} quiz attempts, {} steps'.format(len(arrays.emails), len(arrays)))
+    print()
+    print('{:>5} {:>10} {:>9} {:>12} {:>13}'.format('qnum', 'mean mark', 'right %', 'median mins', 'median tries'))
+    for column, qnum in enumerate(arrays.qnums):
+        attempted = ~np.isnan(marks[:, column])
+        right = ~np.isnan(times[:, column])
+        print('{:>5} {:>10.2f} {:>9.1f} {:>12.1f} {:>13.1f}'.format(
+            qnum,
+            np.nanmean(marks[:, column]) if attempted.any() else np.nan,
+            100 * right.sum() / max(1, attempted.sum()),
+            np.median(times[right, column]) / MINUTE if right.any() else np.nan,
+            np.median(tries[right, column]) if right.any() else np.nan))
+    minutes, counts = arrays.submissions_per_minute()
+    if len(counts):
+        print()
+        print('Peak of {} Checks per minute, mean {:.1f}'.format(counts.max(), counts.mean()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+'''Memory and time benchmark for quizsubmissions.py.
+
+    Writes a synthetic quiz-attempt download (in the format, and the order,
+    of getallsubmissions.sql) with the given number of question attempt
+    steps, a million by default, then reports the time taken, the peak
+    memory and the memory retained afterwards (measured with tracemalloc)
+    for:
+
+      * the raw csv.DictReader rows of the download, i.e. what QuizSubmissions
+        used to hold while building its QuizAttempts;
+      * streaming through it with read_quiz_attempts, keeping nothing;
+      * a materialised QuizSubmissions holding every attempt, parsed from
+        the download (writing its cache) and then opened from the cache,
+        both alone and with every attempt then loaded.
+
+    It then reports, without tracemalloc, how the parse scales with the
+    number of processes: the time for QuizSubmissions(processes=n), without
+    the cache, for n = 1, 2, 4, ... up to --processes (one per core by
+    default), the speed-up over n = 1 and the further time to load every
+    attempt, which the parallel parse leaves until each is used.
+
+        python3 quizsubmissionsbenchmark.py --steps 1000000 --processes 16
+
+    tracemalloc roughly doubles the run time, so the times in the first
+    table are only useful for comparing the methods with each other.
+'''
+
+import argparse
+import csv
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from quizsubmissions import CACHE_SUFFIX, QuizSubmissions, read_quiz_attempts, slot_to_qnum_map
+
+NUM_STEPS = 1000000
+NUM_QUESTIONS = 10
+STEPS_PER_QUESTION = 10
+QUIZ_START = 1700000000
+QUIZ_SECS = 2 * 60 * 60
+
+COLUMNS = ['uniquekey', 'quizattemptid', 'timestart', 'timefinish', 'firstname', 'lastname', 'email',
+           'slot', 'questionid', 'qname', 'mark', 'timestamp', 'datetime', 'fraction', 'state',
+           'attemptstepid', 'qasdname', 'value']
+
+
+def write_download(filename, num_steps=NUM_STEPS, num_questions=NUM_QUESTIONS,
+                   steps_per_question=STEPS_PER_QUESTION, seed=1):
+    '''Write a synthetic download with (about) num_steps steps: each student
+       makes steps_per_question Precheck or Check submissions on each of
+       num_questions questions, each step being an action row plus an
+       answer row. Returns the number of steps written.
+    '''
+    rng = random.Random(seed)
+    num_students = max(1, num_steps // (num_questions * steps_per_question))
+    uniquekey = stepid = 0
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(COLUMNS)
+        for student in range(num_students):
+            start = QUIZ_START + rng.randrange(600)
+            finish = start + QUIZ_SECS - rng.randrange(1800)
+            common = [student + 1, start, finish, 'First{}'.format(student), 'Last{}'.format(student),
+                      'student{}@example.com'.format(student)]
+            rows = []
+            for question in range(num_questions):
+                slot = question + 1
+                fraction = 0.0
+                for timestamp in sorted(rng.randrange(start, finish) for _ in range(steps_per_question)):
+                    stepid += 1
+                    action = '-precheck' if rng.random() < 0.3 else '-submit'
+                    if action == '-submit' and fraction < 1.0:
+                        fraction = min(1.0, fraction + rng.choice([0.0, 0.5, 1.0]))
+                    state = 'complete' if fraction >= 1.0 else 'todo'
+                    answer = 'def answer{}(x):\n    return x * {}\n'.format(question, rng.randrange(1000))
+                    question_cells = [slot, 100 + slot, 'Question {}'.format(slot), '1.0000000', timestamp, '',
+                                      '{:.7f}'.format(fraction), state, stepid]
+                    rows.append((timestamp, stepid, question_cells + [action, '1']))
+                    rows.append((timestamp, stepid, question_cells + ['answer', answer]))
+            rows.sort(key=lambda row: row[:2])  # By timestamp, as the SQL does
+            for _, _, cells in rows:
+                uniquekey += 1
+                writer.writerow([uniquekey] + common + cells)
+    return stepid
+
+
+def measure(label, function, num_steps):
+    '''Run function under tracemalloc and print its time, peak memory and
+       the memory still held by its result
+    '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<22} {:>8.1f} {:>10.1f} {:>12.1f} {:>14.0f}'.format(
+        label, elapsed, peak / 2 ** 20, retained / 2 ** 20, retained / num_steps))
+    del result
+    gc.collect()
+
+
+def read_rows(filename):
+    with open(filename) as infile:
+        return list(csv.DictReader(infile))
+
+
+def stream(filename, slot2qnum_map):
+    for _ in read_quiz_attempts(filename, slot2qnum_map):
+        pass
+
+
+def load_all(filename):
+    submissions = QuizSubmissions(filename)
+    for email in submissions:
+        submissions[email]
+    return submissions
+
+
+def timed(function):
+    '''Return the result of calling function and the seconds it took'''
+    gc.collect()
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def scaling(filename, max_processes):
+    '''Print the time taken to parse the download with 1, 2, 4, ...
+       max_processes processes and then to load every attempt
+    '''
+    counts = [1]
+    while counts[-1] * 2 < max_processes:
+        counts.append(counts[-1] * 2)
+    if max_processes > 1:
+        counts.append(max_processes)
+    print('{:>9} {:>8} {:>9} {:>14}'.format('processes', 'secs', 'speed-up', 'load all secs'))
+    serial_secs = None
+    for processes in counts:
+        submissions, secs = timed(lambda: QuizSubmissions(filename, use_cache=False, processes=processes))
+        _, load_secs = timed(lambda: [submissions[email] for email in submissions])
+        serial_secs = serial_secs or secs
+        print('{:>9} {:>8.2f} {:>9.2f} {:>14.2f}'.format(processes, secs, serial_secs / secs, load_secs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark quizsubmissions.py on a synthetic download')
+    parser.add_argument('--steps', type=int, default=NUM_STEPS, help='Number of question attempt steps')
+    parser.add_argument('--questions', type=int, default=NUM_QUESTIONS, help='Number of questions in the quiz')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of processes for the parallel parse')
+    parser.add_argument('--keep', metavar='CSV', help='Write the download to this file and keep it')
+    args = parser.parse_args()
+
+    if args.keep:
+        filename = args.keep
+    else:
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+    try:
+        num_steps = write_download(filename, args.steps, args.questions)
+        print('{} steps, {:.0f} MB download'.format(num_steps, os.path.getsize(filename) / 2 ** 20))
+        print()
+        slot2qnum_map = slot_to_qnum_map(filename)
+        print('{:<22} {:>8} {:>10} {:>12} {:>14}'.format('', 'secs', 'peak MB', 'retained MB', 'bytes/step'))
+        measure('csv rows', lambda: read_rows(filename), num_steps)
+        measure('read_quiz_attempts', lambda: stream(filename, slot2qnum_map), num_steps)
+        measure('QuizSubmissions', lambda: QuizSubmissions(filename), num_steps)
+        measure('cached open', lambda: QuizSubmissions(filename), num_steps)
+        measure('cached, all loaded', lambda: load_all(filename), num_steps)
+        print()
+        scaling(filename, args.processes)
+    finally:
+        if not args.keep:
+            os.remove(filename)
+        if os.path.exists(filename + CACHE_SUFFIX):
+            os.remove(filename + CACHE_SUFFIX)
+
+
+if __name__ == '__main__':
+    main()